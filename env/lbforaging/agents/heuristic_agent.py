@@ -1,7 +1,7 @@
 import random
 import numpy as np
-from foraging import Agent
-from foraging.environment import Action
+from env.lbforaging.foraging.agent import Agent
+from env.lbforaging.foraging.environment import Action
 
 
 class HeuristicAgent(Agent):
@@ -1,14 +1,12 @@
 import logging
 import math
-import pickle
 import random
 import time
 
 import networkx as nx
-import plotly.graph_objs as go
-from networkx.drawing.nx_pydot import graphviz_layout
 
-from foraging import Agent, Env
+from env.lbforaging.foraging.agent import Agent
+from env.lbforaging.foraging.environment import ForagingEnv as Env
 
 MCTS_DEPTH = 15
 
@@ -16,6 +14,9 @@ logger = logging.getLogger(__name__)
 
 
 def plot_graph(G):
+    import plotly.graph_objs as go
+    from networkx.drawing.nx_pydot import graphviz_layout
+
     pos = graphviz_layout(G, prog="dot")
 
     edge_trace = go.Scatter(
@@ -78,7 +79,7 @@ def plot_graph(G):
         node_trace["y"].append(y)
 
         node_info = "Visits: +{0}<br>Rewards: {1}<br>Score: {2}".format(
-            node.visits, node.reward, node.state.players[0].score
+            node.visits, node.reward, node.score
         )
 
         node_trace["text"].append(node_info)
@@ -102,7 +103,11 @@ def plot_graph(G):
 
 
 class Node:
-    def __init__(self, state: Env):
+    def __init__(self, env: Env, player_id=0):
+        """
+        :param player_id: index in `env.players` of the player searching,
+        whose score the node keeps
+        """
         self.root = None
 
         self.move = None
@@ -111,9 +116,14 @@ class Node:
         self.parent = None
         self.children = []
 
-        self.state = state
+        # the nodes of a search share one env, and keep a snapshot of its state
+        # (steps don't draw from the env random state, so it is left out)
+        self.env = env
+        self.player_id = player_id
+        self.state = env.get_state(rng=False)
+        self.score = env.players[player_id].score
 
-        self.available_moves = set(state.get_valid_actions())
+        self.available_moves = set(env.get_valid_actions())
         self.tried_moves = set()
 
         self.is_terminal = False
@@ -133,15 +143,15 @@ class Node:
         return u_new
 
     def add_child(self, move):
-        new_state = pickle.loads(pickle.dumps(self.state, pickle.HIGHEST_PROTOCOL))
+        self.env.set_state(self.state, rng=False)
         new_is_terminal = False
 
-        observations = new_state.step(move)
+        self.env.step(move)
 
-        if new_state.game_over:
+        if self.env.game_over:
             new_is_terminal = True
 
-        u_new = Node(new_state)
+        u_new = Node(self.env, self.player_id)
 
         u_new.is_terminal = new_is_terminal
 
@@ -155,12 +165,10 @@ class Node:
         return u_new
 
     def best_child(self, c=2, h=10):
-        my_id = 0  # todo fix this
-
         ucb1 = lambda u: (
             u.reward / u.visits
             + c * math.sqrt(math.log(self.root.visits / u.visits))
-            + h * u.state.players[my_id].score / u.visits
+            + h * u.score / u.visits
         )
         best = max(self.children, key=ucb1)
 
@@ -180,19 +188,24 @@ class MonteCarloAgent(Agent):
         pass
 
     def step(self, obs):
-
-        my_id = 0  # todo fix this
         env = Env.from_obs(obs)
         root = self.uct_search(env)
 
         move = root.most_visited_child().move
 
-        return move[my_id]
+        return move[root.player_id]
+
+    def _player_id(self, env: Env):
+        # the players of the env the agent was made for, else the first one
+        for idx, player in enumerate(env.players):
+            if player is self.player:
+                return idx
+        return 0
 
     def uct_search(self, state: Env, timeout=0.5):
         graph = nx.DiGraph()
 
-        root = Node(state)
+        root = Node(state, self._player_id(state))
         root.root = root
 
         graph.add_node(root)
@@ -216,6 +229,7 @@ class MonteCarloAgent(Agent):
 
         # py.plot(plot_graph(graph))
         # print(root.visits)
+        state.set_state(root.state, rng=False)
         return root
 
     def backup(self, u: Node, delta: float):
@@ -239,15 +253,12 @@ class MonteCarloAgent(Agent):
 
     def default_policy(self, u: Node):
         if u.non_terminal():
-            new_state = pickle.loads(pickle.dumps(u.state, pickle.HIGHEST_PROTOCOL))
+            env = u.env
+            env.set_state(u.state, rng=False)
             depth = 0
-            while not new_state.game_over and depth < MCTS_DEPTH:
-                self.random_play(new_state)
+            while not env.game_over and depth < MCTS_DEPTH:
+                self.random_play(env)
                 depth += 1
+            return env.players[u.player_id].score
 
-        else:
-            new_state = u.state
-
-        my_id = 0  # todo fix this
-
-        return new_state.players[my_id].score
+        return u.score
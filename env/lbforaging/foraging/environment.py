@@ -7,6 +7,8 @@ import gym
 from gym.utils import seeding
 import numpy as np
 
+from env import snapshot
+
 
 class Action(Enum):
     NONE = 0
@@ -161,6 +163,83 @@ class ForagingEnv(Env):
     def game_over(self):
         return self._game_over
 
+    @property
+    def state_dtype(self):
+        """
+        The layout of the `get_state` snapshots, fixed by the field size and
+        the number of players.
+        """
+        key = (self.field.shape, len(self.players))
+        if getattr(self, "_state_dtype_key", None) != key:
+            n_players = len(self.players)
+            self._state_dtype = np.dtype(
+                [
+                    ("field", np.int32, self.field.shape),
+                    ("position", np.int64, (n_players, 2)),
+                    ("level", np.int64, (n_players,)),
+                    ("score", np.float64, (n_players,)),
+                    ("reward", np.float64, (n_players,)),
+                    ("current_step", np.int64),
+                    ("game_over", np.bool_),
+                    ("food_spawned", np.float64),
+                ]
+                + snapshot.RNG_STATE_FIELDS
+            )
+            self._state_dtype_key = key
+        return self._state_dtype
+
+    def get_state(self, out=None, rng=True):
+        """
+        Snapshot of the simulator state (the field, the players, the step
+        count and the random state) as a 0-d structured array, to be
+        restored with `set_state`. The histories of the player controllers
+        are not part of it.
+
+        :param out: a snapshot to write to rather than allocating one
+        :param rng: also save the random state, which is most of the cost of a
+        snapshot, steps don't draw from it
+        """
+        if out is None:
+            out = np.zeros((), dtype=self.state_dtype)
+        out["field"] = self.field
+        out["position"] = [(-1, -1) if p.position is None else p.position for p in self.players]
+        out["level"] = [p.level or 0 for p in self.players]
+        out["score"] = [p.score or 0 for p in self.players]
+        out["reward"] = [p.reward for p in self.players]
+        out["current_step"] = getattr(self, "current_step", 0) or 0
+        out["game_over"] = bool(self._game_over)
+        out["food_spawned"] = self._food_spawned
+        if rng:
+            snapshot.get_rng_state(self.np_random, out)
+        return out
+
+    def set_state(self, state, rng=True):
+        """
+        Restores a `get_state` snapshot in place.
+
+        :param rng: also restore the random state
+        """
+        self.field[...] = state["field"]
+        for p, position, level, score, reward in zip(
+            self.players, state["position"].tolist(), state["level"].tolist(), state["score"], state["reward"]
+        ):
+            p.position = None if position[0] < 0 else tuple(position)
+            p.level = level
+            p.score = float(score)
+            p.reward = float(reward)
+        self.current_step = int(state["current_step"])
+        self._game_over = bool(state["game_over"])
+        self._food_spawned = float(state["food_spawned"])
+        if rng:
+            snapshot.set_rng_state(self.np_random, state)
+        self._gen_valid_moves()
+
+    def fork(self, k):
+        """
+        `[K]` copies of the current state, for batched lookahead.
+        """
+        return snapshot.fork(self.get_state(), k)
+
     def _gen_valid_moves(self):
         self._valid_actions = {
             player: [action for action in Action if self._is_valid_action(player, action)] for player in self.players
@@ -10,98 +10,145 @@ import numpy as np
 from typing import List, Tuple, Optional, Dict
 
 
-class PrisonSimple(gym.Env):
-    def __init__(self, n_agents=8, max_cycle=500):
+class VecPrisonSimple(object):
+    """
+    `n_envs` independent `PrisonSimple` instances stepped together, with the
+    state of every agent held in `[n_envs, n_agents]` arrays.
+
+    The observations of all of the agents are drawn in one batch and
+    accumulated with `np.bincount` rather than a loop over the blob samples,
+    and the rewards are masked array arithmetic. The observations and rewards
+    have the same distribution as the per agent implementation (the random
+    draws are made in a different order).
+    """
+
+    def __init__(self, n_envs=1, n_agents=8, max_cycle=500):
+        self.n_envs = n_envs
         self.n_agents = n_agents
-        self.agents = list(range(n_agents))
-        self.possible_agents = self.agents
-        self.agent_info = []
         self.n_sample = 30
         self.min_val = 0
         self.max_val = 30
+        self.obs_size = self.max_val + 2
         self.max_cycle = max_cycle
         self.num_steps = 0
+        self.loc = np.zeros((n_envs, n_agents))
+        self.left = np.zeros((n_envs, n_agents), dtype=bool)
+        self.right = np.zeros((n_envs, n_agents), dtype=bool)
+        self.first_touch = np.ones((n_envs, n_agents), dtype=bool)
+        # offset of the observation of every agent in the flattened observations
+        self._obs_offset = (np.arange(n_envs * n_agents) * self.obs_size).reshape(n_envs, n_agents, 1)
         self.reset()
 
-    def generate_agent(self):
-        return {"loc": np.random.uniform(10, 20, 1), "left": False, "right": False, "first_touch": True}
+    def generate_agents(self, mask=None):
+        """
+        (Re)starts the agents in `mask` (all of them if None).
+        """
+        if mask is None:
+            mask = np.ones((self.n_envs, self.n_agents), dtype=bool)
+        self.loc[mask] = np.random.uniform(10, 20, int(mask.sum()))
+        self.left[mask] = False
+        self.right[mask] = False
+        self.first_touch[mask] = True
 
     def reset(self):
-        self.agent_info = {ag: self.generate_agent() for ag in self.agents}
-        obs = self.gen_obs()
+        self.generate_agents()
         self.num_steps = 0
-        return obs
+        return self.gen_obs()
 
-    def gen_agent_obs(self, info):
-        obs = np.zeros(self.max_val + 2)
+    def gen_obs(self):
+        """
+        :return: `[n_envs, n_agents, max_val + 2]` observations
+        """
+        shape = (self.n_envs, self.n_agents)
         max_obs_index = self.max_val - 1  # off by one index
-        if info["left"]:
-            obs[-2] += np.abs(np.random.normal(5, 2))
-        if info["right"]:
-            obs[-1] += np.abs(np.random.normal(5, 2))
-        blob = np.random.normal(info["loc"], 2, self.n_sample).astype(int)
-        for v in blob:
-            indx = min(max(v, 0), max_obs_index)
-            obs[indx] += np.abs(np.random.normal())
+        blob = np.random.normal(self.loc[..., None], 2, shape + (self.n_sample,)).astype(int)
+        index = np.clip(blob, 0, max_obs_index) + self._obs_offset
+        weights = np.abs(np.random.normal(size=index.shape))
+        obs = np.bincount(index.ravel(), weights.ravel(), minlength=self.n_envs * self.n_agents * self.obs_size)
+        obs = obs.reshape(shape + (self.obs_size,))
+        walls = np.abs(np.random.normal(5, 2, shape + (2,)))
+        obs[..., -2:] += walls * np.stack([self.left, self.right], -1)
         return obs
 
-    def gen_obs(self):
-        return {ag: self.gen_agent_obs(self.agent_info[ag]) for ag in self.agents}
-
     def gen_rewards(self):
-        agent_info = {}
-        agent_reward = {}
-        reward = 0
-        for ag in self.agents:
-            # print(self.agent_info[ag])
-            # calculate penalty...
-            penalty = 0
-            reward = 0
-            if self.agent_info[ag]["left"] and not self.agent_info[ag]["right"]:
-                # penalty is distance to right
-                penalty = (self.max_val - self.agent_info[ag]['loc'])/self.max_val
-            elif self.agent_info[ag]["right"] and not self.agent_info[ag]["left"]:
-                penalty = self.agent_info[ag]['loc']/self.max_val
-            else:
-                penalty = max((self.max_val - self.agent_info[ag]['loc'])/self.max_val, self.agent_info[ag]['loc']/self.max_val)
-            
-            if self.agent_info[ag]["left"] and self.agent_info[ag]["right"]:
-                reward = 2
-                agent_info[ag] = self.generate_agent()
-            elif (self.agent_info[ag]["left"] or self.agent_info[ag]["right"]) and self.agent_info[ag]["first_touch"]:
-                reward = 1 - penalty
-                agent_info[ag] = self.agent_info[ag]
-                agent_info[ag]["first_touch"] = False  # only triggers once
-            else:
-                reward = -penalty
-                agent_info[ag] = self.agent_info[ag]
-            agent_reward[ag] = reward
-        self.agent_info = agent_info
-        return agent_reward
+        """
+        :return: `[n_envs, n_agents]` rewards, this also restarts the agents
+        which touched both walls
+        """
+        loc = self.loc / self.max_val
+        penalty = np.where(
+            self.left & ~self.right, 1 - loc, np.where(self.right & ~self.left, loc, np.maximum(1 - loc, loc))
+        )
+        both = self.left & self.right
+        first_touch = (self.left | self.right) & self.first_touch & ~both
+        reward = np.where(both, 2.0, np.where(first_touch, 1 - penalty, -penalty))
+        # only triggers once
+        self.first_touch[first_touch] = False
+        if both.any():
+            self.generate_agents(both)
+        return reward
 
-    def step(self, action):
-        # 0, nothing, 1, left, 2, right
-        for ag in action.keys():
-            act = action[ag]
-            if act == 1:
-                self.agent_info[ag]["loc"] -= np.abs(np.random.normal(5, 2))
-            if act == 2:
-                self.agent_info[ag]["loc"] += np.abs(np.random.normal(5, 2))
-            self.agent_info[ag]["loc"] = min(max(self.agent_info[ag]["loc"], 0), self.max_val)
-            if self.agent_info[ag]["loc"] < 2:
-                self.agent_info[ag]["left"] = True
-            if self.agent_info[ag]["loc"] > self.max_val - 2:
-                self.agent_info[ag]["right"] = True
+    def step(self, actions):
+        """
+        :param actions: `[n_envs, n_agents]` actions, 0 nothing, 1 left, 2 right
+        :return: `(obs, rewards, done, info)`, `done` is shared by all of the instances
+        """
+        actions = np.asarray(actions)
+        move = np.abs(np.random.normal(5, 2, self.loc.shape))
+        self.loc += np.where(actions == 1, -move, np.where(actions == 2, move, 0.0))
+        np.clip(self.loc, 0, self.max_val, out=self.loc)
+        self.left |= self.loc < 2
+        self.right |= self.loc > self.max_val - 2
 
         # calculate reward
-        reward = self.gen_rewards()  # this also resets successful agents (overloaded - to do refactor)...
+        reward = self.gen_rewards()  # this also resets successful agents
         obs = self.gen_obs()
         self.num_steps += 1
-        if self.num_steps == self.max_cycle:
-            done = {"__all__": 1}
-        else:
-            done = {"__all__": 0}
-        return obs, reward, done, {}
+        return obs, reward, self.num_steps == self.max_cycle, {}
+
+
+class PrisonSimple(gym.Env):
+    def __init__(self, n_agents=8, max_cycle=500):
+        self.n_agents = n_agents
+        self.agents = list(range(n_agents))
+        self.possible_agents = self.agents
+        self.n_sample = 30
+        self.min_val = 0
+        self.max_val = 30
+        self.max_cycle = max_cycle
+        self.env = VecPrisonSimple(n_envs=1, n_agents=n_agents, max_cycle=max_cycle)
+
+    @property
+    def num_steps(self):
+        return self.env.num_steps
+
+    @property
+    def agent_info(self):
+        return {
+            ag: {
+                "loc": self.env.loc[0, ag : ag + 1].copy(),
+                "left": bool(self.env.left[0, ag]),
+                "right": bool(self.env.right[0, ag]),
+                "first_touch": bool(self.env.first_touch[0, ag]),
+            }
+            for ag in self.agents
+        }
+
+    def reset(self):
+        obs = self.env.reset()
+        return {ag: obs[0, ag] for ag in self.agents}
+
+    def step(self, action):
+        # 0, nothing, 1, left, 2, right
+        # agents without an action do nothing
+        actions = np.zeros((1, self.n_agents), dtype=int)
+        for ag, act in action.items():
+            actions[0, ag] = act
+        obs, reward, done, info = self.env.step(actions)
+        obs = {ag: obs[0, ag] for ag in self.agents}
+        reward = {ag: reward[0, ag] for ag in self.agents}
+        done = {"__all__": int(done)}
+        return obs, reward, done, info
 
 
 """
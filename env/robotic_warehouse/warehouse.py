@@ -4,6 +4,7 @@ from collections import defaultdict, OrderedDict
 import gym
 from gym import spaces
 
+from env import snapshot
 from env.robotic_warehouse.utils import MultiAgentActionSpace, MultiAgentObservationSpace
 
 from enum import Enum
@@ -465,6 +466,111 @@ class Warehouse(gym.Env):
         #     self.grid[0, s.y, s.x] = 1
         # print(self.grid[0])
 
+    @property
+    def state_dtype(self):
+        """
+        The layout of the `get_state` snapshots, fixed by the size of the
+        warehouse, the number of agents and the request queue size.
+        """
+        key = (self.grid.shape, self.n_agents, len(self.shelfs), self.request_queue_size, self.msg_bits)
+        if getattr(self, "_state_dtype_key", None) != key:
+            n_shelfs = len(self.shelfs)
+            self._state_dtype = np.dtype(
+                [
+                    ("grid", np.int32, self.grid.shape),
+                    ("agent_xy", np.int64, (self.n_agents, 4)),
+                    ("agent_dir", np.int64, (self.n_agents,)),
+                    ("agent_req_action", np.int64, (self.n_agents,)),
+                    ("agent_carrying", np.int64, (self.n_agents,)),
+                    ("agent_delivered", np.bool_, (self.n_agents,)),
+                    ("agent_message", np.float64, (self.n_agents, self.msg_bits)),
+                    ("shelf_xy", np.int64, (n_shelfs, 4)),
+                    ("request_queue", np.int64, (self.request_queue_size,)),
+                    ("cur_steps", np.int64),
+                    ("cur_inactive_steps", np.int64),
+                ]
+                + snapshot.RNG_STATE_FIELDS
+            )
+            self._state_dtype_key = key
+        return self._state_dtype
+
+    @staticmethod
+    def _entity_xy(entities):
+        # x, y, prev_x, prev_y with -1 for no previous location
+        return [
+            (e.x, e.y, -1 if e.prev_x is None else e.prev_x, -1 if e.prev_y is None else e.prev_y) for e in entities
+        ]
+
+    @staticmethod
+    def _set_entity_xy(entities, xy):
+        for e, (x, y, prev_x, prev_y) in zip(entities, xy):
+            e.x, e.y = x, y
+            e.prev_x = None if prev_x < 0 else prev_x
+            e.prev_y = None if prev_y < 0 else prev_y
+
+    def get_state(self, out=None, rng=True):
+        """
+        Snapshot of the simulator state after `reset` (the grid, the agents,
+        the shelfs, the request queue, the step counters and the global numpy
+        random state, which the warehouse draws from) as a 0-d structured
+        array, to be restored with `set_state`.
+
+        :param out: a snapshot to write to rather than allocating one
+        :param rng: also save the random state, which is most of the cost of a
+        snapshot, steps only draw from it when a shelf is delivered
+        """
+        if out is None:
+            out = np.zeros((), dtype=self.state_dtype)
+        out["grid"] = self.grid
+        out["agent_xy"] = self._entity_xy(self.agents)
+        out["agent_dir"] = [a.dir.value for a in self.agents]
+        out["agent_req_action"] = [-1 if a.req_action is None else Action(a.req_action).value for a in self.agents]
+        out["agent_carrying"] = [a.carrying_shelf.id if a.carrying_shelf else 0 for a in self.agents]
+        out["agent_delivered"] = [a.has_delivered for a in self.agents]
+        if self.msg_bits > 0:
+            out["agent_message"] = [a.message for a in self.agents]
+        out["shelf_xy"] = self._entity_xy(self.shelfs)
+        out["request_queue"] = [shelf.id for shelf in self.request_queue]
+        out["cur_steps"] = self._cur_steps
+        out["cur_inactive_steps"] = self._cur_inactive_steps
+        if rng:
+            snapshot.get_rng_state(np.random, out)
+        return out
+
+    def set_state(self, state, rng=True):
+        """
+        Restores a `get_state` snapshot in place.
+
+        :param rng: also restore the global numpy random state
+        """
+        self.grid[...] = state["grid"]
+        self._set_entity_xy(self.agents, state["agent_xy"].tolist())
+        self._set_entity_xy(self.shelfs, state["shelf_xy"].tolist())
+        for agent, dir_, req_action, carrying, delivered, message in zip(
+            self.agents,
+            state["agent_dir"].tolist(),
+            state["agent_req_action"].tolist(),
+            state["agent_carrying"].tolist(),
+            state["agent_delivered"].tolist(),
+            state["agent_message"],
+        ):
+            agent.dir = Direction(dir_)
+            agent.req_action = None if req_action < 0 else Action(req_action)
+            agent.carrying_shelf = self.shelfs[carrying - 1] if carrying else None
+            agent.has_delivered = delivered
+            agent.message[:] = message
+        self.request_queue = [self.shelfs[id_ - 1] for id_ in state["request_queue"].tolist()]
+        self._cur_steps = int(state["cur_steps"])
+        self._cur_inactive_steps = int(state["cur_inactive_steps"])
+        if rng:
+            snapshot.set_rng_state(np.random, state)
+
+    def fork(self, k):
+        """
+        `[K]` copies of the current state, for batched lookahead.
+        """
+        return snapshot.fork(self.get_state(), k)
+
     def step(self, actions: List[Action]) -> Tuple[List[np.ndarray], List[float], List[bool], Dict]:
         assert len(actions) == len(self.agents)
 
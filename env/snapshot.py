@@ -0,0 +1,47 @@
+"""
+Helpers for the fixed layout state snapshots of the simulators
+(`ForagingEnv.get_state`, `Warehouse.get_state`).
+
+A snapshot is a 0-d numpy structured array, so that copying it, storing it
+or restoring it is a single flat copy, and `fork` gives a `[K]` array of
+copies for batched lookahead.
+"""
+
+import numpy as np
+
+# the MT19937 state of a `np.random.RandomState` (or of `np.random` itself)
+RNG_STATE_FIELDS = [
+    ("rng_key", np.uint32, (624,)),
+    ("rng_pos", np.int64),
+    ("rng_has_gauss", np.int64),
+    ("rng_cached_gaussian", np.float64),
+]
+
+
+def get_rng_state(rng, out):
+    _, key, pos, has_gauss, cached_gaussian = rng.get_state()
+    out["rng_key"] = key
+    out["rng_pos"] = pos
+    out["rng_has_gauss"] = has_gauss
+    out["rng_cached_gaussian"] = cached_gaussian
+    return out
+
+
+def set_rng_state(rng, state):
+    rng.set_state(
+        (
+            "MT19937",
+            state["rng_key"],
+            int(state["rng_pos"]),
+            int(state["rng_has_gauss"]),
+            float(state["rng_cached_gaussian"]),
+        )
+    )
+
+
+def fork(state, k):
+    """
+    `[K]` copies of the snapshot `state`, e.g. the roots of `k` parallel
+    rollouts which are restored with `env.set_state(states[i])`.
+    """
+    return np.repeat(np.asarray(state).reshape(1), k)
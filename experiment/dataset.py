@@ -0,0 +1,309 @@
+"""
+Behaviour dataset generation for offline MARL.
+
+Runs a mixture of behaviour policies on an env across a process pool and
+streams the episodes to an on-disk episode store (see
+`marlkit.data_management.episode_store`), one shard per job:
+
+```
+python -m experiment.dataset --env forage --mixture "H1*2,H3@0.1,random" --episodes 100000 --out data/forage_mixed
+```
+
+The mixture is a comma separated list of `policy[@epsilon][*weight]`. Every
+episode is played by one of the policies, drawn by weight, whose actions are
+replaced by uniform random actions with probability epsilon (`--epsilon` by
+default), so that mixed quality datasets are a single run. The policy and
+epsilon of every episode are recorded in the shard metadata. Policies:
+
+*  `random`: uniform random actions, any env
+*  `snapshot:<params.pkl>`: a policy saved by `logger.save_itr_params`, any env
+*  `H1`-`H4`, `random_agent`, or any `module:Class` lbforaging agent, for
+   `forage`. `+` assigns them per agent (cycled), e.g. `H1+H4`
+*  `monte_carlo`: UCT search on the simulator state, for `forage`
+*  `prison_heuristic`: walk to the wall which hasn't been touched yet, for `prison_simple`
+
+The envs are `forage`, `rware` and `prison_simple` (built directly), or any
+other `ENV_LOOKUP` entry.
+"""
+import sys
+import os
+
+# the repo root goes first, `experiment/env.py` would shadow the `env` package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import importlib
+import itertools
+import multiprocessing
+import random
+import time
+
+import numpy as np
+import torch
+
+from marlkit.data_management.episode_store import EpisodeShardWriter
+from marlkit.envs.wrappers import MultiAgentEnv
+from marlkit.samplers.rollout_functions import marl_rollout
+
+FORAGING_AGENTS = dict(
+    H1="env.lbforaging.agents.heuristic_agent:H1",
+    H2="env.lbforaging.agents.heuristic_agent:H2",
+    H3="env.lbforaging.agents.heuristic_agent:H3",
+    H4="env.lbforaging.agents.heuristic_agent:H4",
+    random_agent="env.lbforaging.agents.random_agent:RandomAgent",
+)
+
+
+def make_env(name):
+    if name == "forage":
+        from env import forage
+
+        return MultiAgentEnv(forage.ForageEnv(forage.base_config))
+    if name == "rware":
+        from env import rware
+
+        return MultiAgentEnv(rware.RwareEnv(rware.base_config))
+    if name == "prison_simple":
+        from env import prison
+
+        return MultiAgentEnv(prison.PrisonEnv())
+    from experiment.env import ENV_LOOKUP
+
+    return ENV_LOOKUP[name]
+
+
+def simulator(env):
+    """
+    The simulator under the `MultiAgentEnv` of a custom env, e.g. the
+    `ForagingEnv` of `forage`.
+    """
+    return env._wrapped_env.env
+
+
+def _load_class(path):
+    module, name = path.split(":")
+    return getattr(importlib.import_module(module), name)
+
+
+def _action_value(action):
+    # lbforaging agents act with `Action`s
+    return getattr(action, "value", action)
+
+
+class RandomPolicy(object):
+    def __init__(self, env):
+        self.env = env
+
+    def reset(self):
+        pass
+
+    def get_action(self, obs):
+        n_actions = self.env.multi_agent_action_space.n
+        return list(np.random.randint(n_actions, size=len(self.env.possible_agents))), {}
+
+
+class ForagingAgentPolicy(object):
+    """
+    lbforaging agents (`Agent` subclasses), cycled over the players, acting on
+    the lbforaging observations of the simulator.
+    """
+
+    def __init__(self, env, agent_classes):
+        self.env = env
+        self.agent_classes = agent_classes
+        self.agents = None
+
+    def reset(self):
+        players = simulator(self.env).players
+        self.agents = [cls(player) for cls, player in zip(itertools.cycle(self.agent_classes), players)]
+
+    def get_action(self, obs):
+        sim = simulator(self.env)
+        return [_action_value(agent._step(sim._make_obs(agent.player))) for agent in self.agents], {}
+
+
+class MonteCarloPolicy(object):
+    """
+    Joint action of a UCT search (`MonteCarloAgent`) from the simulator state,
+    which is restored after the search.
+    """
+
+    def __init__(self, env, timeout):
+        from env.lbforaging.agents.monte_carlo import MonteCarloAgent
+
+        self.env = env
+        self.timeout = timeout
+        self.agent_class = MonteCarloAgent
+        self.agent = None
+
+    def reset(self):
+        self.agent = self.agent_class(simulator(self.env).players[0])
+
+    def get_action(self, obs):
+        root = self.agent.uct_search(simulator(self.env), timeout=self.timeout)
+        return [_action_value(action) for action in root.most_visited_child().move], {}
+
+
+class PrisonHeuristicPolicy(object):
+    def __init__(self, env):
+        self.env = env
+
+    def reset(self):
+        pass
+
+    def get_action(self, obs):
+        # 1 left, 2 right, to the wall the agent hasn't touched yet
+        sim = simulator(self.env).env
+        return list(np.where(sim.left[0], 2, 1)), {}
+
+
+class SnapshotPolicy(object):
+    KEYS = ("evaluation/policy", "exploration/policy", "trainer/policy")
+
+    def __init__(self, env, path):
+        params = torch.load(path, map_location="cpu", weights_only=False)
+        keys = [key for key in self.KEYS if key in params]
+        if len(keys) == 0:
+            raise KeyError("no policy in {}, expected one of {}".format(path, self.KEYS))
+        self.policy = params[keys[0]]
+
+    def reset(self):
+        self.policy.reset()
+
+    def get_action(self, obs):
+        return self.policy.get_action(obs)
+
+
+class EpsilonNoise(object):
+    def __init__(self, policy, env, epsilon):
+        self.policy = policy
+        self.env = env
+        self.epsilon = epsilon
+
+    def reset(self):
+        self.policy.reset()
+
+    def get_action(self, obs):
+        actions, info = self.policy.get_action(obs)
+        if self.epsilon > 0:
+            actions = list(actions)
+            for idx in range(len(actions)):
+                if np.random.rand() < self.epsilon:
+                    actions[idx] = np.random.randint(self.env.multi_agent_action_space.n)
+        return actions, info
+
+
+def make_policy(env, name, epsilon=0.0, mcts_timeout=0.05):
+    if name == "random":
+        policy = RandomPolicy(env)
+    elif name.startswith("snapshot:"):
+        policy = SnapshotPolicy(env, name[len("snapshot:") :])
+    elif name == "monte_carlo":
+        policy = MonteCarloPolicy(env, mcts_timeout)
+    elif name == "prison_heuristic":
+        policy = PrisonHeuristicPolicy(env)
+    else:
+        policy = ForagingAgentPolicy(
+            env, [_load_class(FORAGING_AGENTS.get(agent, agent)) for agent in name.split("+")]
+        )
+    return EpsilonNoise(policy, env, epsilon)
+
+
+def parse_mixture(spec, epsilon=0.0):
+    """
+    `"H1*2,H3@0.1,random"` -> `[dict(policy="H1", epsilon=epsilon, weight=2.0), ...]`
+    """
+    mixture = []
+    for item in spec.split(","):
+        item, weight = item.rsplit("*", 1) if "*" in item else (item, 1.0)
+        name, eps = item.rsplit("@", 1) if "@" in item else (item, epsilon)
+        mixture.append(dict(policy=name.strip(), epsilon=float(eps), weight=float(weight)))
+    return mixture
+
+
+def generate_shard(job):
+    """
+    Plays `n_episodes` episodes into the shard `path`, in a worker process.
+    """
+    env_name, mixture, n_episodes, max_path_length, seed, path, mcts_timeout = job
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    env = make_env(env_name)
+    if env_name == "forage":
+        simulator(env).seed(seed)
+    policies = [make_policy(env, item["policy"], item["epsilon"], mcts_timeout) for item in mixture]
+    weights = np.array([item["weight"] for item in mixture], dtype=np.float64)
+    weights /= weights.sum()
+
+    start = time.time()
+    metadata = dict(env=env_name, seed=seed, mixture=mixture, max_path_length=max_path_length)
+    writer = EpisodeShardWriter(path, metadata)
+    for _ in range(n_episodes):
+        k = np.random.choice(len(policies), p=weights)
+        episode = marl_rollout(env, policies[k], max_path_length=max_path_length)
+        writer.write(episode, policy=mixture[k]["policy"], epsilon=mixture[k]["epsilon"])
+    metadata = writer.close()
+    return path, metadata["n_steps"], time.time() - start
+
+
+def generate_dataset(
+    env_name,
+    mixture,
+    n_episodes,
+    out_dir,
+    n_workers=None,
+    episodes_per_shard=100,
+    max_path_length=1000,
+    seed=0,
+    mcts_timeout=0.05,
+):
+    """
+    :param mixture: list of `dict(policy=..., epsilon=..., weight=...)`, see `parse_mixture`
+    :return: total number of steps written
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    jobs = []
+    for shard, first in enumerate(range(0, n_episodes, episodes_per_shard)):
+        path = os.path.join(out_dir, "shard_{}_{:05d}".format(seed, shard))
+        shard_episodes = min(episodes_per_shard, n_episodes - first)
+        jobs.append((env_name, mixture, shard_episodes, max_path_length, seed * 100003 + shard, path, mcts_timeout))
+
+    start = time.time()
+    total_steps = 0
+    n_workers = n_workers or os.cpu_count()
+    with multiprocessing.Pool(min(n_workers, len(jobs))) as pool:
+        for i, (path, n_steps, _) in enumerate(pool.imap_unordered(generate_shard, jobs)):
+            total_steps += n_steps
+            print(
+                "{}/{} shards, {} steps, {:.0f} steps/s".format(
+                    i + 1, len(jobs), total_steps, total_steps / (time.time() - start)
+                )
+            )
+    return total_steps
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="behaviour dataset generation")
+    parser.add_argument("--env", type=str, default="forage")
+    parser.add_argument("--mixture", type=str, default="H1")
+    parser.add_argument("--epsilon", type=float, default=0.0)
+    parser.add_argument("--episodes", type=int, default=1000)
+    parser.add_argument("--episodes_per_shard", type=int, default=100)
+    parser.add_argument("--max_path_length", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--mcts_timeout", type=float, default=0.05)
+    parser.add_argument("--out", type=str, required=True)
+    args = parser.parse_args()
+    generate_dataset(
+        args.env,
+        parse_mixture(args.mixture, args.epsilon),
+        args.episodes,
+        args.out,
+        n_workers=args.workers,
+        episodes_per_shard=args.episodes_per_shard,
+        max_path_length=args.max_path_length,
+        seed=args.seed,
+        mcts_timeout=args.mcts_timeout,
+    )
@@ -2,8 +2,6 @@
 import itertools
 import numpy as np
 from supersuit import (
-    resize_v0,
-    color_reduction_v0,
     flatten_v0,
     normalize_obs_v0,
     dtype_v0,
@@ -22,7 +20,7 @@ from pettingzoo.mpe import simple_spread_v2
 from pettingzoo.mpe import simple_reference_v2
 from pettingzoo.mpe import simple_tag_v2
 from pettingzoo.butterfly import cooperative_pong_v2
-from marlkit.envs.wrappers import MultiAgentEnv, MultiEnv
+from marlkit.envs.wrappers import MultiAgentEnv, MultiEnv, PixelObsWrapper
 
 # custom envs
 from env import rware
@@ -56,18 +54,8 @@ simple_no_norm_wrapper = lambda x: flatten_v0(
     )
 )
 
-grid_wrapper = lambda x: flatten_v0(
-    normalize_obs_v0(
-        dtype_v0(
-            pad_observations_v0(
-                pad_action_space_v0(
-                    resize_v0(color_reduction_v0(x), resize_size, resize_size),
-                )
-            ),
-            np.float32,
-        )
-    )
-)
+# gray, resize, pad, normalize and flatten in one pass (see PixelObsWrapper)
+grid_wrapper = lambda x: PixelObsWrapper(pad_action_space_v0(x), resize_size)
 
 
 def waterworld_act(x, n=None):
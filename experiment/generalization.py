@@ -0,0 +1,213 @@
+"""
+Cross-size generalization evaluation of trained snapshots.
+
+Loads snapshots saved by `logger.save_itr_params` (`params.pkl`,
+`itr_<n>.pkl`), rebuilds the evaluation policy of the runner from the
+trainer networks and evaluates it on a list of envs (`ENV_LOOKUP` names,
+or the custom `forage`, `rware`, `prison_simple`), one process per env, so
+that a single train-small run is tested on every size without retraining:
+
+```
+python -m experiment.generalization --checkpoints data/pursuit_small-pursuit_small-qmix/params.pkl \
+    --targets pursuit_small,pursuit_medium,pursuit_large --steps 2500
+```
+
+The loaded weights are moved to shared memory once and shared by the
+worker processes, so they aren't copied per target. Inference is not
+batched across the targets though: every worker builds its own policy on
+the shared weights and evaluates it on its env step by step, as the
+runners do. Every checkpoint gives one results table (one row per
+target env), printed and written next to the checkpoint as
+`<checkpoint>.generalization.csv` (or to `--out`).
+
+With `--ci_width` every target is evaluated until the confidence interval
+of its mean return is that narrow (within `--min_paths`/`--max_paths`),
+on common random numbers (the episodes are seeded from `--seed`), so that
+the checkpoints are compared on the same episodes.
+
+The evaluation policy (`--eval_policy`) is, as in the runners,
+
+*  `argmax_qf`: `MAArgmaxDiscretePolicy(trainer/qf)` (IQL, VDN, QMIX, ...)
+*  `qf`: `trainer/qf` acting itself (the quantile runners)
+*  `deterministic`: `MakeDeterministic(trainer/policy)` (IAC, SEAC, central V)
+*  `discretify`: `Discretify(trainer/policy)` (MADDPG, IPG)
+*  `argmax_policy`: `MAArgmaxDiscretePolicy(trainer/policy)` (LICA)
+*  `auto`: guessed from the snapshot keys and the policy
+"""
+import sys
+import os
+
+# the repo root goes first, `experiment/env.py` would shadow the `env` package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import csv
+import inspect
+import random
+import time
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from marlkit.core.tabulate import tabulate
+from marlkit.policies.argmax import Discretify, MAArgmaxDiscretePolicy
+from marlkit.samplers.data_collector.marl_path_collector import MdpPathCollector
+from marlkit.torch.sac.policies import MakeDeterministic
+
+EVAL_POLICIES = ("auto", "argmax_qf", "qf", "deterministic", "discretify", "argmax_policy")
+
+# the columns of the results tables
+COLUMNS = (
+    "Returns Mean",
+    "Returns Std",
+    "Average Returns",
+    "path length Mean",
+    "Num Paths",
+)
+
+
+def _guess_eval_policy(params):
+    if "trainer/policy" not in params:
+        return "qf" if hasattr(params["trainer/qf"], "get_action") else "argmax_qf"
+    policy = params["trainer/policy"]
+    if "deterministic" in inspect.signature(policy.get_action).parameters:
+        return "deterministic"
+    if type(policy).__name__.startswith("Tanh"):
+        return "discretify"
+    return "argmax_policy"
+
+
+def load_eval_policy(path, eval_policy="auto", compile_inference=False):
+    """
+    Rebuilds the evaluation policy of a `logger.save_itr_params` snapshot.
+    """
+    params = torch.load(path, map_location="cpu", weights_only=False)
+    if eval_policy == "auto":
+        eval_policy = _guess_eval_policy(params)
+    if eval_policy not in EVAL_POLICIES:
+        raise ValueError("unknown eval policy {}, expected one of {}".format(eval_policy, EVAL_POLICIES))
+    key = "trainer/qf" if eval_policy in ("argmax_qf", "qf") else "trainer/policy"
+    if key not in params:
+        raise KeyError("{} has no {} for the {} eval policy".format(path, key, eval_policy))
+    network = params[key]
+    if eval_policy == "argmax_qf" or eval_policy == "argmax_policy":
+        policy = MAArgmaxDiscretePolicy(network, compile_inference=compile_inference)
+    elif eval_policy == "deterministic":
+        policy = MakeDeterministic(network)
+    elif eval_policy == "discretify":
+        policy = Discretify(network, hard=True, compile_inference=compile_inference)
+    else:
+        policy = network
+    policy.eval()
+    return policy, eval_policy
+
+
+def evaluate_target(job):
+    """
+    Evaluates the (shared) policy on one target env, in a worker process.
+    """
+    target, policy, max_path_length, num_steps, seed, adaptive_eval_kwargs = job
+    from experiment.dataset import make_env
+
+    torch.set_num_threads(1)
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    env = make_env(target)
+    start = time.time()
+    collector = MdpPathCollector(env, policy)
+    # most of the pettingzoo envs don't terminate cleanly when the agents die
+    discard_incomplete_paths = target not in ["kaz"]
+    with torch.no_grad():
+        if adaptive_eval_kwargs is None:
+            collector.collect_new_paths(max_path_length, num_steps, discard_incomplete_paths=discard_incomplete_paths)
+        else:
+            collector.collect_adaptive_paths(
+                max_path_length, discard_incomplete_paths=discard_incomplete_paths, seed=seed, **adaptive_eval_kwargs
+            )
+    row = OrderedDict(target=target, n_agents=getattr(env, "max_num_agents", None))
+    statistics = collector.get_diagnostics()
+    statistics.update(collector.get_epoch_statistics().get_statistics())
+    for column in COLUMNS:
+        row[column] = statistics.get(column)
+    if adaptive_eval_kwargs is not None:
+        row["Returns CI width"] = statistics["adaptive return CI width"]
+    row["time (s)"] = time.time() - start
+    return row
+
+
+def evaluate_checkpoint(
+    path,
+    targets,
+    pool,
+    eval_policy="auto",
+    max_path_length=500,
+    num_steps=2500,
+    seed=0,
+    adaptive_eval_kwargs=None,
+):
+    """
+    :param adaptive_eval_kwargs: evaluate with `MdpPathCollector.collect_adaptive_paths`
+    (e.g. `dict(ci_width=1.0, max_num_paths=100)`) instead of for `num_steps`
+    :return: the results table, a list of rows (one per target)
+    """
+    policy, eval_policy = load_eval_policy(path, eval_policy)
+    # the workers map the weights rather than copying them
+    policy.share_memory()
+    jobs = [(target, policy, max_path_length, num_steps, seed, adaptive_eval_kwargs) for target in targets]
+    rows = list(pool.imap(evaluate_target, jobs))
+    for row in rows:
+        row["checkpoint"] = path
+        row["eval policy"] = eval_policy
+    return rows
+
+
+def write_table(rows, out):
+    with open(out, "w") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="cross-size generalization evaluation")
+    parser.add_argument("--checkpoints", type=str, nargs="+", required=True)
+    parser.add_argument("--targets", type=str, required=True, help="comma separated env names")
+    parser.add_argument("--eval_policy", type=str, default="auto", choices=EVAL_POLICIES)
+    parser.add_argument("--max_path_length", type=int, default=500)
+    parser.add_argument("--steps", type=int, default=2500, help="evaluation steps per target")
+    parser.add_argument("--ci_width", type=float, default=None, help="adaptive evaluation, target return CI width")
+    parser.add_argument("--min_paths", type=int, default=5)
+    parser.add_argument("--max_paths", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", type=str, default=None, help="csv of the results of every checkpoint")
+    args = parser.parse_args()
+
+    targets = args.targets.split(",")
+    adaptive_eval_kwargs = None
+    if args.ci_width is not None:
+        adaptive_eval_kwargs = dict(ci_width=args.ci_width, min_num_paths=args.min_paths, max_num_paths=args.max_paths)
+    all_rows = []
+    with mp.get_context("spawn").Pool(min(args.workers or os.cpu_count(), len(targets))) as pool:
+        for path in args.checkpoints:
+            rows = evaluate_checkpoint(
+                path,
+                targets,
+                pool,
+                eval_policy=args.eval_policy,
+                max_path_length=args.max_path_length,
+                num_steps=args.steps,
+                seed=args.seed,
+                adaptive_eval_kwargs=adaptive_eval_kwargs,
+            )
+            headers = [key for key in rows[0] if key != "checkpoint"]
+            print(path)
+            print(tabulate([[row[key] for key in headers] for row in rows], headers=headers))
+            if args.out is None:
+                write_table(rows, path + ".generalization.csv")
+            all_rows.extend(rows)
+    if args.out is not None:
+        write_table(all_rows, args.out)
@@ -106,6 +106,7 @@ def experiment(variant, train="pursuit", test="pursuit"):
     replay_buffer = FullMAEnvReplayBuffer(
         variant["replay_buffer_size"],
         expl_env,
+        **variant["replay_buffer_kwargs"],
     )
     algorithm = TorchBatchMARLAlgorithm(
         trainer=trainer,
@@ -135,6 +136,8 @@ def run(train, test):
         layer_size=base_agent_size,
         layer_mixer_size=mixer_size,
         replay_buffer_size=buffer_size,
+        # e.g. dict(max_replay_buffer_bytes=8 * 1024 ** 3, spill_dir="/tmp") for pixel envs
+        replay_buffer_kwargs=dict(),
         algorithm_kwargs=dict(
             num_epochs=num_epochs,
             num_eval_steps_per_epoch=max_path_length * 5,
@@ -0,0 +1,256 @@
+"""
+Evaluation of policy snapshots in a background process.
+
+`BatchMARLAlgorithm` evaluates synchronously every 5 epochs, and training
+stops while the evaluation paths are collected. With an `AsyncEvaluator`
+the algorithm only submits a snapshot of the evaluation policy's weights,
+and a worker process collects the evaluation paths on its own copies of
+the eval envs while training continues:
+
+    evaluator = AsyncEvaluator(
+        eval_policy,
+        env_fns=dict(pursuit=functools.partial(make_env, "pursuit")),
+        max_path_length=variant["algorithm_kwargs"]["max_path_length"],
+        num_eval_steps=variant["algorithm_kwargs"]["num_eval_steps_per_epoch"],
+    )
+    algorithm = TorchBatchMARLAlgorithm(..., async_evaluator=evaluator)
+
+The results are tagged with the epoch of their snapshot and written, as
+they arrive, to their own csv (`eval_progress.csv` in the snapshot
+directory by default) with an "Epoch" column, rather than to the row of
+whichever epoch is being logged when they arrive.
+
+At most `max_queue_size` snapshots wait for the worker. Submitting to a
+full queue drops the oldest waiting snapshot, so that `submit` never blocks
+training and the worker always evaluates the most recent weights.
+"""
+
+import csv
+import io
+import os.path as osp
+import queue
+import traceback
+from collections import OrderedDict
+
+import torch
+import torch.multiprocessing as mp
+
+from marlkit.core import logger
+
+
+def _load_policy(policy_bytes):
+    return torch.load(io.BytesIO(policy_bytes), map_location="cpu", weights_only=False)
+
+
+def _evaluation_worker(
+    policy_bytes,
+    env_fns,
+    max_path_length,
+    num_eval_steps,
+    discard_incomplete_paths,
+    snapshot_queue,
+    result_queue,
+):
+    # imported here, the worker is a spawned process
+    from marlkit.samplers.data_collector.marl_path_collector import MdpPathCollector
+
+    try:
+        torch.set_num_threads(1)
+        policy = _load_policy(policy_bytes)
+        envs = OrderedDict((name, env_fn()) for name, env_fn in env_fns.items())
+        while True:
+            snapshot = snapshot_queue.get()
+            if snapshot is None:
+                break
+            epoch, state_dict = snapshot
+            policy.load_state_dict(state_dict)
+            statistics = OrderedDict()
+            for name, env in envs.items():
+                collector = MdpPathCollector(env, policy)
+                collector.collect_new_paths(
+                    max_path_length,
+                    num_eval_steps,
+                    discard_incomplete_paths=discard_incomplete_paths,
+                )
+                prefix = "" if len(envs) == 1 else name + "/"
+                for k, v in collector.get_diagnostics().items():
+                    statistics[prefix + k] = v
+                for k, v in collector.get_epoch_statistics().get_statistics().items():
+                    statistics[prefix + k] = v
+            result_queue.put((epoch, statistics))
+    except Exception:
+        result_queue.put((None, traceback.format_exc()))
+
+
+class AsyncEvaluator(object):
+    def __init__(
+        self,
+        policy,
+        env_fns,
+        max_path_length,
+        num_eval_steps,
+        discard_incomplete_paths=True,
+        max_queue_size=1,
+        log_file="eval_progress.csv",
+    ):
+        """
+        :param policy: the evaluation policy (an `nn.Module`), its weights are
+        snapshot on every `submit`
+        :param env_fns: dict of eval env name to a picklable function
+        building the env in the worker, e.g. a `functools.partial`. The
+        statistics are prefixed with the env name if there are several
+        :param num_eval_steps: evaluation steps per env and snapshot
+        :param max_queue_size: number of snapshots which may wait for the worker
+        :param log_file: csv the results are written to, relative to the
+        snapshot directory, or None to only return them from `poll`
+        """
+        if not isinstance(env_fns, dict):
+            env_fns = OrderedDict(("env_{}".format(idx), env_fn) for idx, env_fn in enumerate(env_fns))
+        self.policy = policy
+        self.env_fns = env_fns
+        self.max_path_length = max_path_length
+        self.num_eval_steps = num_eval_steps
+        self.discard_incomplete_paths = discard_incomplete_paths
+        self.max_queue_size = max_queue_size
+        self.log_file = log_file
+
+        self.num_submitted = 0
+        self.num_dropped = 0
+        self.num_finished = 0
+        self._process = None
+        self._snapshot_queue = None
+        self._result_queue = None
+        self._csv_file = None
+        self._csv_writer = None
+
+    def start(self):
+        if self._process is not None:
+            return
+        ctx = mp.get_context("spawn")
+        # a cpu copy of the policy, the worker only receives the weights afterwards
+        policy_bytes = io.BytesIO()
+        torch.save(self.policy, policy_bytes)
+        self._snapshot_queue = ctx.Queue(maxsize=self.max_queue_size)
+        self._result_queue = ctx.Queue()
+        self._process = ctx.Process(
+            target=_evaluation_worker,
+            args=(
+                policy_bytes.getvalue(),
+                self.env_fns,
+                self.max_path_length,
+                self.num_eval_steps,
+                self.discard_incomplete_paths,
+                self._snapshot_queue,
+                self._result_queue,
+            ),
+            daemon=True,
+        )
+        self._process.start()
+
+    def submit(self, epoch):
+        """
+        Queues the current weights of the policy for evaluation, tagged with
+        `epoch`. Never blocks, drops the oldest waiting snapshot if the queue
+        is full.
+        """
+        self.start()
+        state_dict = OrderedDict((k, v.detach().cpu().clone()) for k, v in self.policy.state_dict().items())
+        while True:
+            try:
+                self._snapshot_queue.put_nowait((epoch, state_dict))
+                break
+            except queue.Full:
+                try:
+                    self._snapshot_queue.get_nowait()
+                    self.num_dropped += 1
+                except queue.Empty:
+                    pass
+        self.num_submitted += 1
+
+    def poll(self, block=False, timeout=None):
+        """
+        Returns the `(epoch, statistics)` of the evaluations which have
+        finished since the last call, and writes them to the log file.
+
+        :param block: wait for (at least) one result
+        """
+        results = []
+        while self._result_queue is not None:
+            try:
+                if block and len(results) == 0:
+                    epoch, statistics = self._result_queue.get(timeout=timeout)
+                else:
+                    epoch, statistics = self._result_queue.get_nowait()
+            except queue.Empty:
+                break
+            if epoch is None:
+                raise RuntimeError("asynchronous evaluation failed:\n" + statistics)
+            self.num_finished += 1
+            self._write(epoch, statistics)
+            results.append((epoch, statistics))
+        return results
+
+    def _write(self, epoch, statistics):
+        if self.log_file is None or logger.get_snapshot_dir() is None:
+            return
+        row = OrderedDict(Epoch=epoch)
+        row.update(statistics)
+        if self._csv_writer is None:
+            self._csv_file = open(osp.join(logger.get_snapshot_dir(), self.log_file), "w")
+            # the keys of later evaluations are expected to be the same
+            self._csv_writer = csv.DictWriter(self._csv_file, fieldnames=list(row.keys()), extrasaction="ignore")
+            self._csv_writer.writeheader()
+        self._csv_writer.writerow(row)
+        self._csv_file.flush()
+
+    def get_diagnostics(self):
+        return OrderedDict(
+            [
+                ("snapshots submitted", self.num_submitted),
+                ("snapshots dropped", self.num_dropped),
+                ("snapshots evaluated", self.num_finished),
+            ]
+        )
+
+    def close(self, wait=True):
+        """
+        Stops the worker, after it has evaluated the waiting snapshots if
+        `wait`, and returns the remaining results. The worker is stopped
+        even if the evaluation failed (and this raises its error).
+        """
+        if self._process is None:
+            return []
+        results = []
+        try:
+            if wait:
+                while self.num_finished < self.num_submitted - self.num_dropped and self._process.is_alive():
+                    results.extend(self.poll(block=True, timeout=1.0))
+            else:
+                while True:
+                    try:
+                        self._snapshot_queue.get_nowait()
+                        self.num_dropped += 1
+                    except queue.Empty:
+                        break
+            self._stop_worker()
+            results.extend(self.poll())
+        finally:
+            self._stop_worker()
+            self._process = None
+            self._snapshot_queue = None
+            self._result_queue = None
+            if self._csv_file is not None:
+                self._csv_file.close()
+                self._csv_file = None
+                self._csv_writer = None
+        return results
+
+    def _stop_worker(self):
+        if self._process.is_alive():
+            try:
+                self._snapshot_queue.put(None, timeout=1.0)
+            except queue.Full:
+                pass
+            self._process.join(timeout=10.0)
+            if self._process.is_alive():
+                self._process.terminate()
@@ -13,6 +13,7 @@ import matplotlib.pyplot as plt
 from marlkit.torch import pytorch_util as ptu
 
 import gtimer as gt
+from marlkit.core import logger
 from marlkit.core.rl_algorithm import BaseRLAlgorithm, BaseMARLAlgorithm
 from marlkit.core.rl_algorithm import eval_util
 from marlkit.data_management.replay_buffer import MAReplayBuffer
@@ -20,6 +21,7 @@ from marlkit.samplers.data_collector import PathCollector
 from marlkit.samplers.data_collector.marl_path_collector import MdpPathCollector
 import numpy as np
 from marlkit.torch.core import np_to_pytorch_batch
+from marlkit.torch.data import BatchPrefetcher
 
 import torch
 
@@ -37,26 +39,11 @@ gt.set_def_unique(False)
 
 
 def get_flat_params(model):
-    params = []
-    for param in model.parameters():
-        # import ipdb; ipdb.set_trace()
-        params.append(param.data.cpu().numpy().reshape(-1))
-    return np.concatenate(params)
+    return ptu.get_numpy(ptu.get_flat_params(model)).copy()
 
 
 def set_flat_params(model, flat_params, trainable_only=True):
-    idx = 0
-    # import ipdb; ipdb.set_trace()
-    for p in model.parameters():
-        flat_shape = int(np.prod(list(p.data.shape)))
-        flat_params_to_assign = flat_params[idx : idx + flat_shape]
-
-        if len(p.data.shape):
-            p.data = ptu.tensor(flat_params_to_assign.reshape(*p.data.shape))
-        else:
-            p.data = ptu.tensor(flat_params_to_assign[0])
-        idx += flat_shape
-    return model
+    return ptu.set_flat_params(model, flat_params)
 
 
 class BatchMARLAlgorithm(BaseMARLAlgorithm, metaclass=abc.ABCMeta):
@@ -84,6 +71,18 @@ class BatchMARLAlgorithm(BaseMARLAlgorithm, metaclass=abc.ABCMeta):
         # where the mixing network can only accept fixed sizes
         flatten_global_state=False,
         eval_discard_incomplete=True,
+        # sample and collate batches in a background thread, keeping
+        # this many ready for the trainer (0 disables prefetching)
+        num_prefetch_batches=0,
+        pin_memory=False,
+        # evaluate policy snapshots in a background process instead, see
+        # marlkit.core.async_evaluation
+        async_evaluator=None,
+        # evaluate until the return confidence interval is narrow enough
+        # instead of for num_eval_steps_per_epoch, e.g. dict(ci_width=1.0,
+        # min_num_paths=5, max_num_paths=50, seed=0), see
+        # MdpPathCollector.collect_adaptive_paths
+        adaptive_eval_kwargs=None,
     ):
         super().__init__(
             trainer,
@@ -106,6 +105,14 @@ class BatchMARLAlgorithm(BaseMARLAlgorithm, metaclass=abc.ABCMeta):
         self.eval_both = eval_both
         self.num_actions_sample = num_actions_sample
         self.eval_discard_incomplete = eval_discard_incomplete
+        if async_evaluator is not None and q_learning_alg:
+            raise ValueError("asynchronous evaluation doesn't support q_learning_alg evaluation")
+        if adaptive_eval_kwargs is not None and q_learning_alg:
+            raise ValueError("adaptive evaluation doesn't support q_learning_alg evaluation")
+        if adaptive_eval_kwargs is not None and async_evaluator is not None:
+            raise ValueError("adaptive evaluation can't be combined with asynchronous evaluation")
+        self.async_evaluator = async_evaluator
+        self.adaptive_eval_kwargs = adaptive_eval_kwargs
 
         ### Reserve path collector for evaluation, visualization
         # if hasattr(a, 'property'):
@@ -115,6 +122,18 @@ class BatchMARLAlgorithm(BaseMARLAlgorithm, metaclass=abc.ABCMeta):
             mixer=self.trainer.mixer if hasattr(self.trainer, "mixer") else None,
         )
 
+        if num_prefetch_batches > 0:
+            assert hasattr(self.trainer, "train_collated"), "Prefetching requires a (MA)TorchTrainer"
+            self._prefetcher = BatchPrefetcher(
+                self.replay_buffer,
+                self.batch_size,
+                collate_fn=getattr(self.trainer, "collate", None),
+                num_prefetch_batches=num_prefetch_batches,
+                pin_memory=pin_memory,
+            )
+        else:
+            self._prefetcher = None
+
         self.running_loss = None
         self.running_loss_count = 0
         self.running_loss_target = 10
@@ -141,6 +160,34 @@ class BatchMARLAlgorithm(BaseMARLAlgorithm, metaclass=abc.ABCMeta):
         return ptu.get_numpy(action).flatten()
 
     def _train(self):
+        self._collect_initial_paths()
+
+        if self._prefetcher is not None:
+            self._prefetcher.start()
+        training_failed = True
+        try:
+            self._train_epochs()
+            training_failed = False
+        finally:
+            if self._prefetcher is not None:
+                self._prefetcher.close()
+            self._close_async_evaluator(training_failed=training_failed)
+
+    def _add_paths(self, paths):
+        if self._prefetcher is not None:
+            with self._prefetcher.buffer_lock:
+                self.replay_buffer.add_paths(paths)
+        else:
+            self.replay_buffer.add_paths(paths)
+
+    def _train_batch(self):
+        if self._prefetcher is not None:
+            self.trainer.train_collated(self._prefetcher.get())
+        else:
+            train_data = self.replay_buffer.random_batch(self.batch_size)
+            self.trainer.train(train_data)
+
+    def _collect_initial_paths(self):
         if self.min_num_steps_before_training > 0 and not self.batch_rl:
             init_expl_paths = self.expl_data_collector.collect_new_paths(
                 self.max_path_length,
@@ -150,67 +197,111 @@ class BatchMARLAlgorithm(BaseMARLAlgorithm, metaclass=abc.ABCMeta):
             self.replay_buffer.add_paths(init_expl_paths)
             self.expl_data_collector.end_epoch(-1)
 
+    def _train_epochs(self):
         for epoch in gt.timed_for(
             range(self._start_epoch, self.num_epochs),
             save_itrs=True,
         ):
-            if self.q_learning_alg:
-                policy_fn = self.policy_fn
-                try:
-                    if self.trainer.discrete:
-                        policy_fn = self.policy_fn_discrete
-                except:
-                    pass
-
-                # for MARL - and petting zoo, set discard_incomplete_paths to False
-                # as most of the environments you die and does not terminate correctly?
-                if (epoch % 5) == 0:
-                    self.eval_data_collector.collect_new_paths(
-                        policy_fn,
-                        self.max_path_length,
-                        self.num_eval_steps_per_epoch,
-                        discard_incomplete_paths=self.eval_discard_incomplete,
-                    )
-            else:
-                if (epoch % 5) == 0:
-                    self.eval_data_collector.collect_new_paths(
-                        self.max_path_length,
-                        self.num_eval_steps_per_epoch,
-                        discard_incomplete_paths=self.eval_discard_incomplete,
-                    )
-            gt.stamp("evaluation sampling")
+            self._evaluate(epoch)
 
             for _ in range(self.num_train_loops_per_epoch):
-                if not self.batch_rl:
-                    # Sample new paths only if not doing batch rl
-                    new_expl_paths = self.expl_data_collector.collect_new_paths(
-                        self.max_path_length,
-                        self.num_expl_steps_per_train_loop,
-                        discard_incomplete_paths=False,
-                    )
-                    gt.stamp("exploration sampling", unique=False)
-
-                    self.replay_buffer.add_paths(new_expl_paths)
-                    gt.stamp("data storing", unique=False)
-                elif self.eval_both:
-                    # Now evaluate the policy here:
-                    policy_fn = self.policy_fn
-                    if self.trainer.discrete:
-                        policy_fn = self.policy_fn_discrete
-                    new_expl_paths = self.expl_data_collector.collect_new_paths(
-                        policy_fn,
-                        self.max_path_length,
-                        self.num_eval_steps_per_epoch,
-                        discard_incomplete_paths=self.eval_discard_incomplete,
-                    )
-
-                    gt.stamp("policy fn evaluation")
+                self._collect_exploration_paths()
 
                 self.training_mode(True)
                 for _ in range(self.num_trains_per_train_loop):
-                    train_data = self.replay_buffer.random_batch(self.batch_size)
-                    self.trainer.train(train_data)
+                    self._train_batch()
                 gt.stamp("training", unique=False)
                 self.training_mode(False)
 
             self._end_epoch(epoch)
+
+    def _evaluate(self, epoch):
+        if self.async_evaluator is not None:
+            self._log_async_results(self.async_evaluator.poll())
+            if (epoch % 5) == 0:
+                self.async_evaluator.submit(epoch)
+            gt.stamp("evaluation sampling")
+            return
+        if self.q_learning_alg:
+            policy_fn = self.policy_fn
+            try:
+                if self.trainer.discrete:
+                    policy_fn = self.policy_fn_discrete
+            except:
+                pass
+
+            # for MARL - and petting zoo, set discard_incomplete_paths to False
+            # as most of the environments you die and does not terminate correctly?
+            if (epoch % 5) == 0:
+                self.eval_data_collector.collect_new_paths(
+                    policy_fn,
+                    self.max_path_length,
+                    self.num_eval_steps_per_epoch,
+                    discard_incomplete_paths=self.eval_discard_incomplete,
+                )
+        elif self.adaptive_eval_kwargs is not None:
+            if (epoch % 5) == 0:
+                self.eval_data_collector.collect_adaptive_paths(
+                    self.max_path_length,
+                    discard_incomplete_paths=self.eval_discard_incomplete,
+                    **self.adaptive_eval_kwargs,
+                )
+        else:
+            if (epoch % 5) == 0:
+                self.eval_data_collector.collect_new_paths(
+                    self.max_path_length,
+                    self.num_eval_steps_per_epoch,
+                    discard_incomplete_paths=self.eval_discard_incomplete,
+                )
+        gt.stamp("evaluation sampling")
+
+    def _log_async_results(self, results):
+        for epoch, statistics in results:
+            logger.log(
+                "Evaluation of epoch {} finished, average returns {}".format(epoch, statistics.get("Average Returns"))
+            )
+
+    def _close_async_evaluator(self, training_failed=False):
+        if self.async_evaluator is None:
+            return
+        if not training_failed:
+            self._log_async_results(self.async_evaluator.close())
+            return
+        # don't wait for the pending snapshots, nor replace the exception
+        # training failed with by an evaluation error
+        try:
+            self._log_async_results(self.async_evaluator.close(wait=False))
+        except Exception as e:
+            logger.log("Closing the asynchronous evaluator failed: {}".format(e))
+
+    def _log_evaluation(self, epoch):
+        if self.async_evaluator is None:
+            return super()._log_evaluation(epoch)
+        # the results are logged to their own csv, tagged with their epoch
+        logger.record_dict(self.async_evaluator.get_diagnostics(), prefix="evaluation/")
+
+    def _collect_exploration_paths(self):
+        if not self.batch_rl:
+            # Sample new paths only if not doing batch rl
+            new_expl_paths = self.expl_data_collector.collect_new_paths(
+                self.max_path_length,
+                self.num_expl_steps_per_train_loop,
+                discard_incomplete_paths=False,
+            )
+            gt.stamp("exploration sampling", unique=False)
+
+            self._add_paths(new_expl_paths)
+            gt.stamp("data storing", unique=False)
+        elif self.eval_both:
+            # Now evaluate the policy here:
+            policy_fn = self.policy_fn
+            if self.trainer.discrete:
+                policy_fn = self.policy_fn_discrete
+            new_expl_paths = self.expl_data_collector.collect_new_paths(
+                policy_fn,
+                self.max_path_length,
+                self.num_eval_steps_per_epoch,
+                discard_incomplete_paths=self.eval_discard_incomplete,
+            )
+
+            gt.stamp("policy fn evaluation")
@@ -25,26 +25,11 @@ gt.set_def_unique(False)
 
 
 def get_flat_params(model):
-    params = []
-    for param in model.parameters():
-        # import ipdb; ipdb.set_trace()
-        params.append(param.data.cpu().numpy().reshape(-1))
-    return np.concatenate(params)
+    return ptu.get_numpy(ptu.get_flat_params(model)).copy()
 
 
 def set_flat_params(model, flat_params, trainable_only=True):
-    idx = 0
-    # import ipdb; ipdb.set_trace()
-    for p in model.parameters():
-        flat_shape = int(np.prod(list(p.data.shape)))
-        flat_params_to_assign = flat_params[idx : idx + flat_shape]
-
-        if len(p.data.shape):
-            p.data = ptu.tensor(flat_params_to_assign.reshape(*p.data.shape))
-        else:
-            p.data = ptu.tensor(flat_params_to_assign[0])
-        idx += flat_shape
-    return model
+    return ptu.set_flat_params(model, flat_params)
 
 
 class BatchRLAlgorithm(BaseRLAlgorithm, metaclass=abc.ABCMeta):
@@ -4,6 +4,7 @@ Common evaluation utilities.
 
 from collections import OrderedDict
 from numbers import Number
+from statistics import NormalDist
 
 import numpy as np
 
@@ -75,67 +76,149 @@ def get_generic_multi_agent_path_information(paths, stat_prefix=""):
     """
     Get an OrderedDict with a bunch of statistic names and values.
     """
-    # print(paths)
-    # print(paths[0]["rewards"])
-    # print(np.array(paths[0]["rewards"]).shape)
-    # raise Exception("")
-    statistics = OrderedDict()
-    returns = [np.sum(np.array(path["rewards"])[:, 0, 0]) for path in paths]
-    rewards = [np.array(path["rewards"])[:, 0, 0] for path in paths]
+    statistics = MultiAgentPathStatistics()
+    for path in paths:
+        statistics.add_path(path)
+    return statistics.get_statistics(stat_prefix)
 
-    # statistics.update(
-    #     create_stats_ordered_dict("Rewards", rewards, stat_prefix=stat_prefix)
-    # )
-    statistics.update(create_stats_ordered_dict("Returns", returns, stat_prefix=stat_prefix))
-    statistics.update(create_stats_ordered_dict("Rewards", rewards, stat_prefix=stat_prefix))
-    # statistics.update(
-    #    create_stats_ordered_dict(
-    #        "Final Rewards", final_reward, stat_prefix=stat_prefix
-    #    )
-    # )
-    # actions = [path["actions"] for path in paths]
-    # if len(actions[0].shape) == 1:
-    #     actions = np.hstack([path["actions"] for path in paths])
-    # else:
-    #     actions = np.vstack([path["actions"] for path in paths])
-    # statistics.update(
-    #     create_stats_ordered_dict("Actions", actions, stat_prefix=stat_prefix)
-    # )
-    statistics["Num Paths"] = len(paths)
-    statistics[stat_prefix + "Average Returns"] = get_average_returns(paths)
 
-    return statistics
+class RunningStat(object):
+    """
+    Streaming mean, (population) std, max and min of a stream of numbers,
+    merged a batch at a time (Chan et al.), in constant memory.
+    """
 
-    for info_key in ["env_infos", "agent_infos"]:
-        if info_key in paths[0]:
-            all_env_infos = [ppp.list_of_dicts__to__dict_of_lists(p[info_key]) for p in paths]
-            for k in all_env_infos[0].keys():
-                final_ks = np.array([info[k][-1] for info in all_env_infos])
-                first_ks = np.array([info[k][0] for info in all_env_infos])
-                all_ks = np.concatenate([info[k] for info in all_env_infos])
-                statistics.update(
-                    create_stats_ordered_dict(
-                        stat_prefix + k,
-                        final_ks,
-                        stat_prefix="{}/final/".format(info_key),
-                    )
-                )
-                statistics.update(
-                    create_stats_ordered_dict(
-                        stat_prefix + k,
-                        first_ks,
-                        stat_prefix="{}/initial/".format(info_key),
-                    )
-                )
-                statistics.update(
-                    create_stats_ordered_dict(
-                        stat_prefix + k,
-                        all_ks,
-                        stat_prefix="{}/".format(info_key),
-                    )
-                )
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.max = -np.inf
+        self.min = np.inf
 
-    return statistics
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).reshape(-1)
+        if len(values) == 0:
+            return
+        count = self.count + len(values)
+        mean = values.mean()
+        delta = mean - self.mean
+        self._m2 += ((values - mean) ** 2).sum() + delta ** 2 * self.count * len(values) / count
+        self.mean += delta * len(values) / count
+        self.count = count
+        self.max = max(self.max, values.max())
+        self.min = min(self.min, values.min())
+
+    @property
+    def std(self):
+        return np.sqrt(self._m2 / self.count) if self.count > 0 else 0.0
+
+    def confidence_interval(self, confidence=0.95):
+        """
+        Half width of the (normal) confidence interval of the mean, inf
+        until there are two values.
+        """
+        if self.count < 2:
+            return np.inf
+        z = NormalDist().inv_cdf(0.5 + confidence / 2)
+        return z * np.sqrt(self._m2 / (self.count - 1) / self.count)
+
+    def get_statistics(self, name, stat_prefix=None):
+        """
+        The statistics of `create_stats_ordered_dict(name, values)`
+        """
+        if stat_prefix is not None:
+            name = "{}{}".format(stat_prefix, name)
+        if self.count == 0:
+            return OrderedDict()
+        return OrderedDict(
+            [
+                (name + " Mean", self.mean),
+                (name + " Std", self.std),
+                (name + " Max", self.max),
+                (name + " Min", self.min),
+            ]
+        )
+
+
+def team_rewards(path):
+    """
+    `[T]` team rewards of a multi-agent path, the rewards of the first agent
+    """
+    return np.array([np.asarray(r).reshape(-1)[0] for r in path["rewards"]], dtype=np.float64)
+
+
+class MultiAgentPathStatistics(object):
+    """
+    The statistics of `get_generic_multi_agent_path_information`, accumulated
+    as every path finishes so that the paths need not be kept until the end
+    of the epoch.
+
+    Also accumulates the returns of every agent (by index) and the numeric
+    `env_infos`/`agent_infos` of every agent and step.
+    """
+
+    def __init__(self):
+        self.num_paths = 0
+        self.returns = RunningStat()
+        self.rewards = RunningStat()
+        self.lengths = RunningStat()
+        self._average_returns = RunningStat()
+        self.agent_returns = []
+        self.infos = OrderedDict()
+
+    def add_path(self, path):
+        rewards = team_rewards(path)
+        self.num_paths += 1
+        self.returns.update(rewards.sum())
+        self.rewards.update(rewards)
+        self.lengths.update(len(path["actions"]))
+
+        agent_returns = np.zeros(0)
+        per_step_total = 0.0
+        for r in path["rewards"]:
+            r = np.asarray(r, dtype=np.float64).reshape(-1)
+            if len(r) > len(agent_returns):
+                agent_returns = np.concatenate([agent_returns, np.zeros(len(r) - len(agent_returns))])
+            agent_returns[: len(r)] += r
+            per_step_total += r.sum()
+        # sum over the agents of the mean reward per step, see `get_average_returns`
+        self._average_returns.update(per_step_total / max(len(path["rewards"]), 1))
+        while len(self.agent_returns) < len(agent_returns):
+            self.agent_returns.append(RunningStat())
+        for stat, value in zip(self.agent_returns, agent_returns):
+            stat.update(value)
+
+        for info_key in ["env_infos", "agent_infos"]:
+            for t, step in enumerate(path.get(info_key, [])):
+                final = t == len(path[info_key]) - 1
+                for agent_infos in step:
+                    for info in agent_infos:
+                        if not isinstance(info, dict):
+                            continue
+                        for k, v in info.items():
+                            if isinstance(v, (Number, np.number)) and not isinstance(v, bool):
+                                self._update_info(info_key, k, v, final)
+
+    def _update_info(self, info_key, k, value, final):
+        if (info_key, k) not in self.infos:
+            self.infos[(info_key, k)] = (RunningStat(), RunningStat())
+        every_step, final_step = self.infos[(info_key, k)]
+        every_step.update(value)
+        if final:
+            final_step.update(value)
+
+    def get_statistics(self, stat_prefix=""):
+        statistics = OrderedDict()
+        statistics.update(self.returns.get_statistics("Returns", stat_prefix=stat_prefix))
+        statistics.update(self.rewards.get_statistics("Rewards", stat_prefix=stat_prefix))
+        statistics["Num Paths"] = self.num_paths
+        statistics[stat_prefix + "Average Returns"] = self._average_returns.mean if self.num_paths else np.nan
+        for idx, stat in enumerate(self.agent_returns):
+            statistics.update(stat.get_statistics("Agent {} Returns".format(idx), stat_prefix=stat_prefix))
+        for (info_key, k), (every_step, final_step) in self.infos.items():
+            statistics.update(every_step.get_statistics(stat_prefix + k, stat_prefix="{}/".format(info_key)))
+            statistics.update(final_step.get_statistics(stat_prefix + k, stat_prefix="{}/final/".format(info_key)))
+        return statistics
 
 
 def get_average_returns(paths):
@@ -25,6 +25,16 @@ def _get_epoch_timings():
     return times
 
 
+def _get_path_information(data_collector):
+    """
+    The multi-agent path statistics of the epoch, streamed by the collector
+    if it can, else computed from its epoch paths.
+    """
+    if hasattr(data_collector, "get_epoch_statistics"):
+        return data_collector.get_epoch_statistics().get_statistics()
+    return eval_util.get_generic_multi_agent_path_information(data_collector.get_epoch_paths())
+
+
 class BaseRLAlgorithm(object, metaclass=abc.ABCMeta):
     def __init__(
         self,
@@ -244,12 +254,23 @@ class BaseMARLAlgorithm(object, metaclass=abc.ABCMeta):
             )
         if not self.batch_rl or self.eval_both:
             logger.record_dict(
-                eval_util.get_generic_multi_agent_path_information(expl_paths),
+                _get_path_information(self.expl_data_collector),
                 prefix="exploration/",
             )
         """
         Evaluation
         """
+        self._log_evaluation(epoch)
+
+        """
+        Misc
+        """
+        gt.stamp("logging")
+        logger.record_dict(_get_epoch_timings())
+        logger.record_tabular("Epoch", epoch)
+        logger.dump_tabular(with_prefix=False, with_timestamp=False)
+
+    def _log_evaluation(self, epoch):
         if (epoch % 5) == 0:
             logger.record_dict(
                 self.eval_data_collector.get_diagnostics(),
@@ -262,18 +283,10 @@ class BaseMARLAlgorithm(object, metaclass=abc.ABCMeta):
                     prefix="evaluation/",
                 )
             logger.record_dict(
-                eval_util.get_generic_multi_agent_path_information(eval_paths),
+                _get_path_information(self.eval_data_collector),
                 prefix="evaluation/",
             )
 
-        """
-        Misc
-        """
-        gt.stamp("logging")
-        logger.record_dict(_get_epoch_timings())
-        logger.record_tabular("Epoch", epoch)
-        logger.dump_tabular(with_prefix=False, with_timestamp=False)
-
     @abc.abstractmethod
     def training_mode(self, mode):
         """
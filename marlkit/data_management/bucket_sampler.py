@@ -0,0 +1,131 @@
+"""
+Bucketed episode sampling for the whole path replay buffers.
+
+On the mixed size envs (`pursuit_mix`, `kaz_mix`, `prison_mix`, ...) the
+episodes of a uniformly sampled batch have different numbers of agents and
+lengths, so the batch is padded to the largest of each. `BucketSampler`
+keeps the stored episodes in buckets by agent count (and, optionally, by
+length) and draws every batch from a single bucket, so that a batch needs
+no agent padding and little time padding.
+
+The bucket of a batch is the bucket of a uniformly sampled episode, i.e.
+buckets are drawn weighted by their size, so every episode is still sampled
+with the same probability on average. Within the bucket the episodes are
+sampled uniformly, with replacement.
+
+Use it through the env buffer, e.g.
+
+    FullMAEnvReplayBuffer(max_replay_buffer_size, env, sampler="bucket", length_bucket_width=25)
+
+The buffers evict their episodes oldest first, so the sampler identifies an
+episode by its position in the buffer from the oldest one (see `sample`),
+and each buffer maps that position to its own storage.
+"""
+
+from collections import OrderedDict, deque
+
+import numpy as np
+
+
+class _IdQueue(object):
+    """
+    FIFO of increasing episode ids, as a growable numpy array so that a batch
+    is sampled with a single fancy index.
+    """
+
+    def __init__(self, capacity=64):
+        self._ids = np.zeros(capacity, dtype=np.int64)
+        self._head = 0
+        self._tail = 0
+
+    def __len__(self):
+        return self._tail - self._head
+
+    def append(self, episode_id):
+        if self._tail == len(self._ids):
+            ids = self._ids[self._head : self._tail]
+            if len(ids) * 2 > len(self._ids):
+                self._ids = np.zeros(len(self._ids) * 2, dtype=np.int64)
+            self._ids[: len(ids)] = ids
+            self._head, self._tail = 0, len(ids)
+        self._ids[self._tail] = episode_id
+        self._tail += 1
+
+    def popleft(self):
+        episode_id = self._ids[self._head]
+        self._head += 1
+        return episode_id
+
+    def sample(self, batch_size):
+        return self._ids[np.random.randint(self._head, self._tail, batch_size)]
+
+
+class BucketSampler(object):
+    def __init__(self, length_bucket_width=None):
+        """
+        :param length_bucket_width: also bucket the episodes by length, in
+        buckets of `length_bucket_width` steps. Buckets by agent count only
+        if None.
+        """
+        self.length_bucket_width = length_bucket_width
+        self._buckets = OrderedDict()
+        # bucket of every stored episode, oldest first
+        self._keys = deque()
+        self._first_id = 0
+
+    def _key(self, n_agents, length):
+        if self.length_bucket_width is None:
+            return (int(n_agents),)
+        return int(n_agents), max(int(length) - 1, 0) // self.length_bucket_width
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, n_agents, length):
+        """
+        Registers the newest episode of the buffer.
+        """
+        key = self._key(n_agents, length)
+        if key not in self._buckets:
+            self._buckets[key] = _IdQueue()
+        self._buckets[key].append(self._first_id + len(self._keys))
+        self._keys.append(key)
+
+    def evict_oldest(self):
+        """
+        Forgets the oldest episode of the buffer.
+        """
+        key = self._keys.popleft()
+        self._buckets[key].popleft()
+        if len(self._buckets[key]) == 0:
+            del self._buckets[key]
+        self._first_id += 1
+
+    def sample(self, batch_size):
+        """
+        :return: `[batch_size]` positions of the sampled episodes from the
+        oldest stored episode, all from the same bucket
+        """
+        buckets = list(self._buckets.values())
+        sizes = np.cumsum([len(ids) for ids in buckets])
+        bucket = buckets[np.searchsorted(sizes, np.random.randint(sizes[-1]), side="right")]
+        return bucket.sample(batch_size) - self._first_id
+
+    def get_diagnostics(self):
+        return OrderedDict(
+            [
+                ("buckets", len(self._buckets)),
+                ("largest bucket", max((len(ids) for ids in self._buckets.values()), default=0)),
+            ]
+        )
+
+
+def make_sampler(sampler, length_bucket_width=None):
+    """
+    :param sampler: "uniform" (None) or "bucket"
+    """
+    if sampler in (None, "uniform"):
+        return None
+    if sampler == "bucket":
+        return BucketSampler(length_bucket_width)
+    raise ValueError("unknown sampler {}, expected 'uniform' or 'bucket'".format(sampler))
@@ -5,15 +5,26 @@ from marlkit.data_management.simple_replay_buffer import (
     SimpleMAReplayBuffer,
     WholeMAReplayBuffer,
 )
+from marlkit.data_management.spill_replay_buffer import BudgetWholeMAReplayBuffer
+from marlkit.data_management.torch_replay_buffer import (
+    TorchReplayBuffer,
+    TorchWholeMAReplayBuffer,
+)
 from marlkit.envs.env_utils import get_dim
 import numpy as np
 
 
 class EnvReplayBuffer(SimpleReplayBuffer):
-    def __init__(self, max_replay_buffer_size, env, env_info_sizes=None):
+    def __new__(cls, *args, backend="numpy", **kwargs):
+        if backend == "torch" and not issubclass(cls, TorchReplayBuffer):
+            cls = TorchEnvReplayBuffer
+        return super().__new__(cls)
+
+    def __init__(self, max_replay_buffer_size, env, env_info_sizes=None, backend="numpy"):
         """
         :param max_replay_buffer_size:
         :param env:
+        :param backend: "numpy" or "torch", see marlkit.data_management.torch_replay_buffer
         """
         self.env = env
         self._ob_space = env.observation_space
@@ -47,6 +58,11 @@ class EnvReplayBuffer(SimpleReplayBuffer):
             **kwargs
         )
 
+    def _process_actions(self, actions):
+        if isinstance(self._action_space, Discrete):
+            return np.eye(self._action_dim)[np.asarray(actions, dtype=int).reshape(-1)]
+        return super()._process_actions(actions)
+
 
 class MAEnvReplayBuffer(SimpleMAReplayBuffer):
     def __init__(self, max_replay_buffer_size, env, env_info_sizes=None):
@@ -104,10 +120,40 @@ class MAEnvReplayBuffer(SimpleMAReplayBuffer):
 
 
 class FullMAEnvReplayBuffer(WholeMAReplayBuffer):
-    def __init__(self, max_replay_buffer_size, env, env_info_sizes=None):
+    def __new__(cls, *args, backend="numpy", max_replay_buffer_bytes=None, **kwargs):
+        if backend == "torch" and max_replay_buffer_bytes is not None:
+            raise ValueError("max_replay_buffer_bytes is only supported by the numpy backend")
+        if issubclass(cls, (TorchWholeMAReplayBuffer, BudgetWholeMAReplayBuffer)):
+            pass
+        elif backend == "torch":
+            cls = TorchFullMAEnvReplayBuffer
+        elif max_replay_buffer_bytes is not None:
+            cls = BudgetFullMAEnvReplayBuffer
+        return super().__new__(cls)
+
+    def __init__(
+        self,
+        max_replay_buffer_size,
+        env,
+        env_info_sizes=None,
+        backend="numpy",
+        max_path_length=None,
+        max_replay_buffer_bytes=None,
+        spill_dir=None,
+        sampler=None,
+        length_bucket_width=None,
+    ):
         """
         :param max_replay_buffer_size:
         :param env:
+        :param backend: "numpy" or "torch", see marlkit.data_management.torch_replay_buffer
+        :param max_path_length: needed by the torch backend to preallocate the paths
+        :param max_replay_buffer_bytes: memory budget of the buffer, see
+        marlkit.data_management.spill_replay_buffer. Only with the numpy backend
+        :param spill_dir: where episodes over the memory budget are spilled to
+        :param sampler: "uniform" or "bucket", to draw every batch from a single
+        agent count (and length) bucket, see marlkit.data_management.bucket_sampler
+        :param length_bucket_width: length buckets of the "bucket" sampler
         """
         ENV_OBS = "obs"
         ENV_STATE = "state"
@@ -123,12 +169,19 @@ class FullMAEnvReplayBuffer(WholeMAReplayBuffer):
             else:
                 env_info_sizes = dict()
 
+        kwargs = dict(sampler=sampler, length_bucket_width=length_bucket_width)
+        if isinstance(self, TorchWholeMAReplayBuffer):
+            kwargs.update(max_path_length=max_path_length, max_num_agents=env.max_num_agents)
+        elif isinstance(self, BudgetWholeMAReplayBuffer):
+            kwargs.update(max_replay_buffer_bytes=max_replay_buffer_bytes, spill_dir=spill_dir)
+
         super().__init__(
             max_replay_buffer_size=max_replay_buffer_size,
             observation_dim=get_dim(self._ob_space),
             state_dim=get_dim(self._state_space),
             action_dim=get_dim(self._action_space),
             env_info_sizes=env_info_sizes,
+            **kwargs
         )
 
     def add_sample(
@@ -156,3 +209,15 @@ class FullMAEnvReplayBuffer(WholeMAReplayBuffer):
             terminal=terminal,
             **kwargs
         )
+
+
+class TorchEnvReplayBuffer(EnvReplayBuffer, TorchReplayBuffer):
+    pass
+
+
+class TorchFullMAEnvReplayBuffer(FullMAEnvReplayBuffer, TorchWholeMAReplayBuffer):
+    pass
+
+
+class BudgetFullMAEnvReplayBuffer(FullMAEnvReplayBuffer, BudgetWholeMAReplayBuffer):
+    pass
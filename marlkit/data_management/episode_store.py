@@ -0,0 +1,179 @@
+"""
+On-disk store of whole multi-agent episodes, e.g. the behaviour datasets of
+offline MARL written by `experiment/dataset.py`.
+
+A store is a directory of shards. Every shard is written by a single
+`EpisodeShardWriter` as
+
+*  `<name>.bin`: the float32 arrays of its episodes, back to back, appended
+   (and flushed) as every episode completes
+*  `<name>.json`: the shard metadata (whatever the writer was given, e.g. the
+   env and the behaviour policies) and the layout, length, return and info
+   of every episode, written when the shard is closed
+
+so that a shard without metadata is incomplete and is skipped by
+`EpisodeStore`. The episodes are read back as read only memory mapped arrays
+with the per step shapes of `marl_rollout` (see `marlkit.torch.episode_batch`),
+e.g. into a whole path replay buffer with
+
+    EpisodeStore(root).add_to_replay_buffer(replay_buffer)
+"""
+
+import json
+import os
+
+import numpy as np
+
+from marlkit.data_management.path_builder import stack_steps
+
+EPISODE_KEYS = (
+    "observations",
+    "states",
+    "states_0",
+    "active_agents",
+    "actions",
+    "rewards",
+    "terminals",
+    "next_observations",
+    "next_states",
+    "next_states_0",
+)
+
+
+def path_to_episode(path):
+    """
+    Stacks a `marl_rollout` path into `[T, *step_shape]` float32 arrays,
+    cut to the steps which every key has (see `stack_steps`).
+    """
+    episode = {key: stack_steps(path[key]) for key in EPISODE_KEYS}
+    length = min(len(value) for value in episode.values())
+    return {key: value[:length] for key, value in episode.items()}
+
+
+class EpisodeShardWriter(object):
+    def __init__(self, path, metadata=None):
+        """
+        :param path: path of the shard without extension
+        :param metadata: json serialisable metadata of the shard
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.metadata = dict(metadata or {})
+        self._file = open(path + ".bin", "wb")
+        self._offset = 0
+        self._episodes = []
+
+    def write(self, episode, **info):
+        """
+        Appends an episode (a `marl_rollout` path, or a dict of stacked
+        arrays) with its json serialisable `info`, e.g. the behaviour policy.
+        """
+        if "agent_infos" in episode or not isinstance(episode.get("observations"), np.ndarray):
+            episode = path_to_episode(episode)
+        layout = {}
+        for key in EPISODE_KEYS:
+            value = np.ascontiguousarray(episode[key], dtype=np.float32)
+            layout[key] = [self._offset, list(value.shape)]
+            self._file.write(value.tobytes())
+            self._offset += value.nbytes
+        self._file.flush()
+        rewards = episode["rewards"]
+        self._episodes.append(
+            dict(
+                layout=layout,
+                length=int(len(rewards)),
+                n_agents=int(rewards.shape[-1]) if rewards.ndim > 1 else 1,
+                # team return, the sum of the rewards of every agent
+                episode_return=float(np.sum(rewards)),
+                **info,
+            )
+        )
+
+    def close(self):
+        self._file.close()
+        returns = [episode["episode_return"] for episode in self._episodes]
+        metadata = dict(
+            self.metadata,
+            n_episodes=len(self._episodes),
+            n_steps=int(sum(episode["length"] for episode in self._episodes)),
+            mean_return=float(np.mean(returns)) if returns else None,
+            episodes=self._episodes,
+        )
+        # the metadata marks the shard as complete, so write it atomically
+        with open(self.path + ".json.tmp", "w") as f:
+            json.dump(metadata, f)
+        os.replace(self.path + ".json.tmp", self.path + ".json")
+        return metadata
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class EpisodeStore(object):
+    def __init__(self, root):
+        """
+        :param root: directory of the (complete) shards
+        """
+        self.root = root
+        self.shards = []
+        for name in sorted(os.listdir(root)):
+            if name.endswith(".json"):
+                with open(os.path.join(root, name)) as f:
+                    metadata = json.load(f)
+                metadata["path"] = os.path.join(root, name[: -len(".json")])
+                self.shards.append(metadata)
+        self._maps = {}
+
+    @property
+    def n_episodes(self):
+        return sum(shard["n_episodes"] for shard in self.shards)
+
+    @property
+    def n_steps(self):
+        return sum(shard["n_steps"] for shard in self.shards)
+
+    def _read(self, shard, episode):
+        path = shard["path"] + ".bin"
+        if path not in self._maps:
+            self._maps[path] = np.memmap(path, dtype=np.uint8, mode="r")
+        data = self._maps[path]
+        return {
+            key: np.frombuffer(data, dtype=np.float32, count=int(np.prod(shape)), offset=offset).reshape(shape)
+            for key, (offset, shape) in episode["layout"].items()
+        }
+
+    def episodes(self, where=None):
+        """
+        Yields `(episode, info)` for every stored episode, where `info` is the
+        episode metadata with the metadata of its shard under "shard".
+
+        :param where: optional predicate on `info`, e.g. to select a behaviour
+        policy of a mixed dataset
+        """
+        for shard in self.shards:
+            shard_info = {key: value for key, value in shard.items() if key != "episodes"}
+            for episode in shard["episodes"]:
+                info = dict(episode, shard=shard_info)
+                if where is not None and not where(info):
+                    continue
+                yield self._read(shard, episode), info
+
+    def __iter__(self):
+        for episode, _ in self.episodes():
+            yield episode
+
+    def add_to_replay_buffer(self, replay_buffer, where=None):
+        """
+        Adds the (selected) episodes to a whole path replay buffer as paths.
+        """
+        n_episodes = 0
+        for episode, _ in self.episodes(where):
+            path = dict(episode)
+            path["agent_infos"] = [[{}] for _ in range(len(episode["actions"]))]
+            path["env_infos"] = [[{}] for _ in range(len(episode["actions"]))]
+            replay_buffer.add_path(path)
+            n_episodes += 1
+        return n_episodes
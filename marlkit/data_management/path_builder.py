@@ -58,3 +58,38 @@ def stack_list(lst):
         return lst
     else:
         return np.array(lst)
+
+
+def _step_array(step):
+    """
+    Returns the step as a float32 array, or None if it is ragged
+    (e.g. a list of per-agent observations of different sizes).
+    """
+    if isinstance(step, (list, tuple)) and len(step) > 0 and isinstance(step[0], np.ndarray):
+        shape = step[0].shape
+        if any(s.shape != shape for s in step):
+            return None
+    return np.asarray(step, dtype=np.float32)
+
+
+def stack_steps(steps):
+    """
+    Stacks the steps of a single episode into a `[T, *step_shape]` array.
+    Steps which only differ in shape by a reshape (e.g. a flattened final
+    state) are reshaped, the episode is cut at the first step which cannot be.
+    """
+    if isinstance(steps, np.ndarray) and steps.dtype != np.dtype("O"):
+        return steps.astype(np.float32, copy=False)
+    steps = list(steps)
+    if len(steps) == 0:
+        return np.zeros((0,), dtype=np.float32)
+    first = _step_array(steps[0])
+    if first is None:
+        return np.zeros((0,), dtype=np.float32)
+    arrays = [first]
+    for step in steps[1:]:
+        array = _step_array(step)
+        if array is None or array.size != first.size:
+            break
+        arrays.append(array.reshape(first.shape))
+    return np.stack(arrays, 0)
@@ -2,6 +2,7 @@ from collections import OrderedDict, deque
 
 import numpy as np
 
+from marlkit.data_management.bucket_sampler import make_sampler
 from marlkit.data_management.replay_buffer import (
     ReplayBuffer,
     MAReplayBuffer,
@@ -9,6 +10,11 @@ from marlkit.data_management.replay_buffer import (
 )
 
 
+def flatten_n(xs):
+    xs = np.asarray(xs)
+    return xs.reshape((xs.shape[0], -1))
+
+
 class SimpleReplayBuffer(ReplayBuffer):
     def __init__(
         self,
@@ -60,13 +66,71 @@ class SimpleReplayBuffer(ReplayBuffer):
         self._next_obs[self._top] = next_observation
         self._advance()
 
+    def add_path(self, path):
+        """
+        Writes the whole path into the buffer with (at most) two slice
+        assignments per field rather than going through `add_sample`.
+        """
+        self.add_paths([path])
+
+    def add_paths(self, paths):
+        if len(paths) == 0:
+            return
+        observations = np.concatenate([flatten_n(path["observations"]) for path in paths])
+        actions = np.concatenate([self._process_actions(path["actions"]) for path in paths])
+        rewards = np.concatenate([flatten_n(path["rewards"]) for path in paths])
+        terminals = np.concatenate([flatten_n(path["terminals"]) for path in paths])
+        next_obs = np.concatenate([flatten_n(path["next_observations"]) for path in paths])
+        env_infos = {
+            key: np.concatenate([flatten_n([info[key] for info in path["env_infos"]]) for path in paths])
+            for key in self._env_info_keys
+        }
+
+        for buffer_slice, path_slice in self._wrap_slices(len(rewards)):
+            self._observations[buffer_slice] = observations[path_slice]
+            self._actions[buffer_slice] = actions[path_slice]
+            self._rewards[buffer_slice] = rewards[path_slice]
+            self._terminals[buffer_slice] = terminals[path_slice]
+            self._next_obs[buffer_slice] = next_obs[path_slice]
+            for key in self._env_info_keys:
+                self._env_infos[key][buffer_slice] = env_infos[key][path_slice]
+        self._advance(len(rewards))
+
+        for _ in paths:
+            self.terminate_episode()
+
+    def _process_actions(self, actions):
+        """
+        Hook for subclasses which store actions differently to how they
+        are emitted by the rollout (e.g. one-hot encoding discrete actions)
+        """
+        return flatten_n(actions)
+
+    def _wrap_slices(self, num_steps):
+        """
+        Returns the (buffer slice, data slice) pairs needed to write
+        `num_steps` transitions starting at `self._top`, handling the
+        wrap around when the replay buffer gets full. If there are more
+        transitions than the buffer can hold only the latest ones are kept.
+        """
+        max_size = self._max_replay_buffer_size
+        skip = max(num_steps - max_size, 0)
+        top = (self._top + skip) % max_size
+        num_steps = num_steps - skip
+        num_pre_wrap_steps = min(num_steps, max_size - top)
+        num_post_wrap_steps = num_steps - num_pre_wrap_steps
+
+        slices = [(slice(top, top + num_pre_wrap_steps), slice(skip, skip + num_pre_wrap_steps))]
+        if num_post_wrap_steps > 0:
+            slices.append((slice(0, num_post_wrap_steps), slice(skip + num_pre_wrap_steps, skip + num_steps)))
+        return slices
+
     def terminate_episode(self):
         pass
 
-    def _advance(self):
-        self._top = (self._top + 1) % self._max_replay_buffer_size
-        if self._size < self._max_replay_buffer_size:
-            self._size += 1
+    def _advance(self, num_steps=1):
+        self._top = (self._top + num_steps) % self._max_replay_buffer_size
+        self._size = min(self._size + num_steps, self._max_replay_buffer_size)
 
     def random_batch(self, batch_size):
         indices = np.random.randint(0, self._size, batch_size)
@@ -201,13 +265,34 @@ class SimpleMAReplayBuffer(MAReplayBuffer):
         self._next_states_0.appendleft(next_states_0)
         self._advance()
 
+    def add_path(self, path):
+        """
+        Extends every field with the whole path at once rather than going
+        through `add_sample` one transition at a time.
+        """
+        num_steps = len(path["actions"])
+        self._observations.extendleft(path["observations"])
+        self._states.extendleft(path["states"])
+        self._states_0.extendleft(path["states_0"])
+        self._active_agents.extendleft(path["active_agents"])
+        self._actions.extendleft(path["actions"])
+        self._rewards.extendleft(path["rewards"])
+        self._terminals.extendleft(path["terminals"])
+        self._next_obs.extendleft(path["next_observations"])
+        self._next_states.extendleft(path["next_states"])
+        self._next_states_0.extendleft(path["next_states_0"])
+
+        for key in self._env_info_keys:
+            self._env_infos[key].extendleft(np.asarray([env_info[key] for env_info in path["env_infos"]]))
+        self._advance(num_steps)
+        self.terminate_episode()
+
     def terminate_episode(self):
         pass
 
-    def _advance(self):
-        self._top = (self._top + 1) % self._max_replay_buffer_size
-        if self._size < self._max_replay_buffer_size:
-            self._size += 1
+    def _advance(self, num_steps=1):
+        self._top = (self._top + num_steps) % self._max_replay_buffer_size
+        self._size = min(self._size + num_steps, self._max_replay_buffer_size)
 
     def random_batch(self, batch_size):
         """
@@ -264,7 +349,13 @@ class WholeMAReplayBuffer(FullMAReplayBuffer):
         state_dim,
         action_dim,
         env_info_sizes,
+        sampler=None,
+        length_bucket_width=None,
     ):
+        """
+        :param sampler: "uniform" or "bucket", see marlkit.data_management.bucket_sampler
+        :param length_bucket_width: length buckets of the "bucket" sampler
+        """
         self._observation_dim = observation_dim
         self._state_dim = state_dim
         self._action_dim = action_dim
@@ -304,6 +395,7 @@ class WholeMAReplayBuffer(FullMAReplayBuffer):
         for key, size in env_info_sizes.items():
             self._env_infos[key] = deque([], max_replay_buffer_size)
         self._env_info_keys = env_info_sizes.keys()
+        self._sampler = make_sampler(sampler, length_bucket_width)
 
         self._top = 0
         self._size = 0
@@ -324,6 +416,7 @@ class WholeMAReplayBuffer(FullMAReplayBuffer):
         env_info,
         **kwargs
     ):
+        self._add_to_sampler(observation, action)
         self._observations.appendleft(observation)
         self._states.appendleft(states)
         self._states_0.appendleft(states_0)
@@ -352,6 +445,7 @@ class WholeMAReplayBuffer(FullMAReplayBuffer):
         next_states_0,
         terminal,
     ):
+        self._add_to_sampler(observation, action)
         self._observations.appendleft(observation)
         self._states.appendleft(states)
         self._states_0.appendleft(states_0)
@@ -367,10 +461,17 @@ class WholeMAReplayBuffer(FullMAReplayBuffer):
     def terminate_episode(self):
         pass
 
-    def _advance(self):
-        self._top = (self._top + 1) % self._max_replay_buffer_size
-        if self._size < self._max_replay_buffer_size:
-            self._size += 1
+    def _add_to_sampler(self, observation, action):
+        if self._sampler is None:
+            return
+        # the deques drop their oldest episode once full
+        if self._size == self._max_replay_buffer_size:
+            self._sampler.evict_oldest()
+        self._sampler.add(len(observation[0]) if len(observation) > 0 else 0, len(action))
+
+    def _advance(self, num_steps=1):
+        self._top = (self._top + num_steps) % self._max_replay_buffer_size
+        self._size = min(self._size + num_steps, self._max_replay_buffer_size)
 
     def random_batch(self, batch_size):
         """
@@ -388,7 +489,11 @@ class WholeMAReplayBuffer(FullMAReplayBuffer):
         next_states_0,
         terminal,
         """
-        indices = np.random.randint(0, self._size, batch_size)
+        if self._sampler is None:
+            indices = np.random.randint(0, self._size, batch_size)
+        else:
+            # newest first
+            indices = self._size - 1 - self._sampler.sample(batch_size)
         batch = dict(
             observations=[self._observations[i] for i in indices],
             states=[self._states[i] for i in indices],
@@ -416,4 +521,7 @@ class WholeMAReplayBuffer(FullMAReplayBuffer):
         return self._size
 
     def get_diagnostics(self):
-        return OrderedDict([("size", self._size)])
+        diagnostics = OrderedDict([("size", self._size)])
+        if self._sampler is not None:
+            diagnostics.update(self._sampler.get_diagnostics())
+        return diagnostics
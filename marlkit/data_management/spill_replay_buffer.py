@@ -0,0 +1,268 @@
+"""
+Whole path multi-agent replay buffer whose capacity is a memory budget in
+bytes rather than a number of episodes.
+
+Every stored episode is accounted for by the actual size of its arrays.
+Once the resident episodes exceed `max_replay_buffer_bytes` the oldest ones
+are spilled to an on-disk segment store (or evicted, if no `spill_dir` is
+given) and are read back through memory mapping when they are sampled.
+
+Use it through the env buffer, e.g.
+
+    FullMAEnvReplayBuffer(max_replay_buffer_size, env, max_replay_buffer_bytes=2 * 1024 ** 3, spill_dir="/tmp")
+
+`max_replay_buffer_size` still bounds the total number of episodes.
+"""
+
+import os
+import shutil
+import tempfile
+import weakref
+from collections import OrderedDict, deque
+
+import numpy as np
+
+from marlkit.data_management.bucket_sampler import make_sampler
+from marlkit.data_management.path_builder import stack_steps
+from marlkit.data_management.replay_buffer import FullMAReplayBuffer
+
+
+class SegmentStore(object):
+    """
+    Append only store of episodes on disk. Episodes are written back to back
+    into segment files of about `segment_bytes` and read back as read only
+    memory mapped arrays. A segment file is removed once every episode in it
+    has been released, and the store directory once the store is closed or
+    garbage collected (or at exit).
+    """
+
+    def __init__(self, spill_dir, segment_bytes=64 * 1024 ** 2):
+        os.makedirs(spill_dir, exist_ok=True)
+        self.root = tempfile.mkdtemp(prefix="replay-segments-", dir=spill_dir)
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self.root, True)
+        self.segment_bytes = segment_bytes
+        self._segment_id = -1
+        self._segment_file = None
+        self._segment_size = 0
+        # segment_id -> [number of live episodes, np.memmap or None]
+        self._segments = {}
+        self.nbytes = 0
+
+    def _path(self, segment_id):
+        return os.path.join(self.root, "segment_{}.bin".format(segment_id))
+
+    def _roll_segment(self):
+        if self._segment_file is not None:
+            self._segment_file.close()
+            # released while it was still being written to
+            if self._segments[self._segment_id][0] == 0:
+                del self._segments[self._segment_id]
+                os.remove(self._path(self._segment_id))
+        self._segment_id += 1
+        self._segment_file = open(self._path(self._segment_id), "wb")
+        self._segment_size = 0
+        self._segments[self._segment_id] = [0, None]
+
+    def write(self, episode):
+        """
+        Returns the location of the episode, to be passed to `read` and `release`.
+        """
+        if self._segment_file is None or self._segment_size >= self.segment_bytes:
+            self._roll_segment()
+        layout = {}
+        for key, value in episode.items():
+            value = np.ascontiguousarray(value)
+            layout[key] = (self._segment_size, value.dtype.str, value.shape)
+            self._segment_file.write(value.tobytes())
+            self._segment_size += value.nbytes
+            self.nbytes += value.nbytes
+        self._segment_file.flush()
+        self._segments[self._segment_id][0] += 1
+        # the segment grew, so it needs to be mapped again
+        self._segments[self._segment_id][1] = None
+        return self._segment_id, layout
+
+    def read(self, location):
+        segment_id, layout = location
+        segment = self._segments[segment_id]
+        if segment[1] is None:
+            segment[1] = np.memmap(self._path(segment_id), dtype=np.uint8, mode="r")
+        episode = {}
+        for key, (offset, dtype, shape) in layout.items():
+            dtype = np.dtype(dtype)
+            count = int(np.prod(shape))
+            episode[key] = np.frombuffer(segment[1], dtype=dtype, count=count, offset=offset).reshape(shape)
+        return episode
+
+    def release(self, location):
+        segment_id, layout = location
+        for offset, dtype, shape in layout.values():
+            self.nbytes -= int(np.prod(shape)) * np.dtype(dtype).itemsize
+        segment = self._segments[segment_id]
+        segment[0] -= 1
+        if segment[0] == 0 and segment_id != self._segment_id:
+            del self._segments[segment_id]
+            os.remove(self._path(segment_id))
+
+    def close(self):
+        if self._segment_file is not None:
+            self._segment_file.close()
+            self._segment_file = None
+        self._segments = {}
+        self._finalizer()
+
+
+class BudgetWholeMAReplayBuffer(FullMAReplayBuffer):
+    def __init__(
+        self,
+        max_replay_buffer_size,
+        observation_dim,
+        state_dim,
+        action_dim,
+        env_info_sizes,
+        max_replay_buffer_bytes=None,
+        spill_dir=None,
+        max_spill_bytes=None,
+        segment_bytes=64 * 1024 ** 2,
+        sampler=None,
+        length_bucket_width=None,
+    ):
+        """
+        :param max_replay_buffer_size: maximum number of episodes
+        :param max_replay_buffer_bytes: memory budget for the resident episodes
+        :param spill_dir: directory for the segment store, episodes over the
+        budget are evicted if this is None
+        :param max_spill_bytes: optional budget for the spilled episodes
+        :param sampler: "uniform" or "bucket", see marlkit.data_management.bucket_sampler
+        :param length_bucket_width: length buckets of the "bucket" sampler
+        """
+        if max_replay_buffer_bytes is None:
+            raise ValueError("max_replay_buffer_bytes is needed for a memory budgeted replay buffer")
+        self._observation_dim = observation_dim
+        self._state_dim = state_dim
+        self._action_dim = action_dim
+        self._max_replay_buffer_size = max_replay_buffer_size
+        self._max_replay_buffer_bytes = max_replay_buffer_bytes
+        self._max_spill_bytes = max_spill_bytes
+        self._env_info_keys = list(env_info_sizes.keys())
+
+        # oldest first, the spilled episodes are always the oldest ones
+        self._spilled = deque()
+        self._resident = deque()
+        self._resident_bytes = 0
+        self._store = None if spill_dir is None else SegmentStore(spill_dir, segment_bytes)
+        self._num_evicted = 0
+        self._sampler = make_sampler(sampler, length_bucket_width)
+
+        self._top = 0
+        self._size = 0
+        self.full_path = True
+
+    def add_sample(
+        self,
+        observation,
+        states,
+        states_0,
+        active_agents,
+        action,
+        reward,
+        next_observation,
+        next_states,
+        next_states_0,
+        terminal,
+        env_info=None,
+        **kwargs
+    ):
+        path = dict(
+            observations=observation,
+            states=states,
+            states_0=states_0,
+            active_agents=active_agents,
+            actions=action,
+            rewards=reward,
+            terminals=terminal,
+            next_observations=next_observation,
+            next_states=next_states,
+            next_states_0=next_states_0,
+        )
+        episode = {key: stack_steps(value) for key, value in path.items()}
+        for key in self._env_info_keys:
+            episode[key] = stack_steps([info[key] for info in env_info])
+
+        nbytes = sum(value.nbytes for value in episode.values())
+        if self._sampler is not None:
+            observations = episode["observations"]
+            self._sampler.add(
+                observations.shape[1] if observations.ndim > 1 else 0, min(len(value) for value in episode.values())
+            )
+        self._resident.append((episode, nbytes))
+        self._resident_bytes += nbytes
+        self._size += 1
+
+        if self._size > self._max_replay_buffer_size:
+            self._evict_oldest()
+        while self._resident_bytes > self._max_replay_buffer_bytes and len(self._resident) > 1:
+            self._spill_oldest()
+
+    def _evict_oldest(self):
+        if len(self._spilled) > 0:
+            self._store.release(self._spilled.popleft())
+        else:
+            _, nbytes = self._resident.popleft()
+            self._resident_bytes -= nbytes
+        self._forget_oldest()
+
+    def _spill_oldest(self):
+        episode, nbytes = self._resident.popleft()
+        self._resident_bytes -= nbytes
+        if self._store is None:
+            self._forget_oldest()
+            return
+        self._spilled.append(self._store.write(episode))
+        if self._max_spill_bytes is not None:
+            while self._store.nbytes > self._max_spill_bytes and len(self._spilled) > 0:
+                self._store.release(self._spilled.popleft())
+                self._forget_oldest()
+
+    def _forget_oldest(self):
+        self._size -= 1
+        self._num_evicted += 1
+        if self._sampler is not None:
+            self._sampler.evict_oldest()
+
+    def terminate_episode(self):
+        pass
+
+    def _get_episode(self, index):
+        if index < len(self._spilled):
+            return self._store.read(self._spilled[index])
+        return self._resident[index - len(self._spilled)][0]
+
+    def random_batch(self, batch_size):
+        if self._sampler is None:
+            indices = np.random.randint(0, self._size, batch_size)
+        else:
+            # oldest first
+            indices = self._sampler.sample(batch_size)
+        episodes = [self._get_episode(i) for i in indices]
+        return {key: [episode[key] for episode in episodes] for key in episodes[0].keys()}
+
+    def num_steps_can_sample(self):
+        return self._size
+
+    def get_diagnostics(self):
+        return OrderedDict(
+            [
+                ("size", self._size),
+                ("resident episodes", len(self._resident)),
+                ("resident bytes", self._resident_bytes),
+                ("spilled episodes", len(self._spilled)),
+                ("spilled bytes", 0 if self._store is None else self._store.nbytes),
+                ("evicted episodes", self._num_evicted),
+            ]
+            + ([] if self._sampler is None else list(self._sampler.get_diagnostics().items()))
+        )
+
+    def close(self):
+        if self._store is not None:
+            self._store.close()
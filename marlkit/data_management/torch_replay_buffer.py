@@ -0,0 +1,353 @@
+"""
+Replay buffers which keep their fields as preallocated torch tensors.
+
+The numpy buffers hand `random_batch` to the trainer as numpy arrays, which
+are then copied again by `torch.from_numpy(...).float()`. Here every field is
+a float32 tensor in shared memory, `random_batch` gathers rows with
+`index_select` into reusable output tensors and the trainer receives float32
+tensors directly.
+
+Use these through the env buffers, e.g.
+
+    EnvReplayBuffer(max_replay_buffer_size, env, backend="torch")
+    FullMAEnvReplayBuffer(max_replay_buffer_size, env, backend="torch", max_path_length=...)
+
+NOTE: the tensors returned by `random_batch` are only valid until the
+buffer has been sampled `num_sample_buffers` more times, as the outputs are
+reused in a ring. Keep `num_sample_buffers` larger than the number of
+batches which are alive at once, `BatchPrefetcher` requires at least
+`num_prefetch_batches + 2`.
+
+The write cursor (and the length and step shapes of the stored paths) are
+in shared memory as well, so a buffer passed to worker processes (e.g. as a
+`torch.multiprocessing.Process` argument) can be written by them and
+sampled by the training process. Every writer and the sampler hold the
+buffer's multiprocessing `lock`, which `BatchPrefetcher` also uses:
+
+    with replay_buffer.lock:
+        replay_buffer.add_paths(paths)
+
+The "bucket" sampler of `TorchWholeMAReplayBuffer` only lives in the
+process which created the buffer, other processes can't add paths to it.
+"""
+
+import os
+from collections import OrderedDict
+
+import torch
+import torch.multiprocessing as mp
+
+import marlkit.torch.pytorch_util as ptu
+from marlkit.data_management.bucket_sampler import make_sampler
+from marlkit.data_management.path_builder import stack_steps
+from marlkit.data_management.replay_buffer import FullMAReplayBuffer
+from marlkit.data_management.simple_replay_buffer import SimpleReplayBuffer
+from marlkit.torch.episode_batch import EpisodeBatch
+
+
+def shared_zeros(shape):
+    return torch.zeros(shape, dtype=torch.float32).share_memory_()
+
+
+class _SampleBuffers(object):
+    """
+    A ring of reusable output tensors for `random_batch`.
+    """
+
+    def __init__(self, num_sample_buffers):
+        self._num_sample_buffers = num_sample_buffers
+        self._buffers = []
+        self._batch_size = None
+        self._next = 0
+
+    def next(self, batch_size, shapes):
+        if batch_size != self._batch_size:
+            self._batch_size = batch_size
+            self._buffers = [
+                dict(
+                    indices=torch.empty(batch_size, dtype=torch.long),
+                    **{key: torch.empty((batch_size,) + shape, dtype=torch.float32) for key, shape in shapes.items()}
+                )
+                for _ in range(self._num_sample_buffers)
+            ]
+        buffers = self._buffers[self._next]
+        self._next = (self._next + 1) % self._num_sample_buffers
+        return buffers
+
+
+class _SharedCursor(object):
+    """
+    `_top` and `_size` of a buffer, kept in a shared tensor with the `lock`
+    which guards them.
+    """
+
+    def _init_cursor(self):
+        self._cursor = torch.zeros(2, dtype=torch.long).share_memory_()
+        # a spawn lock can be passed to spawned processes, and forked ones inherit it
+        self.lock = mp.get_context("spawn").Lock()
+
+    @property
+    def _top(self):
+        return int(self._cursor[0])
+
+    @_top.setter
+    def _top(self, top):
+        self._cursor[0] = top
+
+    @property
+    def _size(self):
+        return int(self._cursor[1])
+
+    @_size.setter
+    def _size(self, size):
+        self._cursor[1] = size
+
+
+class TorchReplayBuffer(_SharedCursor, SimpleReplayBuffer):
+    def __init__(
+        self,
+        max_replay_buffer_size,
+        observation_dim,
+        action_dim,
+        env_info_sizes,
+        num_sample_buffers=4,
+    ):
+        self._observation_dim = observation_dim
+        self._action_dim = action_dim
+        self._max_replay_buffer_size = max_replay_buffer_size
+
+        self._tensors = OrderedDict(
+            observations=shared_zeros((max_replay_buffer_size, observation_dim)),
+            actions=shared_zeros((max_replay_buffer_size, action_dim)),
+            rewards=shared_zeros((max_replay_buffer_size, 1)),
+            terminals=shared_zeros((max_replay_buffer_size, 1)),
+            next_observations=shared_zeros((max_replay_buffer_size, observation_dim)),
+        )
+        for key, size in env_info_sizes.items():
+            assert key not in self._tensors
+            self._tensors[key] = shared_zeros((max_replay_buffer_size, size))
+        self._env_info_keys = list(env_info_sizes.keys())
+
+        # the numpy fields are views of the shared tensors, so every write
+        # path of SimpleReplayBuffer (add_sample, add_paths) writes to them
+        self._observations = self._tensors["observations"].numpy()
+        self._actions = self._tensors["actions"].numpy()
+        self._rewards = self._tensors["rewards"].numpy()
+        self._terminals = self._tensors["terminals"].numpy()
+        self._next_obs = self._tensors["next_observations"].numpy()
+        self._env_infos = {key: self._tensors[key].numpy() for key in self._env_info_keys}
+
+        self.num_sample_buffers = num_sample_buffers
+        self._sample_buffers = _SampleBuffers(num_sample_buffers)
+        self._init_cursor()
+
+    def random_batch(self, batch_size):
+        out = self._sample_buffers.next(
+            batch_size, {key: tuple(value.shape[1:]) for key, value in self._tensors.items()}
+        )
+        indices = out["indices"].random_(0, self._size)
+        batch = dict()
+        for key, value in self._tensors.items():
+            batch[key] = torch.index_select(value, 0, indices, out=out[key])
+        return batch
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # the numpy views are rebuilt from the tensors
+        for key in ["_observations", "_actions", "_rewards", "_terminals", "_next_obs", "_env_infos"]:
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._observations = self._tensors["observations"].numpy()
+        self._actions = self._tensors["actions"].numpy()
+        self._rewards = self._tensors["rewards"].numpy()
+        self._terminals = self._tensors["terminals"].numpy()
+        self._next_obs = self._tensors["next_observations"].numpy()
+        self._env_infos = {key: self._tensors[key].numpy() for key in self._env_info_keys}
+
+
+class TorchWholeMAReplayBuffer(_SharedCursor, FullMAReplayBuffer):
+    """
+    Whole path multi-agent buffer. Each path is stored padded to
+    `[max_path_length, *step_shape]` (with the agent dimensions padded to
+    `max_num_agents`), and `random_batch` returns an `EpisodeBatch` trimmed
+    to the longest path and largest agent count in the batch, so it holds
+    exactly what `EpisodeBatch.from_random_batch` would have built from the
+    numpy `WholeMAReplayBuffer`.
+    """
+
+    def __init__(
+        self,
+        max_replay_buffer_size,
+        observation_dim,
+        state_dim,
+        action_dim,
+        env_info_sizes,
+        max_path_length=None,
+        max_num_agents=None,
+        num_sample_buffers=4,
+        sampler=None,
+        length_bucket_width=None,
+    ):
+        """
+        :param sampler: "uniform" or "bucket", see marlkit.data_management.bucket_sampler
+        :param length_bucket_width: length buckets of the "bucket" sampler
+        """
+        if max_path_length is None or max_num_agents is None:
+            raise ValueError("max_path_length and max_num_agents are needed to preallocate the torch replay buffer")
+        self._observation_dim = observation_dim
+        self._state_dim = state_dim
+        self._action_dim = action_dim
+        self._max_replay_buffer_size = max_replay_buffer_size
+        self._max_path_length = max_path_length
+        self._max_num_agents = max_num_agents
+
+        N = max_num_agents
+        step_shapes = OrderedDict(
+            observations=(N, observation_dim),
+            states=(1, state_dim),
+            states_0=(1, state_dim),
+            active_agents=(1, N),
+            actions=(N, action_dim),
+            rewards=(1, N),
+            terminals=(1, N),
+            next_observations=(N, observation_dim),
+            next_states=(1, state_dim),
+            next_states_0=(1, state_dim),
+        )
+        for key, size in env_info_sizes.items():
+            assert key not in step_shapes
+            step_shapes[key] = (size,)
+        self._env_info_keys = list(env_info_sizes.keys())
+
+        self._tensors = OrderedDict(
+            (key, shared_zeros((max_replay_buffer_size, max_path_length) + shape)) for key, shape in step_shapes.items()
+        )
+        # unpadded length and per step shape of every stored path, the numpy
+        # fields are views of them
+        self._path_tensors = OrderedDict(
+            lengths=torch.zeros(max_replay_buffer_size, dtype=torch.long).share_memory_(),
+            **{
+                key: torch.zeros((max_replay_buffer_size, len(shape)), dtype=torch.long).share_memory_()
+                for key, shape in step_shapes.items()
+            }
+        )
+        self._set_path_views()
+
+        self.num_sample_buffers = num_sample_buffers
+        self._sample_buffers = _SampleBuffers(num_sample_buffers)
+        self._sampler = make_sampler(sampler, length_bucket_width)
+        self._sampler_pid = os.getpid()
+        self._init_cursor()
+        self.full_path = True
+
+    def _set_path_views(self):
+        self._lengths = self._path_tensors["lengths"].numpy()
+        self._step_shapes = {key: self._path_tensors[key].numpy() for key in self._tensors}
+
+    def add_sample(
+        self,
+        observation,
+        states,
+        states_0,
+        active_agents,
+        action,
+        reward,
+        next_observation,
+        next_states,
+        next_states_0,
+        terminal,
+        env_info=None,
+        **kwargs
+    ):
+        path = dict(
+            observations=observation,
+            states=states,
+            states_0=states_0,
+            active_agents=active_agents,
+            actions=action,
+            rewards=reward,
+            terminals=terminal,
+            next_observations=next_observation,
+            next_states=next_states,
+            next_states_0=next_states_0,
+        )
+        for key in self._env_info_keys:
+            path[key] = [info[key] for info in env_info]
+        if self._sampler is not None and os.getpid() != self._sampler_pid:
+            raise RuntimeError("the bucket sampler is local to the process which created the buffer")
+
+        steps = {key: stack_steps(value) for key, value in path.items()}
+        length = min(len(value) for value in steps.values())
+        if length > self._max_path_length:
+            raise ValueError("path of length {} is longer than max_path_length".format(length))
+
+        for key, value in steps.items():
+            shape = value.shape[1:]
+            self._tensors[key][self._top].zero_()
+            self._tensors[key][self._top][(slice(0, length),) + tuple(slice(0, d) for d in shape)] = torch.from_numpy(
+                value[:length]
+            )
+            self._step_shapes[key][self._top] = shape if len(shape) else 0
+        self._lengths[self._top] = length
+        if self._sampler is not None:
+            # the oldest path is overwritten once full
+            if self._size == self._max_replay_buffer_size:
+                self._sampler.evict_oldest()
+            self._sampler.add(self._step_shapes["observations"][self._top][0], length)
+        self._advance()
+
+    def terminate_episode(self):
+        pass
+
+    def _advance(self, num_steps=1):
+        self._top = (self._top + num_steps) % self._max_replay_buffer_size
+        self._size = min(self._size + num_steps, self._max_replay_buffer_size)
+
+    def random_batch(self, batch_size):
+        out = self._sample_buffers.next(
+            batch_size, {key: tuple(value.shape[1:]) for key, value in self._tensors.items()}
+        )
+        if self._sampler is None:
+            indices = out["indices"].random_(0, self._size)
+        else:
+            # oldest first
+            slots = (self._top - self._size + self._sampler.sample(batch_size)) % self._max_replay_buffer_size
+            indices = out["indices"].copy_(torch.from_numpy(slots))
+        np_indices = indices.numpy()
+        lengths = self._lengths[np_indices]
+        max_length = int(lengths.max())
+
+        data = {}
+        step_shapes = {}
+        for key, value in self._tensors.items():
+            torch.index_select(value, 0, indices, out=out[key])
+            shapes = self._step_shapes[key][np_indices]
+            max_shape = shapes.max(0)
+            data[key] = out[key][(slice(None), slice(0, max_length)) + tuple(slice(0, d) for d in max_shape)]
+            if ptu.device is not None:
+                data[key] = data[key].to(ptu.device)
+            step_shapes[key] = [tuple(shape) for shape in shapes]
+        return EpisodeBatch(data, lengths, step_shapes)
+
+    def num_steps_can_sample(self):
+        return self._size
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # the numpy views are rebuilt from the tensors
+        del state["_lengths"]
+        del state["_step_shapes"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._set_path_views()
+
+    def get_diagnostics(self):
+        diagnostics = OrderedDict([("size", self._size)])
+        if self._sampler is not None:
+            diagnostics.update(self._sampler.get_diagnostics())
+        return diagnostics
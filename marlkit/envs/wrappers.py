@@ -175,6 +175,106 @@ class NormalizedBoxEnv(ProxyEnv):
         return "Normalized: %s" % self._wrapped_env
 
 
+def _area_matrix(n_in, n_out):
+    """
+    `[n_out, n_in]` matrix averaging the input cells covered by every output cell
+    """
+    edges = np.arange(n_out + 1) * (n_in / n_out)
+    lo = np.maximum(edges[:-1, None], np.arange(n_in)[None, :])
+    hi = np.minimum(edges[1:, None], np.arange(n_in)[None, :] + 1)
+    return (np.clip(hi - lo, 0, None) * (n_out / n_in)).astype(np.float32)
+
+
+class PixelObsWrapper(ProxyEnv):
+    """
+    The pixel preprocessing of a parallel (petting zoo) env in a single pass,
+    the equivalent of the supersuit chain
+
+        flatten_v0(normalize_obs_v0(dtype_v0(pad_observations_v0(resize_v0(color_reduction_v0(env))), np.float32)))
+
+    Every frame is converted to gray, resized to `size x size`, normalized to
+    [0, 1] and flattened into its row of a preallocated
+    `[len(possible_agents), size * size]` buffer. The (default) area resize
+    averages the gray frame with separable area matrices and truncates the
+    gray levels, as `resize_v0` does. With `mode="nearest"` only the sampled
+    pixels are read, through an index map computed once per frame shape, which
+    is faster but not the supersuit pipeline. All of the agents are resized to
+    the same size, so there is nothing left to pad.
+
+    With `dtype=np.uint8` the gray levels are kept as they are (and the
+    observation space is [0, 255]), to be normalized at batch time.
+
+    The observations returned are views of the buffer, which is overwritten on
+    the next step, so copy them to keep them around (`MultiAgentEnv` does).
+    """
+
+    GRAYSCALE_WEIGHTS = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+    def __init__(self, env, size=32, mode="area", dtype=np.float32):
+        if mode not in ("nearest", "area"):
+            raise ValueError("unknown resize mode {}".format(mode))
+        ProxyEnv.__init__(self, env)
+        self.size = size
+        self.mode = mode
+        self.dtype = np.dtype(dtype)
+        self.possible_agents = env.possible_agents
+        self._agent_index = {agent: idx for idx, agent in enumerate(self.possible_agents)}
+        self._buffer = np.zeros((len(self.possible_agents), size * size), dtype=self.dtype)
+        # frame shape -> index / area maps
+        self._maps = {}
+        if self.dtype == np.uint8:
+            space = Box(low=0, high=255, shape=(size * size,), dtype=np.uint8)
+        else:
+            space = Box(low=0.0, high=1.0, shape=(size * size,), dtype=self.dtype)
+        self.observation_spaces = {agent: space for agent in self.possible_agents}
+
+    def _resize_map(self, shape):
+        if shape not in self._maps:
+            height, width = shape[:2]
+            if self.mode == "nearest":
+                rows = np.minimum(np.arange(self.size) * height // self.size, height - 1)
+                cols = np.minimum(np.arange(self.size) * width // self.size, width - 1)
+                self._maps[shape] = (rows[:, None] * width + cols[None, :]).ravel()
+            else:
+                self._maps[shape] = (_area_matrix(height, self.size), _area_matrix(width, self.size).T)
+        return self._maps[shape]
+
+    def _gray(self, pixels):
+        # as color_reduction_v0, the gray levels are truncated to uint8
+        if pixels.shape[-1] == 3 and pixels.ndim > 1:
+            pixels = pixels.astype(np.float32) @ self.GRAYSCALE_WEIGHTS
+        else:
+            pixels = pixels.astype(np.float32)
+        return np.floor(pixels, out=pixels)
+
+    def process(self, frame, out):
+        frame = np.asarray(frame)
+        resize_map = self._resize_map(frame.shape)
+        if self.mode == "nearest":
+            pixels = frame.reshape((frame.shape[0] * frame.shape[1],) + frame.shape[2:])
+            gray = self._gray(pixels.take(resize_map, axis=0))
+        else:
+            rows, cols = resize_map
+            # as resize_v0 the averages are truncated to uint8, the tolerance
+            # keeps float error from truncating e.g. 255 to 254
+            gray = np.floor(rows @ self._gray(frame) @ cols + 1e-3).ravel()
+        if self.dtype == np.uint8:
+            out[:] = gray
+        else:
+            np.divide(gray, 255.0, out=out, casting="unsafe")
+        return out
+
+    def observation(self, obs):
+        return {agent: self.process(frame, self._buffer[self._agent_index[agent]]) for agent, frame in obs.items()}
+
+    def reset(self, **kwargs):
+        return self.observation(self._wrapped_env.reset(**kwargs))
+
+    def step(self, action):
+        next_obs, reward, done, info = self._wrapped_env.step(action)
+        return self.observation(next_obs), reward, done, info
+
+
 class MultiAgentEnv(ProxyEnv):
     """
     This changes the dict items in parallel environments
@@ -352,7 +452,8 @@ class MultiAgentEnv(ProxyEnv):
         return rewards
 
     def multi_done(self, done):
-        done = [done.get(ag, 1) for idx, ag in enumerate(self._wrapped_env.possible_agents)]
+        # the custom envs (forage, rware, prison) only report "__all__"
+        done = [done.get(ag, done.get("__all__", 1)) for idx, ag in enumerate(self._wrapped_env.possible_agents)]
         if self.rllib:
             done = {"__all__": all(done)}
         return done
@@ -38,6 +38,9 @@ class PolicyWrappedWithExplorationStrategy(ExplorationPolicy):
     def set_num_steps_total(self, t):
         self.t = t
 
+    def compile_inference(self, freeze=False):
+        self.policy.compile_inference(freeze=freeze)
+
     def get_action(self, *args, **kwargs):
         return self.es.get_action(self.t, self.policy, *args, **kwargs)
 
@@ -8,6 +8,7 @@ import torch
 
 import marlkit.torch.pytorch_util as ptu
 from marlkit.policies.base import Policy
+from marlkit.torch.inference import ArgmaxHead, InferenceGraph
 
 
 class ArgmaxDiscretePolicy(nn.Module, Policy):
@@ -24,13 +25,27 @@ class ArgmaxDiscretePolicy(nn.Module, Policy):
 
 
 class MAArgmaxDiscretePolicy(nn.Module, Policy):
-    def __init__(self, qf):
+    # compiled inference graph, None for the eager forward
+    _greedy_graph = None
+
+    def __init__(self, qf, compile_inference=False):
+        """
+        :param compile_inference: run the greedy action through a traced
+        graph, see `marlkit.torch.inference`
+        """
         super().__init__()
         self.qf = qf
+        if compile_inference:
+            self.compile_inference()
+
+    def compile_inference(self, freeze=False):
+        self._greedy_graph = InferenceGraph(ArgmaxHead(self.qf), freeze=freeze)
 
     def get_action_(self, obs):
         obs = np.expand_dims(obs, axis=0)
         obs = ptu.from_numpy(obs).float()
+        if self._greedy_graph is not None:
+            return ptu.get_numpy(self._greedy_graph(obs))[0], {}
         q_values = self.qf(obs).squeeze(0)
         q_values_np = ptu.get_numpy(q_values)
         return q_values_np.argmax(), {}
@@ -60,18 +75,32 @@ class MAArgmaxDiscretePolicy(nn.Module, Policy):
                 actions.append(self.get_action_(obs_dict["obs"])[0])
             return actions, {}
         else:
-            obs = np.expand_dims(obs, axis=0)
-            obs = ptu.from_numpy(obs).float()
-            q_values = self.qf(obs).squeeze(0)
-            q_values_np = ptu.get_numpy(q_values)
-            return q_values_np.argmax(), {}
+            return self.get_action_(obs)
 
 
 class Discretify(nn.Module, Policy):
-    def __init__(self, policy, hard=True):
+    # compiled inference graph, None for the eager forward
+    _policy_graph = None
+
+    def __init__(self, policy, hard=True, compile_inference=False):
+        """
+        :param compile_inference: run the policy network through a traced
+        graph, the gumbel softmax sampling stays eager so that the random
+        draws are unchanged
+        """
         super().__init__()
         self.policy = policy
         self.hard = hard
+        if compile_inference:
+            self.compile_inference()
+
+    def compile_inference(self, freeze=False):
+        self._policy_graph = InferenceGraph(self.policy, freeze=freeze)
+
+    def _logits(self, obs):
+        if self._policy_graph is not None:
+            return self._policy_graph(obs)
+        return self.policy(obs)
 
     def get_log_proba(self, obs):
         # gets approximate log proba for munchausen RL
@@ -82,7 +111,7 @@ class Discretify(nn.Module, Policy):
         else:
             obs = np.expand_dims(obs, axis=0)
             obs = ptu.from_numpy(obs).float()
-        output = self.policy(obs).squeeze(0)
+        output = self._logits(obs).squeeze(0)
         output = F.softmax(output)
         return output
 
@@ -94,7 +123,7 @@ class Discretify(nn.Module, Policy):
         else:
             obs = np.expand_dims(obs, axis=0)
             obs = ptu.from_numpy(obs).float()
-        output = self.policy(obs).squeeze(0)
+        output = self._logits(obs).squeeze(0)
         output = F.gumbel_softmax(output, hard=self.hard)
         output_np = ptu.get_numpy(output)
         return output_np.argmax(-1), {}
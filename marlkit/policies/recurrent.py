@@ -7,17 +7,30 @@ from torch import nn
 
 import marlkit.torch.pytorch_util as ptu
 from marlkit.policies.base import Policy
+from marlkit.torch.inference import InferenceGraph
 from torch.nn import functional as F
 from torch.distributions import Categorical
 
 
 class RecurrentPolicy(nn.Module, Policy):
-    def __init__(self, qf, use_gumbel_softmax=False, eval_policy=False):
+    # compiled inference graph, None for the eager forward
+    _qf_graph = None
+
+    def __init__(self, qf, use_gumbel_softmax=False, eval_policy=False, compile_inference=False):
+        """
+        :param compile_inference: run the recurrent network through a traced
+        graph, see `marlkit.torch.inference`
+        """
         super().__init__()
         self.qf = qf
         self.hidden_states = None
         self.use_gumbel_softmax = use_gumbel_softmax
         self.eval_policy = eval_policy
+        if compile_inference:
+            self.compile_inference()
+
+    def compile_inference(self, freeze=False):
+        self._qf_graph = InferenceGraph(self.qf, freeze=freeze)
 
     def reset(self):
         self.hidden_states = None
@@ -29,10 +42,11 @@ class RecurrentPolicy(nn.Module, Policy):
     def get_action_(self, obs, agent_indx=None):
         obs = np.expand_dims(obs, axis=0)
         obs = ptu.from_numpy(obs).float()
+        qf = self.qf if self._qf_graph is None else self._qf_graph
         if agent_indx is None:
-            q_values, hidden = self.qf(obs, self.hidden_states)
+            q_values, hidden = qf(obs, self.hidden_states)
         else:
-            q_values, hidden = self.qf(obs, self.hidden_states[agent_indx])
+            q_values, hidden = qf(obs, self.hidden_states[agent_indx])
         #
         if self.use_gumbel_softmax and self.eval_policy:
             act_proba = F.gumbel_softmax(q_values, hard=True)
@@ -1,9 +1,13 @@
 """
 The equivalent of the multi-agent controller in pymarl.
 """
+import random
 from collections import deque, OrderedDict
+from contextlib import contextmanager
 
-from marlkit.core.eval_util import create_stats_ordered_dict
+import torch
+
+from marlkit.core.eval_util import MultiAgentPathStatistics, RunningStat, team_rewards
 from marlkit.samplers.rollout_functions import (
     marl_rollout,
     multitask_rollout,
@@ -13,11 +17,42 @@ from marlkit.samplers.data_collector.base import PathCollector
 import numpy as np
 
 
+@contextmanager
+def common_random_numbers(env, seed):
+    """
+    Seeds the global random streams (and the wrapped env, if it can be
+    seeded) for one episode, so that the same `seed` gives the same
+    episode randomness to every policy, and restores the global streams
+    afterwards.
+    """
+    states = random.getstate(), np.random.get_state(), torch.get_rng_state()
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    wrapped_env = getattr(env, "_wrapped_env", None)
+    if hasattr(wrapped_env, "seed"):
+        try:
+            wrapped_env.seed(seed)
+        except:
+            pass
+    try:
+        yield
+    finally:
+        random.setstate(states[0])
+        np.random.set_state(states[1])
+        torch.set_rng_state(states[2])
+
+
 class MdpPathCollector(PathCollector):
     """
     The challenge with the path collector is that the number of agents
     for each path might be different. If its blank, either it can't be stored
     or it needs to be excluded at training time in the get.
+
+    The epoch statistics (returns, lengths, per agent returns, infos) are
+    accumulated as every path finishes, see `get_epoch_statistics`. The
+    paths themselves are only kept for the epoch (e.g. for videos or
+    debugging) with `save_epoch_paths=True`, up to `max_num_epoch_paths_saved`.
     """
 
     def __init__(
@@ -26,6 +61,7 @@ class MdpPathCollector(PathCollector):
         policy,
         mixer=None,
         max_num_epoch_paths_saved=None,
+        save_epoch_paths=False,
         render=False,
         sparse_reward=False,
         render_kwargs=None,
@@ -37,13 +73,17 @@ class MdpPathCollector(PathCollector):
         # should NOT be used if in "eval" - only expl.
         self._mixer = None  # for qmix, maven and variations
         self._max_num_epoch_paths_saved = max_num_epoch_paths_saved
+        self._save_epoch_paths = save_epoch_paths
         self._epoch_paths = deque(maxlen=self._max_num_epoch_paths_saved)
+        self._epoch_statistics = MultiAgentPathStatistics()
         self._render = render
         self._render_kwargs = render_kwargs
 
         self._num_steps_total = 0
         self._num_paths_total = 0
         self._sparse_reward = sparse_reward
+        # how the last adaptive evaluation ended, see collect_adaptive_paths
+        self._adaptive_diagnostics = None
 
     def update_policy(self, new_policy):
         self._policy = new_policy
@@ -68,51 +108,111 @@ class MdpPathCollector(PathCollector):
             )
             # print("path_actions", path["actions"])
             path_len = path["actions"].shape[0]
-            terminal = (
-                all(np.array(path["terminals"][-1]).flatten().tolist())
-                if type(path["terminals"][-1]) is not bool
-                else path["terminals"][-1]
-            )
-            if path_len != max_path_length and not terminal and discard_incomplete_paths:
+            if not self._is_complete(path, max_path_length) and discard_incomplete_paths:
                 break
             num_steps_collected += path_len
+            paths.append(self._add_path(path))
+        self._num_paths_total += len(paths)
+        self._num_steps_total += num_steps_collected
+        return paths
 
-            ## Used to sparsify reward
-            if self._sparse_reward:
-                random_noise = np.random.normal(size=path["rewards"].shape)
-                path["rewards"] = path["rewards"] + 1.0 * random_noise
-                # bins = np.array([-10, -0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10])
-                # temp_rewards = np.cast(path['rewards']/2.0, )
-                # temp_rewards = (path['rewards'] > 1.0)
-                # path['rewards'] = temp_rewards.astype(np.float32)
+    def collect_adaptive_paths(
+        self,
+        max_path_length,
+        ci_width,
+        min_num_paths=5,
+        max_num_paths=100,
+        confidence=0.95,
+        discard_incomplete_paths=True,
+        seed=None,
+    ):
+        """
+        Collects paths until the confidence interval of the mean (team) return
+        is narrower than `ci_width`, with at least `min_num_paths` and at most
+        `max_num_paths` paths, rather than a fixed number of steps. The number
+        of paths used is reported by `get_diagnostics`.
 
-            paths.append(path)
+        :param ci_width: target (full) width of the confidence interval
+        :param seed: use common random numbers, the i-th path is played with
+        the random streams seeded with `seed + i`, so that policies (e.g. the
+        checkpoints of a run) are compared on the same episodes
+        """
+        paths = []
+        returns = RunningStat()
+        num_steps_collected = 0
+        for i in range(max_num_paths):
+            if seed is None:
+                path = marl_rollout(self._env, self._policy, max_path_length=max_path_length)
+            else:
+                with common_random_numbers(self._env, seed + i):
+                    path = marl_rollout(self._env, self._policy, max_path_length=max_path_length)
+            # incomplete paths still count towards max_num_paths
+            if not self._is_complete(path, max_path_length) and discard_incomplete_paths:
+                continue
+            num_steps_collected += path["actions"].shape[0]
+            paths.append(self._add_path(path))
+            returns.update(team_rewards(path).sum())
+            if len(paths) >= min_num_paths and 2 * returns.confidence_interval(confidence) <= ci_width:
+                break
         self._num_paths_total += len(paths)
         self._num_steps_total += num_steps_collected
-        self._epoch_paths.extend(paths)
+        self._adaptive_diagnostics = OrderedDict(
+            [
+                ("adaptive num paths", len(paths)),
+                ("adaptive num steps", num_steps_collected),
+                ("adaptive return CI width", 2 * returns.confidence_interval(confidence)),
+                ("adaptive converged", int(2 * returns.confidence_interval(confidence) <= ci_width)),
+            ]
+        )
         return paths
 
+    def _is_complete(self, path, max_path_length):
+        terminal = (
+            all(np.array(path["terminals"][-1]).flatten().tolist())
+            if type(path["terminals"][-1]) is not bool
+            else path["terminals"][-1]
+        )
+        return path["actions"].shape[0] == max_path_length or terminal
+
+    def _add_path(self, path):
+        ## Used to sparsify reward
+        if self._sparse_reward:
+            random_noise = np.random.normal(size=path["rewards"].shape)
+            path["rewards"] = path["rewards"] + 1.0 * random_noise
+            # bins = np.array([-10, -0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10])
+            # temp_rewards = np.cast(path['rewards']/2.0, )
+            # temp_rewards = (path['rewards'] > 1.0)
+            # path['rewards'] = temp_rewards.astype(np.float32)
+
+        self._epoch_statistics.add_path(path)
+        if self._save_epoch_paths:
+            self._epoch_paths.append(path)
+        return path
+
     def get_epoch_paths(self):
+        """
+        The paths of the epoch, empty unless `save_epoch_paths`
+        """
         return self._epoch_paths
 
+    def get_epoch_statistics(self):
+        return self._epoch_statistics
+
     def end_epoch(self, epoch):
         self._epoch_paths = deque(maxlen=self._max_num_epoch_paths_saved)
+        self._epoch_statistics = MultiAgentPathStatistics()
+        self._adaptive_diagnostics = None
 
     def get_diagnostics(self):
-        path_lens = [len(path["actions"]) for path in self._epoch_paths]
         stats = OrderedDict(
             [
                 ("num steps total", self._num_steps_total),
                 ("num paths total", self._num_paths_total),
             ]
         )
-        stats.update(
-            create_stats_ordered_dict(
-                "path length",
-                path_lens,
-                always_show_all_stats=True,
-            )
-        )
+        stats.update(self._epoch_statistics.lengths.get_statistics("path length"))
+        if self._adaptive_diagnostics is not None:
+            stats.update(self._adaptive_diagnostics)
         return stats
 
     def get_snapshot(self):
@@ -39,12 +39,17 @@ def np_ify(tensor_or_other):
 def _elem_or_tuple_to_variable(elem_or_tuple):
     if isinstance(elem_or_tuple, tuple):
         return tuple(_elem_or_tuple_to_variable(e) for e in elem_or_tuple)
+    if isinstance(elem_or_tuple, torch.Tensor):
+        # already sampled as float tensors (e.g. TorchReplayBuffer)
+        return elem_or_tuple.to(ptu.device)
     return ptu.from_numpy(elem_or_tuple).float()
 
 
 def _filter_batch(np_batch):
     for k, v in np_batch.items():
-        if v.dtype == np.bool:
+        if isinstance(v, torch.Tensor):
+            yield k, v
+        elif v.dtype == np.bool:
             yield k, v.astype(int)
         else:
             yield k, v
@@ -56,3 +61,39 @@ def np_to_pytorch_batch(np_batch):
         for k, x in _filter_batch(np_batch)
         if x.dtype != np.dtype("O")  # ignore object (e.g. dictionaries)
     }
+
+
+def _split_time(output, dim, first, second):
+    if isinstance(output, tuple):
+        return tuple(zip(*(_split_time(x, dim, first, second) for x in output)))
+    return output.narrow(dim, *first), output.narrow(dim, *second)
+
+
+def eval_obs_next_obs(module, obs, next_obs, dim=0, **kwargs):
+    """
+    Evaluates `module` on `obs` and `next_obs` in a single forward pass.
+
+    Along a whole episode `next_obs` is `obs` shifted by one step plus the
+    final observation, in which case only that `T + 1` sequence is
+    evaluated. Otherwise `obs` and `next_obs` are concatenated along `dim`,
+    or evaluated separately if they don't even share the other dimensions
+    (e.g. the number of agents changed at the final step).
+
+    `module` must act on every step independently (e.g. an `Mlp`), not a
+    recurrent network.
+
+    :return: `(module(obs), module(next_obs))`, for a module which returns a
+    tuple these are the tuples of outputs on `obs` and on `next_obs`
+    """
+    T = obs.shape[dim]
+    other_dims = [d for d in range(obs.dim()) if d != dim % obs.dim()]
+    if obs.dim() != next_obs.dim() or any(obs.shape[d] != next_obs.shape[d] for d in other_dims):
+        return module(obs, **kwargs), module(next_obs, **kwargs)
+
+    if T > 0 and obs.shape == next_obs.shape and torch.equal(obs.narrow(dim, 1, T - 1), next_obs.narrow(dim, 0, T - 1)):
+        inputs = torch.cat([obs, next_obs.narrow(dim, T - 1, 1)], dim)
+        first, second = (0, T), (1, T)
+    else:
+        inputs = torch.cat([obs, next_obs], dim)
+        first, second = (0, T), (T, next_obs.shape[dim])
+    return _split_time(module(inputs, **kwargs), dim, first, second)
@@ -1,3 +1,6 @@
+import queue
+import threading
+
 import numpy as np
 import torch
 from torch.utils.data import Dataset, Sampler
@@ -73,3 +76,123 @@ class InfiniteWeightedRandomSampler(Sampler):
 
     def __len__(self):
         return 2 ** 62
+
+
+class BatchPrefetcher(object):
+    """
+    Samples and collates training batches in a background thread so that
+    the trainer never waits on `random_batch` or the numpy -> torch
+    conversion. Up to `num_prefetch_batches` ready batches are kept in a
+    bounded queue.
+
+    Writes to the replay buffer which happen while the prefetcher is
+    running (e.g. during online training) must hold `buffer_lock`, which
+    the background thread also holds while it samples. It is the `lock` of
+    the replay buffer if it has one (the torch replay buffers):
+
+        with prefetcher.buffer_lock:
+            replay_buffer.add_paths(paths)
+
+    Batches already in the queue were sampled before the write, so at most
+    `num_prefetch_batches` train steps see slightly stale data. Until the
+    replay buffer holds some data, the background thread waits (without
+    holding `buffer_lock`) rather than sampling.
+
+    The torch replay buffers return views of a ring of `num_sample_buffers`
+    output tensors, which has to outlive the queued batches, the batch being
+    sampled and the one being trained on.
+    """
+
+    def __init__(
+        self,
+        replay_buffer,
+        batch_size,
+        collate_fn=None,
+        num_prefetch_batches=2,
+        pin_memory=False,
+    ):
+        num_sample_buffers = getattr(replay_buffer, "num_sample_buffers", None)
+        if num_sample_buffers is not None and num_sample_buffers <= num_prefetch_batches + 1:
+            raise ValueError(
+                "num_sample_buffers={} of the replay buffer is too small for num_prefetch_batches={}, "
+                "it needs to be at least num_prefetch_batches + 2".format(num_sample_buffers, num_prefetch_batches)
+            )
+        self.replay_buffer = replay_buffer
+        self.batch_size = batch_size
+        self.collate_fn = collate_fn
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        # the torch replay buffers have a lock shared with their writer processes
+        self.buffer_lock = getattr(replay_buffer, "lock", None) or threading.Lock()
+        self._queue = queue.Queue(maxsize=num_prefetch_batches)
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._exception = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        # unblock the worker if it is waiting on a full queue
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        self._thread.join()
+        self._thread = None
+        while not self._queue.empty():
+            self._queue.get_nowait()
+
+    def get(self):
+        """
+        Returns the next collated batch, blocking only if the background
+        thread has not caught up yet.
+        """
+        while True:
+            if self._exception is not None:
+                raise self._exception
+            try:
+                return self._queue.get(timeout=1.0)
+            except queue.Empty:
+                if self._thread is None or not self._thread.is_alive():
+                    if self._exception is not None:
+                        raise self._exception
+                    raise RuntimeError("BatchPrefetcher is not running, call start() first")
+
+    def _worker(self):
+        try:
+            while not self._stop_event.is_set():
+                with self.buffer_lock:
+                    can_sample = self.replay_buffer.num_steps_can_sample() > 0
+                    if can_sample:
+                        batch = self.replay_buffer.random_batch(self.batch_size)
+                if not can_sample:
+                    # e.g. started before any exploration paths were added
+                    self._stop_event.wait(0.01)
+                    continue
+                if self.collate_fn is not None:
+                    batch = self.collate_fn(batch)
+                if self.pin_memory:
+                    batch = _pin_batch(batch)
+                while not self._stop_event.is_set():
+                    try:
+                        self._queue.put(batch, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+        except Exception as e:
+            self._exception = e
+
+
+def _pin_batch(batch):
+    if isinstance(batch, torch.Tensor):
+        return batch.pin_memory() if batch.device.type == "cpu" else batch
+    if isinstance(batch, dict):
+        return {k: _pin_batch(v) for k, v in batch.items()}
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(_pin_batch(v) for v in batch)
+    return batch
@@ -8,11 +8,45 @@ import numpy as np
 import torch
 import torch.optim as optim
 from torch import nn as nn
+from torch.nn import functional as F
 
 import marlkit.torch.pytorch_util as ptu
 from marlkit.core.eval_util import create_stats_ordered_dict
+from marlkit.torch.mixers import replication_pad, replication_pad_index
+from marlkit.torch.networks import FlattenMlp, Mlp
 from marlkit.torch.torch_rl_algorithm import MATorchTrainer
 
+# cache of the joint space critic input indices, see joint_input_index
+_JOINT_INPUT_INDEX = {}
+
+
+def joint_input_index(
+    obs_dim, action_dim, n_agents, state_dim, joint_size=None, padded_state_dim=None, qf_size=None, device=None
+):
+    """
+    The MADDPG critic input of an agent is
+
+        cat([obs, action, joint_action.repeat(n_agents), state])
+
+    with the repeated actions replication padded to `joint_size`, the state
+    to `padded_state_dim` and the whole input to `qf_size`. Every entry of
+    it is a copy of an entry of the unpadded `cat([obs, action, joint_action,
+    state])`, this returns the index of that entry for every critic input.
+    """
+    key = (obs_dim, action_dim, n_agents, state_dim, joint_size, padded_state_dim, qf_size, device)
+    if key not in _JOINT_INPUT_INDEX:
+        joint = obs_dim + action_dim + torch.arange(n_agents * action_dim, device=device) % action_dim
+        if joint_size is not None and joint_size != joint.size(0):
+            joint = joint[replication_pad_index(joint.size(0), joint_size, device)]
+        state = obs_dim + 2 * action_dim + torch.arange(state_dim, device=device)
+        if padded_state_dim is not None and padded_state_dim != state_dim:
+            state = state[replication_pad_index(state_dim, padded_state_dim, device)]
+        index = torch.cat([torch.arange(obs_dim + action_dim, device=device), joint, state])
+        if qf_size is not None and qf_size != index.size(0):
+            index = index[replication_pad_index(index.size(0), qf_size, device)]
+        _JOINT_INPUT_INDEX[key] = index
+    return _JOINT_INPUT_INDEX[key]
+
 
 class DDPGTrainer(MATorchTrainer):
     """
@@ -90,45 +124,6 @@ class DDPGTrainer(MATorchTrainer):
         self._need_to_update_eval_statistics = True
 
     def train_from_torch(self, batch):
-        rewards = batch["rewards"]
-        terminals = batch["terminals"]
-        obs = batch["observations"]
-        actions = batch["actions"]
-        next_obs = batch["next_observations"]
-        states = batch["states"]
-        next_states = batch["next_states"]
-
-        # since this is IPG paradigm, we can just stack everything and move on
-        # since we're in the MA paradigm, we need to be careful of ragged
-        # inputs...
-        """
-        obs = torch.from_numpy(np.stack(obs, 0)).float()
-        actions = torch.from_numpy(np.stack(actions, 0)).float()
-        terminals = torch.from_numpy(np.stack(terminals, 0)).float()
-        rewards = torch.from_numpy(np.stack(rewards, 0)).float()
-        states = torch.from_numpy(np.stack(states, 0)).float()
-        next_obs = torch.from_numpy(np.stack(next_obs, 0)).float()
-        next_states = torch.from_numpy(np.stack(next_states, 0)).float()
-
-        terminals = terminals.permute(0, 1, 3, 2)
-        rewards = rewards.permute(0, 1, 3, 2)
-        """
-
-        def to_tensor(x, filter_n=None):
-            try:
-                if filter_n is None:
-                    return torch.from_numpy(np.array(x, dtype=float)).float()
-                else:
-                    return torch.from_numpy(np.array(x[:filter_n], dtype=float)).float()
-            except:
-                x = [np.array(x_) for x_ in x]
-                if filter_n is None:
-                    x = np.stack(x, 0)
-                else:
-                    x = x[:filter_n]
-                    x = np.stack(x, 0)
-                return torch.from_numpy(x).float()
-
         # statistics
         total_qf_loss = []
         total_policy_loss = []
@@ -138,28 +133,25 @@ class DDPGTrainer(MATorchTrainer):
         total_bellman_errors = []
         total_policy_actions = []
 
-        for b in range(len(obs)):
-            try:
-                rewards = to_tensor(batch["rewards"][b])
-                terminals = to_tensor(batch["terminals"][b])
-                obs = to_tensor(batch["observations"][b])
-                states = to_tensor(batch["states"][b])
-                active_agent = to_tensor(batch["active_agents"][b])
-                # state_0 = batch["states_0"]
-                actions = to_tensor(batch["actions"][b])
-                next_obs = to_tensor(batch["next_observations"][b])
-                next_states = to_tensor(batch["next_states"][b])
-            except:
-                filter_n = len(batch["observations"][b]) - 1
-                rewards = to_tensor(batch["rewards"][b], filter_n)
-                terminals = to_tensor(batch["terminals"][b], filter_n)
-                obs = to_tensor(batch["observations"][b], filter_n)
-                states = to_tensor(batch["states"][b], filter_n)
-                active_agent = to_tensor(batch["active_agents"][b], filter_n)
-                # state_0 = batch["states_0"]
-                actions = to_tensor(batch["actions"][b], filter_n)
-                next_obs = to_tensor(batch["next_observations"][b], filter_n)
-                next_states = to_tensor(batch["next_states"][b], filter_n)
+        # the target networks change after every episode with soft updates
+        # (and on the hard update steps), otherwise they are fixed for the
+        # whole batch and evaluated once per agent count
+        batch_target_q_values = None
+        if not self.use_soft_update and self._n_train_steps_total % self.target_hard_update_period != 0:
+            with torch.no_grad():
+                batch_target_q_values = batch.map_steps(self._target_q_values, "next_observations", "next_states")
+
+        for b in range(len(batch)):
+            episode = batch.episode(b)
+            rewards = episode["rewards"]
+            terminals = episode["terminals"]
+            obs = episode["observations"]
+            states = episode["states"]
+            active_agent = episode["active_agents"]
+            # state_0 = batch["states_0"]
+            actions = episode["actions"]
+            next_obs = episode["next_observations"]
+            next_states = episode["next_states"]
 
             terminals = terminals.permute(0, 2, 1)
             rewards = rewards.permute(0, 2, 1)
@@ -182,112 +174,24 @@ class DDPGTrainer(MATorchTrainer):
             else:
                 policy_actions = self.policy(obs)
                 if self.use_joint_space:
-                    n_agents = policy_actions.shape[-2]
-                    # if n_agents != n_agents:
-                    #    # pad or repeat until?
-                    # print("policy_actions", policy_actions.shape)
-                    # print("states", states.shape)
-                    rep_policy_actions = policy_actions.detach().repeat(1, 1, n_agents)
-                    rep_states = states.detach().repeat(1, n_agents, 1)
-
-                    # print("rep_policy_actions", rep_policy_actions.shape)  # this needs to be resize or padded
-
-                    #
-                    if self.n_actions is not None and self.n_agents is not None:
-                        target_action_agent = self.n_actions * self.n_agents
-                        if target_action_agent != rep_policy_actions.size(2):
-                            pad_target = (target_action_agent - rep_policy_actions.size(2)) // 2
-                            rep_policy_actions = nn.ReplicationPad1d(
-                                (pad_target, target_action_agent - rep_policy_actions.size(2) - pad_target)
-                            )(rep_policy_actions)
-                    if self.state_dim is not None:
-                        if rep_states.size(2) != self.state_dim:
-                            pad_target = (self.state_dim - rep_states.size(2)) // 2
-                            rep_states = nn.ReplicationPad1d(
-                                (pad_target, self.state_dim - pad_target - rep_states.size(2))
-                            )(rep_states)
-                    flat_inputs = torch.cat([obs, policy_actions, rep_policy_actions, rep_states], dim=-1)
-                    if self.n_agents is not None:
-                        if n_agents != self.n_agents:
-                            pad_target = (self.n_agents - n_agents) // 2
-                            flat_inputs = flat_inputs.permute(0, 2, 1)
-                            flat_inputs = nn.ReplicationPad1d((pad_target, self.n_agents - pad_target - n_agents))(
-                                flat_inputs
-                            )
-                            flat_inputs = flat_inputs.permute(0, 2, 1)
+                    q_output = self._joint_q_values(self.qf, obs, policy_actions, policy_actions.detach(), states)
                 else:
                     flat_inputs = torch.cat([obs, policy_actions], dim=-1)
-
-                # ensure flat_inputs is the right size
-                if self.qf_size is not None:
-                    if flat_inputs.size(2) != self.qf_size:
-                        curr_size = flat_inputs.size(2)
-                        pad_target = (self.qf_size - curr_size) // 2
-                        flat_inputs = nn.ReplicationPad1d((pad_target, self.qf_size - pad_target - curr_size))(
-                            flat_inputs
-                        )
-                q_output = self.qf(flat_inputs)
+                    q_output = self.qf(self._pad_qf_input(flat_inputs))
                 raw_policy_loss = policy_loss = -q_output.mean()
 
             """
             Critic operations.
             """
-            next_actions = self.target_policy(next_obs)
-            # speed up computation by not backpropping these gradients
-            next_actions.detach()
-            if self.use_joint_space:
-                n_agents = next_actions.shape[-2]
-                rep_next_actions = next_actions.repeat(1, 1, n_agents)
-                rep_next_states = next_states.detach().repeat(1, n_agents, 1)
-
-                if self.n_actions is not None and self.n_agents is not None:
-                    target_action_agent = self.n_actions * self.n_agents
-                    if target_action_agent != rep_next_actions.size(2):
-                        pad_target = (target_action_agent - rep_next_actions.size(2)) // 2
-                        rep_next_actions = nn.ReplicationPad1d(
-                            (pad_target, target_action_agent - rep_next_actions.size(2) - pad_target)
-                        )(rep_next_actions)
-                if self.n_actions is not None and self.n_agents is not None:
-                    target_action_agent = self.n_actions * self.n_agents
-                    if target_action_agent != rep_next_actions.size(2):
-                        pad_target = (target_action_agent - rep_next_actions.size(2)) // 2
-                        rep_next_actions = nn.ReplicationPad1d(
-                            (pad_target, target_action_agent - rep_next_actions.size(2) - pad_target)
-                        )(rep_next_actions)
-                if self.state_dim is not None:
-                    if rep_next_states.size(2) != self.state_dim:
-                        pad_target = (self.state_dim - rep_next_states.size(2)) // 2
-                        rep_next_states = nn.ReplicationPad1d(
-                            (pad_target, self.state_dim - pad_target - rep_next_states.size(2))
-                        )(rep_next_states)
-                flat_inputs = torch.cat([next_obs, next_actions, rep_next_actions, rep_next_states], dim=-1)
-                if self.n_agents is not None:
-                    if n_agents != self.n_agents:
-                        pad_target = (self.n_agents - n_agents) // 2
-                        flat_inputs = flat_inputs.permute(0, 2, 1)
-                        flat_inputs = nn.ReplicationPad1d((pad_target, self.n_agents - pad_target - n_agents))(
-                            flat_inputs
-                        )
-                        flat_inputs = flat_inputs.permute(0, 2, 1)
+            if batch_target_q_values is not None:
+                target_q_values = batch_target_q_values[b]
             else:
-                flat_inputs = torch.cat([next_obs, next_actions], -1)
-            # ensure flat_inputs is the right size
-            if self.qf_size is not None:
-                if flat_inputs.size(2) != self.qf_size:
-                    curr_size = flat_inputs.size(2)
-                    pad_target = (self.qf_size - curr_size) // 2
-                    flat_inputs = nn.ReplicationPad1d((pad_target, self.qf_size - pad_target - curr_size))(flat_inputs)
-            target_q_values = self.target_qf(flat_inputs)
+                target_q_values = self._target_q_values(next_obs, next_states)
             if self.n_agents is not None:
                 n_agents = rewards.size(1)
                 if n_agents != self.n_agents:
-                    pad_target = (self.n_agents - n_agents) // 2
-                    rewards = rewards.permute(0, 2, 1)
-                    terminals = terminals.permute(0, 2, 1)
-                    rewards = nn.ReplicationPad1d((pad_target, self.n_agents - pad_target - n_agents))(rewards)
-                    terminals = nn.ReplicationPad1d((pad_target, self.n_agents - pad_target - n_agents))(terminals)
-                    rewards = rewards.permute(0, 2, 1)
-                    terminals = terminals.permute(0, 2, 1)
+                    rewards = replication_pad(rewards.permute(0, 2, 1), self.n_agents).permute(0, 2, 1)
+                    terminals = replication_pad(terminals.permute(0, 2, 1), self.n_agents).permute(0, 2, 1)
 
             if self.mrl:
                 # augment rewards
@@ -299,32 +203,11 @@ class DDPGTrainer(MATorchTrainer):
             q_target = q_target.detach()
             q_target = torch.clamp(q_target, self.min_q_value, self.max_q_value)
             if self.use_joint_space:
-                n_agents = actions.shape[-2]
-                rep_actions = actions.repeat(1, 1, n_agents)
-                rep_states = states.repeat(1, n_agents, 1)
-                if self.state_dim is not None:
-                    if rep_states.size(2) != self.state_dim:
-                        pad_target = (self.state_dim - rep_states.size(2)) // 2
-                        rep_states = nn.ReplicationPad1d(
-                            (pad_target, self.state_dim - pad_target - rep_states.size(2))
-                        )(rep_states)
-                flat_inputs = torch.cat([obs, policy_actions, rep_policy_actions, rep_states], dim=-1)
-                if self.n_agents is not None:
-                    if n_agents != self.n_agents:
-                        pad_target = (self.n_agents - n_agents) // 2
-                        flat_inputs = flat_inputs.permute(0, 2, 1)
-                        flat_inputs = nn.ReplicationPad1d((pad_target, self.n_agents - pad_target - n_agents))(
-                            flat_inputs
-                        )
-                        flat_inputs = flat_inputs.permute(0, 2, 1)
+                # NOTE: the joint space critic is trained on the policy actions
+                q_pred = self._joint_q_values(self.qf, obs, policy_actions, policy_actions.detach(), states)
             else:
                 flat_inputs = torch.cat([obs, actions], -1)
-            if self.qf_size is not None:
-                if flat_inputs.size(2) != self.qf_size:
-                    curr_size = flat_inputs.size(2)
-                    pad_target = (self.qf_size - curr_size) // 2
-                    flat_inputs = nn.ReplicationPad1d((pad_target, self.qf_size - pad_target - curr_size))(flat_inputs)
-            q_pred = self.qf(flat_inputs)
+                q_pred = self.qf(self._pad_qf_input(flat_inputs))
             bellman_errors = (q_pred - q_target) ** 2
             raw_qf_loss = self.qf_criterion(q_pred, q_target)
 
@@ -394,6 +277,79 @@ class DDPGTrainer(MATorchTrainer):
             )
         self._n_train_steps_total += 1
 
+    def _target_q_values(self, next_obs, next_states):
+        next_actions = self.target_policy(next_obs)
+        # speed up computation by not backpropping these gradients
+        next_actions.detach()
+        if self.use_joint_space:
+            return self._joint_q_values(self.target_qf, next_obs, next_actions, next_actions, next_states)
+        flat_inputs = torch.cat([next_obs, next_actions], -1)
+        return self.target_qf(self._pad_qf_input(flat_inputs))
+
+    def _pad_qf_input(self, flat_inputs):
+        # ensure flat_inputs is the right size
+        if self.qf_size is not None:
+            return replication_pad(flat_inputs, self.qf_size)
+        return flat_inputs
+
+    def _joint_q_values(self, qf, obs, actions, joint_actions, states):
+        """
+        The joint space (MADDPG) critic on the input of every agent
+
+            cat([obs, actions, joint_actions.repeat(1, 1, n_agents), states.repeat(1, n_agents, 1)])
+
+        padded as described in `joint_input_index`, with the agents replication
+        padded to `self.n_agents`.
+
+        For an `Mlp` (or `FlattenMlp`) critic which doesn't override
+        `forward`, this input is never built. Every input entry is a
+        copy of one entry of `[obs, actions, joint_actions, states]`, so the
+        first layer weights are folded (summed) onto those, and the state
+        projection is computed once per time step and broadcast to the
+        agents. This is the same function of the same parameters as the
+        concatenated input, at O(N) rather than O(N^2) cost per time step.
+
+        :param obs: `[T, N, obs_dim]`
+        :param actions: `[T, N, action_dim]`
+        :param joint_actions: `[T, N, action_dim]`, the repeated actions
+        :param states: `[T, 1, state_dim]`
+        """
+        n_agents = actions.shape[-2]
+        joint_size = None
+        if self.n_actions is not None and self.n_agents is not None:
+            joint_size = self.n_actions * self.n_agents
+        index = joint_input_index(
+            obs.size(-1),
+            actions.size(-1),
+            n_agents,
+            states.size(-1),
+            joint_size=joint_size,
+            padded_state_dim=self.state_dim,
+            qf_size=self.qf_size,
+            device=obs.device,
+        )
+        agent_index = None
+        if self.n_agents is not None and n_agents != self.n_agents:
+            agent_index = replication_pad_index(n_agents, self.n_agents, obs.device)
+        agent_inputs = torch.cat([obs, actions, joint_actions], dim=-1)
+
+        if not (isinstance(qf, Mlp) and type(qf).forward in (Mlp.forward, FlattenMlp.forward)):
+            states = states.expand(-1, n_agents, -1)
+            flat_inputs = torch.cat([agent_inputs, states], dim=-1).index_select(-1, index)
+            if agent_index is not None:
+                flat_inputs = flat_inputs.index_select(1, agent_index)
+            return qf(flat_inputs)
+
+        layers = list(qf.fcs) + [qf.last_fc]
+        first = layers[0]
+        weight = first.weight.new_zeros(first.out_features, agent_inputs.size(-1) + states.size(-1))
+        weight = weight.index_add(1, index, first.weight)
+        split = agent_inputs.size(-1)
+        h = F.linear(agent_inputs, weight[:, :split], first.bias) + F.linear(states, weight[:, split:])
+        if agent_index is not None:
+            h = h.index_select(1, agent_index)
+        return qf.forward_from_first_layer(h)
+
     def _update_target_networks(self):
         if self.use_soft_update:
             ptu.soft_update_from_to(self.policy, self.target_policy, self.tau)
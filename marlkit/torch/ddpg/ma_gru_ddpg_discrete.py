@@ -137,16 +137,16 @@ class DDPGTrainer(MATorchTrainer):
             hidden = torch.cat(self.policy.init_hidden(size), 0)
             policy_action = []
             for t in range(path_len):
-                pol_act, hidden = self.policy(torch.from_numpy(obs[batch][t, :, :]).float(), hidden)
+                pol_act, hidden = self.policy(obs[batch][t, :, :], hidden)
                 policy_action.append(pol_act)
             policy_actions.append(torch.stack(policy_action, 0))
         policy_actions = torch.stack(policy_actions, 0)
 
-        f_obs = torch.from_numpy(np.stack(obs, 0)).float()
+        f_obs = obs
         if self.use_joint_space:
             n_agents = policy_actions.shape[-2]
             rep_policy_actions = policy_actions.detach().repeat(1, 1, 1, n_agents)
-            rep_states = torch.from_numpy(np.stack(states, 0)).float().repeat(1, 1, n_agents, 1)
+            rep_states = states.repeat(1, 1, n_agents, 1)
             flat_inputs = torch.cat([f_obs, policy_actions, rep_policy_actions, rep_states], dim=-1)
         else:
             flat_inputs = torch.cat([f_obs, policy_actions], dim=-1)
@@ -164,17 +164,17 @@ class DDPGTrainer(MATorchTrainer):
             hidden = torch.cat(self.target_policy.init_hidden(size), 0)
             next_action = []
             for t in range(path_len):
-                next_act, hidden = self.target_policy(torch.from_numpy(next_obs[batch][t, :, :]).float(), hidden)
+                next_act, hidden = self.target_policy(next_obs[batch][t, :, :], hidden)
                 next_action.append(next_act)
             next_actions.append(torch.stack(next_action, 0))
         next_actions = torch.stack(next_actions, 0)
         # speed up computation by not backpropping these gradients
         next_actions.detach()
-        f_next_obs = torch.from_numpy(np.stack(next_obs, 0)).float()
+        f_next_obs = next_obs
         if self.use_joint_space:
             n_agents = next_actions.shape[-2]
             rep_next_actions = next_actions.repeat(1, 1, 1, n_agents)
-            rep_next_states = torch.from_numpy(np.stack(next_states, 0)).float().repeat(1, 1, n_agents, 1)
+            rep_next_states = next_states.repeat(1, 1, n_agents, 1)
             flat_inputs = torch.cat([f_next_obs, next_actions, rep_next_actions, rep_next_states], -1)
         else:
             flat_inputs = torch.cat([f_next_obs, next_actions], -1)
@@ -187,10 +187,10 @@ class DDPGTrainer(MATorchTrainer):
         flat_inputs = torch.cat([next_obs, next_actions], -1)
         target_q_values = self.target_qf(flat_inputs)
         """
-        t_rewards = torch.from_numpy(np.stack(rewards, 0)).float().permute(0, 1, 3, 2)
-        t_terminals = torch.from_numpy(np.stack(terminals, 0)).float().permute(0, 1, 3, 2)
-        t_obs = torch.from_numpy(np.stack(obs, 0)).float()
-        t_actions = torch.from_numpy(np.stack(actions, 0)).float()
+        t_rewards = rewards.permute(0, 1, 3, 2)
+        t_terminals = terminals.permute(0, 1, 3, 2)
+        t_obs = obs
+        t_actions = actions
 
         q_target = t_rewards + (1.0 - t_terminals) * self.discount * target_q_values
         q_target = q_target.detach()
@@ -198,7 +198,7 @@ class DDPGTrainer(MATorchTrainer):
         if self.use_joint_space:
             n_agents = t_actions.shape[-2]
             rep_actions = t_actions.repeat(1, 1, 1, n_agents)
-            rep_states = torch.from_numpy(np.stack(states, 0)).float().repeat(1, 1, n_agents, 1)
+            rep_states = states.repeat(1, 1, n_agents, 1)
             flat_inputs = torch.cat([t_obs, t_actions, rep_actions, rep_states], -1)
         else:
             flat_inputs = torch.cat([t_obs, t_actions], -1)
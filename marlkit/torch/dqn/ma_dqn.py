@@ -28,6 +28,7 @@ class DQNTrainer(MATorchTrainer):
         # TODO
         optimizer_class=optim.Adam,
         use_shared_experience=False,
+        shared_experience_clip=None,
         n_agents=None,
         state_dim=None,
         action_dim=None,
@@ -80,6 +81,7 @@ class DQNTrainer(MATorchTrainer):
         if use_shared_experience:
             assert mixer is None, "Shared experience only makes sense in IQL!"
         self.use_shared_experience = use_shared_experience
+        self.shared_experience_clip = shared_experience_clip
         self.qf_optimizer = optim.Adam(
             self.qf.parameters(),
             lr=self.learning_rate,
@@ -10,6 +10,8 @@ import torch.nn as nn
 import marlkit.torch.pytorch_util as ptu
 from marlkit.core.eval_util import create_stats_ordered_dict
 from marlkit.torch.dqn.ma_dqn import DQNTrainer
+from marlkit.torch.returns import td_lambda_targets
+from marlkit.torch.shared_experience import shared_experience_loss
 import marlkit.torch.pytorch_util as ptu
 from marlkit.core.eval_util import create_stats_ordered_dict
 from marlkit.torch.torch_rl_algorithm import MATorchTrainer
@@ -73,12 +75,12 @@ class DoubleDQNTrainer(DQNTrainer):
                 #    hidden[agent_indx] = h
                 #    q_.append(q)
 
-                q, hidden = self.qf(torch.from_numpy(obs[batch][t, :, :]).float(), hidden)
+                q, hidden = self.qf(obs[batch][t, :, :], hidden)
                 if t != 0:
                     best_action_idx.append(q)
                 obs_q.append(q)
 
-            q, hidden = self.qf(torch.from_numpy(next_obs[batch][-1, :, :]).float(), hidden)
+            q, hidden = self.qf(next_obs[batch][-1, :, :], hidden)
             best_action_idx.append(q)
             best_action_idx = torch.stack(best_action_idx, 0)
             obs_q = torch.stack(obs_q, 0)
@@ -101,11 +103,11 @@ class DoubleDQNTrainer(DQNTrainer):
                 target_q_value = []
                 for t in range(path_len):
                     q_ = []
-                    q, hidden = self.target_qf(torch.from_numpy(obs[batch][t, :, :]).float(), hidden)
+                    q, hidden = self.target_qf(obs[batch][t, :, :], hidden)
                     if t != 0:
                         target_q_value.append(q)
 
-                q, hidden = self.qf(torch.from_numpy(next_obs[batch][-1, :, :]).float(), hidden)
+                q, hidden = self.qf(next_obs[batch][-1, :, :], hidden)
                 target_q_value.append(q)
                 target_q_value = torch.stack(target_q_value, 0)
                 # if self.mixer is None:
@@ -115,20 +117,17 @@ class DoubleDQNTrainer(DQNTrainer):
 
         # need to gather..., by best_action_idxs
         target_q_values = torch.stack(target_q_values, 0)
-        y_target = (
-            torch.from_numpy(np.stack(rewards, axis=0)).float()
-            + (1.0 - torch.from_numpy(np.stack(terminals, axis=0)).float()) * self.discount * target_q_values
-        )
+        y_target = rewards + (1.0 - terminals) * self.discount * target_q_values
         y_target = y_target.detach()
         y_target = y_target.permute(0, 1, 3, 2)
 
         # actions is a one-hot vector
-        y_pred = torch.sum(obs_qs * torch.from_numpy(np.stack(actions, 0)).float(), dim=3, keepdim=True)
+        y_pred = torch.sum(obs_qs * actions, dim=3, keepdim=True)
         # torch.sum(self.qf(obs) * actions, dim=1, keepdim=True)
 
         # y_pred is the "chosen_action_qvals" in pymarl
         # y_target is the "target_max_qvals" in pymarl
-        state = torch.mean(torch.from_numpy(np.stack(state, 0)).float(), 2, keepdim=True)
+        state = torch.mean(state, 2, keepdim=True)
 
         # do stuff here like
         if self.mixer is not None:
@@ -138,22 +137,13 @@ class DoubleDQNTrainer(DQNTrainer):
 
         if self.use_shared_experience:
             # assume lambda = 1 as per paper, so we only need to iterate and not do the top part
-            n_agents = obs_qs.shape[-2]
             # policy_loss_ = (action_probs * (alpha * log_pis - q_new_actions))
             qf_loss_ = (y_pred - y_target) ** 2
 
             pis = torch.softmax(obs_qs, -1)
             log_pi = torch.log(pis)
 
-            qf_loss = None
-            for ag in range(n_agents):
-                # iterate through all of them...
-                if qf_loss is None:
-                    qf_loss = torch.exp(torch.exp(log_pi - log_pi[:, :, [ag], :])).detach() * qf_loss_[:, :, [ag], :]
-                else:
-                    qf_loss += torch.exp(torch.exp(log_pi - log_pi[:, :, [ag], :])).detach() * qf_loss_[:, :, [ag], :]
-
-            qf_loss = qf_loss.mean()
+            qf_loss = shared_experience_loss(qf_loss_, log_pi, double_exp=True, clip=self.shared_experience_clip)
         else:
             qf_loss = self.qf_criterion(y_pred, y_target)
 
@@ -272,25 +262,11 @@ class COMATrainer(DQNTrainer):
 
         def build_td_lambda_targets(rewards, terminated, mask, target_qs, n_agents, gamma, td_lambda):
             # Assumes  <target_qs > in B*T*A and <reward >, <terminated >, <mask > in (at least) B*T-1*1
-            # Initialise  last  lambda -return  for  not  terminated  episodes
-            ret = target_qs.new_zeros(*target_qs.shape)
-            # print("rewards", rewards.shape)  # coma only supports shared reward
             rewards = torch.max(rewards, -1)[1].unsqueeze(3)  # coma only supports shared reward
             terminated = terminated.permute(0, 1, 3, 2)
             mask = mask.permute(0, 1, 3, 2)
-            ret[:, -1] = target_qs[:, -1] * (1 - torch.sum(terminated, dim=1))
-            # Backwards  recursive  update  of the "forward  view"
-            for t in range(ret.shape[1] - 2, -1, -1):
-                # print("ret", ret[:, t].shape)
-                # print("mask", mask[:, t].shape)
-
-                header = td_lambda * gamma * ret[:, t + 1]
-                tail = rewards[:, t] + (1 - td_lambda) * gamma * target_qs[:, t + 1] * (1 - terminated[:, t])
-                # print(header.shape)
-                # print(tail.shape)
-                ret[:, t] = header + mask[:, t] * tail
             # Returns lambda-return from t=0 to t=T-1, i.e. in B*T-1*A
-            return ret[:, 0:-1]
+            return td_lambda_targets(rewards, terminated, mask, target_qs, gamma, td_lambda)
 
         mask = active_agent
         bs = obs.shape[0]
@@ -402,15 +378,6 @@ class COMATrainer(DQNTrainer):
         next_obs = batch["next_observations"]
         active_agent = batch["active_agents"]
 
-        # deal with ragged inputs later...
-        obs = torch.from_numpy(np.stack(obs, axis=0)).float()
-        next_obs = torch.from_numpy(np.stack(next_obs, axis=0)).float()
-        terminals = torch.from_numpy(np.stack(terminals, axis=0)).float()
-        actions = torch.from_numpy(np.stack(actions, axis=0)).float()
-        rewards = torch.from_numpy(np.stack(rewards, axis=0)).float()
-        states = torch.from_numpy(np.stack(states, axis=0)).float()
-        active_agent = torch.from_numpy(np.stack(active_agent, axis=0)).float()
-
         # in the mixer setting they need to be managed in groups
         size = obs[0].shape[0]
         path_len = obs[0].shape[-1]
@@ -453,10 +420,10 @@ class COMATrainer(DQNTrainer):
                 #    hidden[agent_indx] = h
                 #    q_.append(q)
 
-                q, hidden = self.qf(torch.from_numpy(obs[batch][t, :, :]).float(), hidden)
+                q, hidden = self.qf(obs[batch][t, :, :], hidden)
                 obs_q.append(q)
 
-            q, hidden = self.qf(torch.from_numpy(next_obs[batch][-1, :, :]).float(), hidden)
+            q, hidden = self.qf(next_obs[batch][-1, :, :], hidden)
             obs_q = torch.stack(obs_q, 0)
             # if self.mixer is None:
             obs_qs.append(obs_q)
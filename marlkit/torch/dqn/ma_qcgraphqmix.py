@@ -8,6 +8,7 @@ import torch
 import marlkit.torch.pytorch_util as ptu
 from marlkit.core.eval_util import create_stats_ordered_dict
 from marlkit.torch.dqn.ma_dqn import DQNTrainer
+from marlkit.torch.shared_experience import shared_experience_loss
 from marlkit.policies.argmax import MAArgmaxDiscretePolicy
 import torch.optim as optim
 from collections import OrderedDict
@@ -15,45 +16,24 @@ from collections import OrderedDict
 
 class DoubleDQNTrainer(DQNTrainer):
     def train_from_torch(self, batch):
-        rewards = batch["rewards"]
-        terminals = batch["terminals"]
-        obs = batch["observations"]
-        state = batch["states"]
-        active_agent = batch["active_agents"]
-        # state_0 = batch["states_0"]
-        actions = batch["actions"]
-        next_obs = batch["next_observations"]
-
-        # no need to worry about groups of games. in the IQL setting.
-        # to do support batch esp. as games are different lengths...
-        """
-        obs = torch.from_numpy(np.stack(obs, axis=0)).float()
-        next_obs = torch.from_numpy(np.stack(next_obs, axis=0)).float()
-        terminals = torch.from_numpy(np.stack(terminals, axis=0)).float()
-        actions = torch.from_numpy(np.stack(actions, axis=0)).float()
-        rewards = torch.from_numpy(np.stack(rewards, axis=0)).float()
-        active_agent = torch.from_numpy(np.stack(active_agent, axis=0)).float()
-        """
-
-        def to_tensor(x):
-            try:
-                return torch.from_numpy(np.array(x, dtype=float)).float()
-            except:
-                x = np.stack([x_.flatten()[np.newaxis, :] for x_ in x], 0)
-                return torch.from_numpy(x).float()
-
         total_qf_loss = []
         total_y_pred = []
 
-        for b in range(len(obs)):
-            rewards = to_tensor(batch["rewards"][b])
-            terminals = to_tensor(batch["terminals"][b])
-            obs = to_tensor(batch["observations"][b])
-            state = to_tensor(batch["states"][b])
-            active_agent = to_tensor(batch["active_agents"][b])
+        # the target network is fixed until the soft update after the loop,
+        # so it is evaluated once on the padded batch
+        with torch.no_grad():
+            target_next_obs_qf, target_next_obs_hidden = self.target_qf(batch["next_observations"], return_hidden=True)
+
+        for b in range(len(batch)):
+            episode = batch.episode(b)
+            rewards = episode["rewards"]
+            terminals = episode["terminals"]
+            obs = episode["observations"]
+            state = episode["states"]
+            active_agent = episode["active_agents"]
             # state_0 = batch["states_0"]
-            actions = to_tensor(batch["actions"][b])
-            next_obs = to_tensor(batch["next_observations"][b])
+            actions = episode["actions"]
+            next_obs = episode["next_observations"]
 
             """
             Compute loss
@@ -65,8 +45,9 @@ class DoubleDQNTrainer(DQNTrainer):
             best_action_idxs = obs_qf.max(-1, keepdim=True)[1]
             # print(best_action_idxs.shape)
             # print(self.target_qf(next_obs).shape)
-            next_obs_qf, target_hidden_states = self.target_qf(next_obs, return_hidden=True)
-            target_q_values = next_obs_qf.gather(-1, best_action_idxs).detach()
+            next_obs_qf = batch.unpadded(b, target_next_obs_qf, "next_observations")
+            target_hidden_states = batch.unpadded(b, target_next_obs_hidden, "next_observations")
+            target_q_values = next_obs_qf.gather(-1, best_action_idxs)
             target_q_values = target_q_values.permute(0, 2, 1)
             # print(target_q_values.shape)
             y_target = rewards + (1.0 - terminals) * self.discount * target_q_values
@@ -75,8 +56,6 @@ class DoubleDQNTrainer(DQNTrainer):
             obs_qs = self.qf(obs)
             y_pred = torch.sum(obs_qs * actions, dim=-1, keepdim=True)
 
-            state = torch.from_numpy(np.stack(state, 0)).float()
-
             if self.mixer is not None:
                 # inputs needs to include batch['state']
                 y_pred = y_pred.permute(0, 2, 1)  # needs to match y_pred size
@@ -93,7 +72,6 @@ class DoubleDQNTrainer(DQNTrainer):
 
             if self.use_shared_experience:
                 # assume lambda = 1 as per paper, so we only need to iterate and not do the top part
-                n_agents = obs_qs.shape[-2]
                 # policy_loss_ = (action_probs * (alpha * log_pis - q_new_actions))
                 y_target = y_target.permute(0, 2, 1)
                 qf_loss_ = (y_pred - y_target) ** 2
@@ -101,20 +79,7 @@ class DoubleDQNTrainer(DQNTrainer):
                 pis = torch.softmax(obs_qs.detach(), -1)
                 log_pi = torch.log(pis)
 
-                qf_loss = None
-
-                for ag in range(n_agents):
-                    # iterate through all of them...
-                    if qf_loss is None:
-                        qf_loss = (
-                            torch.exp(torch.exp(log_pi - log_pi[:, :, [ag], :])).detach() * qf_loss_[:, :, [ag], :]
-                        )
-                    else:
-                        qf_loss += (
-                            torch.exp(torch.exp(log_pi - log_pi[:, :, [ag], :])).detach() * qf_loss_[:, :, [ag], :]
-                        )
-
-                qf_loss = qf_loss.mean()
+                qf_loss = shared_experience_loss(qf_loss_, log_pi, double_exp=True, clip=self.shared_experience_clip)
             else:
                 y_target = y_target.permute(0, 2, 1)
                 qf_loss = self.qf_criterion(y_pred, y_target)
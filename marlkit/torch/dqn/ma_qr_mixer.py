@@ -23,68 +23,30 @@ class CQLTrainer(DQNTrainer):
     min_q_weight = 1.0
 
     def train_from_torch(self, batch):
-        rewards = batch["rewards"]
-        terminals = batch["terminals"]
-        obs = batch["observations"]
-        state = batch["states"]
-        active_agent = batch["active_agents"]
-        # state_0 = batch["states_0"]
-        actions = batch["actions"]
-        next_obs = batch["next_observations"]
-
-        # no need to worry about groups of games. in the IQL setting.
-        # to do support batch esp. as games are different lengths...
-        """
-        obs = torch.from_numpy(np.stack(obs, axis=0)).float()
-        next_obs = torch.from_numpy(np.stack(next_obs, axis=0)).float()
-        terminals = torch.from_numpy(np.stack(terminals, axis=0)).float()
-        actions = torch.from_numpy(np.stack(actions, axis=0)).float()
-        rewards = torch.from_numpy(np.stack(rewards, axis=0)).float()
-        active_agent = torch.from_numpy(np.stack(active_agent, axis=0)).float()
-        """
-
-        def to_tensor(x, filter_n=None):
-            try:
-                if filter_n is None:
-                    return torch.from_numpy(np.array(x, dtype=float)).float()
-                else:
-                    return torch.from_numpy(np.array(x[:filter_n], dtype=float)).float()
-            except:
-                x = [np.array(x_) for x_ in x]
-                if filter_n is None:
-                    x = np.stack(x, 0)
-                else:
-                    x = x[:filter_n]
-                    x = np.stack(x, 0)
-                return torch.from_numpy(x).float()
-
         total_qf_loss = []
         total_y_pred = []
 
         self.num_quant = self.qf.num_quant  # hack
 
-        for b in range(len(obs)):
-            try:
-                rewards = to_tensor(batch["rewards"][b])
-                terminals = to_tensor(batch["terminals"][b])
-                obs = to_tensor(batch["observations"][b])
-                state = to_tensor(batch["states"][b])
-                active_agent = to_tensor(batch["active_agents"][b])
-                # state_0 = batch["states_0"]
-                actions = to_tensor(batch["actions"][b])
-                next_obs = to_tensor(batch["next_observations"][b])
-                next_states = to_tensor(batch["next_states"][b])
-            except:
-                filter_n = len(batch["observations"][b]) - 1
-                rewards = to_tensor(batch["rewards"][b], filter_n)
-                terminals = to_tensor(batch["terminals"][b], filter_n)
-                obs = to_tensor(batch["observations"][b], filter_n)
-                state = to_tensor(batch["states"][b], filter_n)
-                active_agent = to_tensor(batch["active_agents"][b], filter_n)
-                # state_0 = batch["states_0"]
-                actions = to_tensor(batch["actions"][b], filter_n)
-                next_obs = to_tensor(batch["next_observations"][b], filter_n)
-                next_states = to_tensor(batch["next_states"][b], filter_n)
+        # the target network is fixed until the soft update after the loop,
+        # so it is evaluated once on the padded batch, as `[B, T, N, actions, quantiles]`
+        next_obs = batch["next_observations"]
+        with torch.no_grad():
+            target_next_obs_q = self.target_qf(next_obs).view(
+                next_obs.shape[:-1] + (self.qf.action_size, self.num_quant)
+            )
+
+        for b in range(len(batch)):
+            episode = batch.episode(b)
+            rewards = episode["rewards"]
+            terminals = episode["terminals"]
+            obs = episode["observations"]
+            state = episode["states"]
+            active_agent = episode["active_agents"]
+            # state_0 = batch["states_0"]
+            actions = episode["actions"]
+            next_obs = episode["next_observations"]
+            next_states = episode["next_states"]
 
             """
             Compute loss
@@ -102,7 +64,7 @@ class CQLTrainer(DQNTrainer):
                 best_action_idx = best_action_idx.unsqueeze(0)
             best_action_idx = best_action_idx.permute(0, 1, 3, 2)
 
-            target_q_all = self.target_qf(next_obs).detach()
+            target_q_all = batch.unpadded(b, target_next_obs_q, "next_observations")
             target_q_values = target_q_all.gather(1, best_action_idx.repeat(1, 1, 1, self.num_quant))
             # target_q_values = target_q_values.permute(0, 2, 1)
 
@@ -116,7 +78,6 @@ class CQLTrainer(DQNTrainer):
             y_pred = self.qf(obs) * actions.unsqueeze(-1)
             # print(y_pred.shape)
 
-            state = torch.from_numpy(np.stack(state, 0)).float()
             qf_loss = None
 
             if self.mixer is None:
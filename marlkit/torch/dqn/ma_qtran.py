@@ -8,7 +8,10 @@ from torch import nn as nn
 
 import marlkit.torch.pytorch_util as ptu
 from marlkit.core.eval_util import create_stats_ordered_dict
+from marlkit.torch.core import eval_obs_next_obs
 from marlkit.torch.dqn.ma_dqn import DQNTrainer
+from marlkit.torch.returns import td_lambda_targets
+from marlkit.torch.mixers import replication_pad
 from marlkit.policies.argmax import MAArgmaxDiscretePolicy
 import torch.optim as optim
 from collections import OrderedDict
@@ -19,74 +22,25 @@ class DoubleDQNTrainer(DQNTrainer):
     nopt_min_loss = 0.1
 
     def train_from_torch(self, batch):
-        rewards = batch["rewards"]
-        terminals = batch["terminals"]
-        obs = batch["observations"]
-        state = batch["states"]
-        active_agent = batch["active_agents"]
-        # state_0 = batch["states_0"]
-        actions = batch["actions"]
-        next_obs = batch["next_observations"]
-
-        """
-        n_agents = None,
-        state_dim = None,
-        action_dim = None,
-        obs_dim = None,
-        """
-
-        # no need to worry about groups of games. in the IQL setting.
-        # to do support batch esp. as games are different lengths...
-        """
-        obs = torch.from_numpy(np.stack(obs, axis=0)).float()
-        next_obs = torch.from_numpy(np.stack(next_obs, axis=0)).float()
-        terminals = torch.from_numpy(np.stack(terminals, axis=0)).float()
-        actions = torch.from_numpy(np.stack(actions, axis=0)).float()
-        rewards = torch.from_numpy(np.stack(rewards, axis=0)).float()
-        active_agent = torch.from_numpy(np.stack(active_agent, axis=0)).float()
-        """
-
-        def to_tensor(x, filter_n=None):
-            try:
-                if filter_n is None:
-                    return torch.from_numpy(np.array(x, dtype=float)).float()
-                else:
-                    return torch.from_numpy(np.array(x[:filter_n], dtype=float)).float()
-            except:
-                x = [np.array(x_) for x_ in x]
-                if filter_n is None:
-                    x = np.stack(x, 0)
-                else:
-                    x = x[:filter_n]
-                    x = np.stack(x, 0)
-                return torch.from_numpy(x).float()
-
         total_qf_loss = []
         total_y_pred = []
 
-        for b in range(len(obs)):
-            try:
-                rewards = to_tensor(batch["rewards"][b])
-                terminals = to_tensor(batch["terminals"][b])
-                obs = to_tensor(batch["observations"][b])
-                state = to_tensor(batch["states"][b])
-                active_agent = to_tensor(batch["active_agents"][b])
-                # state_0 = batch["states_0"]
-                actions = to_tensor(batch["actions"][b])
-                next_obs = to_tensor(batch["next_observations"][b])
-                next_states = to_tensor(batch["next_states"][b])
-                filter_n = len(batch["observations"][b])
-            except:
-                filter_n = max(len(batch["observations"][b]) - 1, 1)
-                rewards = to_tensor(batch["rewards"][b], filter_n)
-                terminals = to_tensor(batch["terminals"][b], filter_n)
-                obs = to_tensor(batch["observations"][b], filter_n)
-                state = to_tensor(batch["states"][b], filter_n)
-                active_agent = to_tensor(batch["active_agents"][b], filter_n)
-                # state_0 = batch["states_0"]
-                actions = to_tensor(batch["actions"][b], filter_n)
-                next_obs = to_tensor(batch["next_observations"][b], filter_n)
-                next_states = to_tensor(batch["next_states"][b], filter_n)
+        # the target network is fixed until the soft update after the loop,
+        # so it is evaluated once on the padded batch
+        with torch.no_grad():
+            target_next_obs_qf, target_next_obs_hidden = self.target_qf(batch["next_observations"], return_hidden=True)
+
+        for b in range(len(batch)):
+            episode = batch.episode(b)
+            rewards = episode["rewards"]
+            terminals = episode["terminals"]
+            obs = episode["observations"]
+            state = episode["states"]
+            active_agent = episode["active_agents"]
+            # state_0 = batch["states_0"]
+            actions = episode["actions"]
+            next_obs = episode["next_observations"]
+            next_states = episode["next_states"]
 
             """
             Compute loss
@@ -95,24 +49,22 @@ class DoubleDQNTrainer(DQNTrainer):
                 # rewards = rewards.reshape(-1, 1).float()
                 # terminals = terminals.reshape(-1, 1).float()
 
-                obs_qf, hidden_states = self.qf(next_obs, return_hidden=True)
+                # one pass of the online network over the whole episode
+                (obs_qs, _), (obs_qf, hidden_states) = eval_obs_next_obs(self.qf, obs, next_obs, return_hidden=True)
                 best_action_idxs = obs_qf.max(-1, keepdim=True)[1]
                 # print(best_action_idxs.shape)
                 # print(self.target_qf(next_obs).shape)
-                next_obs_qf, target_hidden_states = self.target_qf(next_obs, return_hidden=True)
+                next_obs_qf = batch.unpadded(b, target_next_obs_qf, "next_observations")
+                target_hidden_states = batch.unpadded(b, target_next_obs_hidden, "next_observations")
                 # target_best_action_idxs = next_obs_qf.max(-1, keepdim=True)[1]
-                target_q_values = next_obs_qf.gather(-1, best_action_idxs).detach()
+                target_q_values = next_obs_qf.gather(-1, best_action_idxs)
                 target_q_values = target_q_values.permute(0, 2, 1)
                 # print(target_q_values.shape)
                 y_target = rewards + (1.0 - terminals) * self.discount * target_q_values
                 y_target = y_target.detach()
                 # actions is a one-hot vector
-                obs_qs = self.qf(obs)
                 y_pred = torch.sum(obs_qs * actions, dim=-1, keepdim=True)
 
-                state = torch.from_numpy(np.stack(state, 0)).float()
-                next_states = torch.from_numpy(np.stack(next_states, 0)).float()
-
                 if self.mixer is not None:
                     # we expect a qtran mixer here!
                     """
@@ -125,24 +77,8 @@ class DoubleDQNTrainer(DQNTrainer):
                         y_pred = torch.cat([y_pred, torch.zeros(*pad_y_pred_shape)], axis=-1)
                         y_target = torch.cat([y_target, torch.zeros(*pad_y_pred_shape)], axis=-1)
                     """
-                    state_dim = state.size(2)
-                    nstate_dim = next_states.size(2)
-                    if state_dim != self.state_dim:
-                        pad_target = (self.state_dim - state_dim) // 2
-                        try:
-                            state = nn.ReplicationPad1d((pad_target, self.state_dim - pad_target - state_dim))(state)
-                        except:
-                            state = nn.ReflectionPad1d((pad_target, self.state_dim - pad_target - state_dim))(state)
-                    if nstate_dim != self.state_dim:
-                        pad_target = (self.state_dim - nstate_dim) // 2
-                        try:
-                            next_states = nn.ReplicationPad1d((pad_target, self.state_dim - pad_target - nstate_dim))(
-                                next_states
-                            )
-                        except:
-                            next_states = nn.ReflectionPad1d((pad_target, self.state_dim - pad_target - nstate_dim))(
-                                next_states
-                            )
+                    state = replication_pad(state, self.state_dim)
+                    next_states = replication_pad(next_states, self.state_dim)
 
                     max_actions = torch.zeros(size=(obs.shape[0], obs.shape[1], actions.shape[-1]))
                     max_actions_onehot = max_actions.scatter(-1, best_action_idxs[:, :], 1)
@@ -341,40 +277,27 @@ class COMATrainer(DQNTrainer):
         else:
             return self.qf(obs_item)
 
-    def _train_critic(self, obs, states, rewards, terminals, actions, active_agent):
+    def _train_critic(self, obs, states, rewards, terminals, actions, active_agent, target_q_vals):
         """
         we don't have avail actions in petting zoo envs?
         this is copied from coma_learner.py from pymarl
+
+        `target_q_vals` is the target critic on the episode.
         """
 
         def build_td_lambda_targets(rewards, terminated, mask, target_qs, n_agents, gamma, td_lambda):
             # Assumes  <target_qs > in B*T*A and <reward >, <terminated >, <mask > in (at least) B*T-1*1
-            # Initialise  last  lambda -return  for  not  terminated  episodes
-            ret = target_qs.new_zeros(*target_qs.shape)
-            # print("rewards", rewards.shape)  # coma only supports shared reward
             rewards = torch.max(rewards, -1)[1].unsqueeze(3)  # coma only supports shared reward
             terminated = terminated.permute(0, 1, 3, 2)
             mask = mask.permute(0, 1, 3, 2)
-            ret[:, -1] = target_qs[:, -1] * (1 - torch.sum(terminated, dim=1))
-            # Backwards  recursive  update  of the "forward  view"
-            for t in range(ret.shape[1] - 2, -1, -1):
-                # print("ret", ret[:, t].shape)
-                # print("mask", mask[:, t].shape)
-
-                header = td_lambda * gamma * ret[:, t + 1]
-                tail = rewards[:, t] + (1 - td_lambda) * gamma * target_qs[:, t + 1] * (1 - terminated[:, t])
-                # print(header.shape)
-                # print(tail.shape)
-                ret[:, t] = header + mask[:, t] * tail
             # Returns lambda-return from t=0 to t=T-1, i.e. in B*T-1*A
-            return ret[:, 0:-1]
+            return td_lambda_targets(rewards, terminated, mask, target_qs, gamma, td_lambda)
 
         mask = active_agent
         bs = obs.shape[0]
         # Optimise critic
         # print("before obs tc", obs.shape)
         # print("before actions tc", actions.shape)
-        target_q_vals = self.target_critic(obs, states, actions)  # this is an MLP, but with counterfactual inputs
         # print("after tc, target q val", target_q_vals.shape)
         # this "un-onehot"
         # torch.max(actions, -1)[1].unsqueeze(3).long()
@@ -471,43 +394,24 @@ class COMATrainer(DQNTrainer):
         return q_vals, running_log
 
     def train_from_torch(self, batch):
-        rewards = batch["rewards"]
-        terminals = batch["terminals"]
-        obs = batch["observations"]
-        states = batch["states"]
-        actions = batch["actions"]
-        next_obs = batch["next_observations"]
-        active_agent = batch["active_agents"]
-
-        """
-        # deal with ragged inputs later...
-        obs = torch.from_numpy(np.stack(obs, axis=0)).float()
-        next_obs = torch.from_numpy(np.stack(next_obs, axis=0)).float()
-        terminals = torch.from_numpy(np.stack(terminals, axis=0)).float()
-        actions = torch.from_numpy(np.stack(actions, axis=0)).float()
-        rewards = torch.from_numpy(np.stack(rewards, axis=0)).float()
-        states = torch.from_numpy(np.stack(states, axis=0)).float()
-        active_agent = torch.from_numpy(np.stack(active_agent, axis=0)).float()
-        """
-
-        def to_tensor(x):
-            try:
-                return torch.from_numpy(np.array(x, dtype=float)).float()
-            except:
-                x = np.stack([x_.flatten()[np.newaxis, :] for x_ in x], 0)
-                return torch.from_numpy(x).float()
-
         total_coma_loss = []
 
-        for b in range(len(obs)):
-            rewards = to_tensor(batch["rewards"][b])
-            terminals = to_tensor(batch["terminals"][b])
-            obs = to_tensor(batch["observations"][b])
-            states = to_tensor(batch["states"][b])
-            active_agent = to_tensor(batch["active_agents"][b])
+        # the target critic is fixed until the soft update after the loop,
+        # so it is evaluated once on the padded batch (its inputs at a step
+        # only depend on that step and the one before)
+        with torch.no_grad():
+            target_q_vals = self.target_critic(batch["observations"], batch["states"], batch["actions"])
+
+        for b in range(len(batch)):
+            episode = batch.episode(b)
+            rewards = episode["rewards"]
+            terminals = episode["terminals"]
+            obs = episode["observations"]
+            states = episode["states"]
+            active_agent = episode["active_agents"]
             # state_0 = batch["states_0"]
-            actions = to_tensor(batch["actions"][b])
-            next_obs = to_tensor(batch["next_observations"][b])
+            actions = episode["actions"]
+            next_obs = episode["next_observations"]
 
             rewards = rewards.unsqueeze(0)
             terminals = terminals.unsqueeze(0)
@@ -529,7 +433,15 @@ class COMATrainer(DQNTrainer):
             """
             train critic here...
             """
-            q_vals, critic_train_stats = self._train_critic(obs, states, rewards, terminals, actions, active_agent)
+            q_vals, critic_train_stats = self._train_critic(
+                obs,
+                states,
+                rewards,
+                terminals,
+                actions,
+                active_agent,
+                batch.unpadded(b, target_q_vals, "observations").unsqueeze(0),
+            )
             q_vals = q_vals.detach()
             # print("critic trained!")
             # print("qvals", q_vals.shape)
@@ -539,10 +451,6 @@ class COMATrainer(DQNTrainer):
             """
             # compute: best_action_idxs = self.qf(next_obs).max(1, keepdim=True)[1]
             # this is "equivalent" to self.qf(next_obs) and self.qf(obs)
-            obs = [batch["observations"][b]]
-            next_obs = [batch["next_observations"][b]]
-            batch_num = len(obs)
-            obs = torch.from_numpy(np.stack(obs, axis=0)).float()
             obs_qs = self.qf(obs[:, :-1])
             obs_qs = obs_qs / obs_qs.sum(dim=-1, keepdim=True)
 
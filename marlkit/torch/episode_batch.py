@@ -0,0 +1,298 @@
+"""
+A pymarl style container for a batch of whole episodes.
+
+The whole path replay buffers (e.g. `FullMAEnvReplayBuffer`) return
+`random_batch` as a dict of lists, with one (possibly ragged) entry per
+episode. `EpisodeBatch` converts this once into float32 tensors padded to
+`[B, T_max, *step_shape]`, so that every multi-agent trainer works off the
+same tensors instead of re-converting (and re-stacking) each episode.
+
+The per-step shape of every key is kept as emitted by `marl_rollout`, e.g.
+
+*  observations, next_observations: `[B, T, N, obs_dim]`
+*  actions: `[B, T, N, action_dim]` (one-hot)
+*  rewards, terminals: `[B, T, 1, N]`
+*  states, next_states: `[B, T, 1, state_dim]`
+*  active_agents: `[B, T, 1, max_num_agents]`
+
+A step whose shape cannot be reconciled with the rest of the episode
+(typically the final next observation once agents have left the env) ends
+the episode at that step for every key, which is what the per-trainer
+`to_tensor` fallbacks used to do.
+"""
+
+import numpy as np
+import torch
+
+import marlkit.torch.pytorch_util as ptu
+from marlkit.data_management.path_builder import stack_steps
+
+# which dimension of the per step shape indexes agents
+AGENT_DIMS = dict(
+    observations=0,
+    next_observations=0,
+    actions=0,
+    rewards=1,
+    terminals=1,
+)
+
+
+class EpisodeBatch(object):
+    def __init__(self, data, lengths, step_shapes, device=None):
+        """
+        Use `EpisodeBatch.from_random_batch` rather than constructing directly.
+
+        :param data: dict of padded tensors `[B, T, *step_shape]`
+        :param lengths: number of valid steps in each episode
+        :param step_shapes: `step_shapes[key][b]` is the unpadded per step
+        shape of `key` in episode `b`
+        """
+        self.data = data
+        self.lengths = np.asarray(lengths, dtype=int)
+        self.step_shapes = step_shapes
+        self.device = ptu.device if device is None else device
+        self._cache = {}
+
+    @classmethod
+    def from_random_batch(cls, batch, device=None):
+        keys = list(batch.keys())
+        batch_size = len(batch[keys[0]])
+        episodes = {key: [stack_steps(batch[key][b]) for b in range(batch_size)] for key in keys}
+        lengths = [min(len(episodes[key][b]) for key in keys) for b in range(batch_size)]
+        max_length = max(lengths) if batch_size > 0 else 0
+
+        data = {}
+        step_shapes = {}
+        for key in keys:
+            shapes = [episodes[key][b].shape[1:] for b in range(batch_size)]
+            ndim = max(len(shape) for shape in shapes)
+            # episodes cut at step 0 have no step shape, don't let them decide the padding
+            shapes = [shape if len(shape) == ndim else (0,) * ndim for shape in shapes]
+            max_shape = tuple(np.max(np.array(shapes, dtype=int).reshape(batch_size, ndim), 0))
+            padded = np.zeros((batch_size, max_length) + max_shape, dtype=np.float32)
+            for b in range(batch_size):
+                padded[(b, slice(0, lengths[b])) + tuple(slice(0, d) for d in shapes[b])] = episodes[key][b][
+                    : lengths[b]
+                ]
+            data[key] = torch.from_numpy(padded).to(ptu.device if device is None else device)
+            step_shapes[key] = shapes
+        return cls(data, lengths, step_shapes, device=device)
+
+    """
+    Dict like access to the padded tensors
+    """
+
+    def __getitem__(self, item):
+        if isinstance(item, str):
+            return self.data[item]
+        return self._select(item)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def keys(self):
+        return self.data.keys()
+
+    def items(self):
+        return self.data.items()
+
+    @property
+    def batch_size(self):
+        return len(self.lengths)
+
+    @property
+    def max_seq_length(self):
+        return int(self.lengths.max()) if len(self.lengths) > 0 else 0
+
+    @property
+    def n_agents(self):
+        """
+        Number of agents in each episode
+        """
+        return np.array([shape[0] if len(shape) else 0 for shape in self.step_shapes["observations"]], dtype=int)
+
+    """
+    Masks
+    """
+
+    @property
+    def filled(self):
+        """
+        `[B, T]` mask of the valid (non padded) steps
+        """
+        if "filled" not in self._cache:
+            steps = torch.arange(self.data["observations"].shape[1], device=self.device)
+            lengths = torch.as_tensor(self.lengths, device=self.device)
+            self._cache["filled"] = (steps.unsqueeze(0) < lengths.unsqueeze(1)).float()
+        return self._cache["filled"]
+
+    @property
+    def agent_mask(self):
+        """
+        `[B, T, N]` mask of the agents which are present (non padded) at each step
+        """
+        if "agent_mask" not in self._cache:
+            agents = torch.arange(self.data["observations"].shape[2], device=self.device)
+            n_agents = torch.as_tensor(self.n_agents, device=self.device)
+            agent_mask = (agents.unsqueeze(0) < n_agents.unsqueeze(1)).float()
+            self._cache["agent_mask"] = self.filled.unsqueeze(2) * agent_mask.unsqueeze(1)
+        return self._cache["agent_mask"]
+
+    """
+    Derived views, these are computed once and cached
+    """
+
+    @property
+    def actions_index(self):
+        """
+        `[B, T, N, 1]` index of the (one-hot) action taken
+        """
+        if "actions_index" not in self._cache:
+            self._cache["actions_index"] = self.data["actions"].max(-1, keepdim=True)[1]
+        return self._cache["actions_index"]
+
+    @property
+    def last_actions(self):
+        """
+        `[B, T, N, action_dim]` one-hot action taken at the previous step
+        (zeros at the first step) as used for the agent inputs in pymarl
+        """
+        if "last_actions" not in self._cache:
+            actions = self.data["actions"]
+            last_actions = torch.zeros_like(actions)
+            last_actions[:, 1:] = actions[:, :-1]
+            self._cache["last_actions"] = last_actions
+        return self._cache["last_actions"]
+
+    def shifted(self, key):
+        """
+        `key` at the next step, i.e. `shifted(key)[:, t] == batch[key][:, t + 1]`,
+        padded with zeros at the final step.
+        """
+        cache_key = "shifted/" + key
+        if cache_key not in self._cache:
+            value = self.data[key]
+            shifted = torch.zeros_like(value)
+            shifted[:, :-1] = value[:, 1:]
+            self._cache[cache_key] = shifted
+        return self._cache[cache_key]
+
+    """
+    Slicing
+    """
+
+    def episode(self, b):
+        """
+        Returns a dict with the unpadded `[T_b, *step_shape]` tensors for
+        episode `b`. These are views into the padded tensors.
+        """
+        episode = {}
+        for key, value in self.data.items():
+            shape = self.step_shapes[key][b]
+            episode[key] = value[(b, slice(0, self.lengths[b])) + tuple(slice(0, d) for d in shape)]
+        return episode
+
+    def concatenated(self, key):
+        """
+        Unpadded steps of every episode concatenated along the time axis
+        """
+        return torch.cat([self.episode(b)[key] for b in range(self.batch_size)], 0)
+
+    def unpadded(self, b, value, key):
+        """
+        Episode `b` of `value`, a `[B, T, ...]` tensor computed step by step
+        from the padded `key` (e.g. a network evaluated on `batch[key]`),
+        without the padded steps and, if `key` has an agent dimension, the
+        padded agents, as in `episode(b)`.
+        """
+        index = (b, slice(0, self.lengths[b]))
+        if key in AGENT_DIMS:
+            dim = AGENT_DIMS[key]
+            shape = self.step_shapes[key][b]
+            index += (slice(None),) * dim + (slice(0, shape[dim] if len(shape) > dim else 0),)
+        return value[index]
+
+    def shape_groups(self, *keys):
+        """
+        Indices of the episodes grouped by the step shapes of `keys`
+        """
+        groups = {}
+        for b in range(self.batch_size):
+            shapes = tuple(tuple(self.step_shapes[key][b]) for key in keys)
+            groups.setdefault(shapes, []).append(b)
+        return groups
+
+    def map_steps(self, fn, *keys):
+        """
+        Evaluates `fn`, which must act on every step independently, on the
+        unpadded `keys` of every episode. This is one call per group of
+        episodes with the same step shapes (see `shape_groups`) on the steps
+        of the group flattened to `[G * T, *step_shape]`, for networks which
+        pad the agents (or the state) of an episode themselves and so can't
+        be evaluated on the padded tensors.
+
+        :return: list of the `[T_b, ...]` outputs of every episode, None
+        for the episodes without any step
+        """
+        outputs = [None] * self.batch_size
+        for shapes, indices in self.shape_groups(*keys).items():
+            index = torch.as_tensor(indices, device=self.device)
+            length = int(self.lengths[indices].max())
+            if length == 0:
+                continue
+            inputs = []
+            for key, shape in zip(keys, shapes):
+                value = self.data[key].index_select(0, index)
+                value = value[(slice(None), slice(0, length)) + tuple(slice(0, d) for d in shape)]
+                inputs.append(value.reshape((-1,) + shape))
+            output = fn(*inputs)
+            output = output.reshape((len(indices), length) + output.shape[1:])
+            for i, b in enumerate(indices):
+                outputs[b] = output[i, : self.lengths[b]]
+        return outputs
+
+    def _select(self, item):
+        if isinstance(item, int):
+            item = [item]
+        indices = np.arange(self.batch_size)[item]
+        data = {key: value[indices] for key, value in self.data.items()}
+        step_shapes = {key: [shapes[i] for i in indices] for key, shapes in self.step_shapes.items()}
+        return EpisodeBatch(data, self.lengths[indices], step_shapes, device=self.device)
+
+    def time_slice(self, start=None, stop=None):
+        """
+        Returns the batch restricted to steps `[start, stop)`
+        """
+        steps = slice(start, stop)
+        data = {key: value[:, steps] for key, value in self.data.items()}
+        start, stop, _ = steps.indices(self.data["observations"].shape[1])
+        lengths = np.clip(self.lengths - start, 0, max(stop - start, 0))
+        return EpisodeBatch(data, lengths, self.step_shapes, device=self.device)
+
+    def agent_slice(self, agents):
+        """
+        Returns the batch restricted to `agents` (an index, a sorted list of
+        indices or a slice) for every key which has an agent dimension.
+        """
+        if isinstance(agents, int):
+            agents = [agents]
+        data = {}
+        step_shapes = {}
+        for key, value in self.data.items():
+            if key not in AGENT_DIMS:
+                data[key] = value
+                step_shapes[key] = self.step_shapes[key]
+                continue
+            dim = AGENT_DIMS[key]
+            selected = np.arange(value.shape[dim + 2])[agents]
+            data[key] = value[(slice(None),) * (dim + 2) + (torch.as_tensor(selected, device=value.device),)]
+            shapes = []
+            for shape in self.step_shapes[key]:
+                if len(shape) > dim:
+                    shape = shape[:dim] + (int((selected < shape[dim]).sum()),) + shape[dim + 1 :]
+                shapes.append(shape)
+            step_shapes[key] = shapes
+        return EpisodeBatch(data, self.lengths, step_shapes, device=self.device)
@@ -0,0 +1,102 @@
+"""
+Compiled inference for rollout policies.
+
+The rollout networks are small `Mlp`/`RNNNetwork` models evaluated on a
+single observation at a time, so most of the time of an env step is spent in
+python dispatch rather than in the matmuls. `InferenceGraph` traces the
+forward of a module once per input signature with `torch.jit.trace` and runs
+the traced graph under `torch.inference_mode`.
+
+The traced graph shares its parameters with the module, so in place weight
+updates (optimizer steps, `ptu.set_flat_params`, `load_state_dict`) are seen
+without retracing. The graph is retraced when the parameter storage is replaced
+(e.g. `module.to(device)`), and, with `freeze=True` (the weights are then
+folded into the graph as constants), whenever their version changes. Call
+`refresh` after writing to `param.data` directly with `freeze=True`, or after
+assigning new `nn.Parameter`s to the module.
+
+If a module cannot be traced the eager forward is used.
+"""
+
+import warnings
+
+import torch
+from torch import nn
+
+
+class InferenceGraph(object):
+    def __init__(self, module, freeze=False):
+        """
+        :param module: the `nn.Module` whose forward is compiled
+        :param freeze: fold the weights into the graph, faster but retraced
+        after every weight update
+        """
+        self.module = module
+        self.freeze = freeze
+        self._graphs = {}
+        self._fingerprint = None
+        self._params = None
+        self._eager = False
+
+    def _current_fingerprint(self):
+        if self._params is None:
+            # walking the module tree on every call costs as much as the forward
+            self._params = list(self.module.parameters())
+        if self.freeze:
+            return tuple((p.data_ptr(), p._version) for p in self._params)
+        return tuple(p.data_ptr() for p in self._params)
+
+    def refresh(self):
+        self._graphs = {}
+        self._fingerprint = None
+        self._params = None
+
+    def _trace(self, inputs):
+        try:
+            with warnings.catch_warnings(), torch.no_grad():
+                warnings.simplefilter("ignore")
+                graph = torch.jit.trace(self.module, inputs, check_trace=False)
+                if self.freeze:
+                    graph = torch.jit.freeze(graph.eval())
+            return graph
+        except Exception as e:
+            warnings.warn("could not trace {}, using the eager forward: {}".format(type(self.module).__name__, e))
+            self._eager = True
+            return None
+
+    def __call__(self, *inputs):
+        if self._eager:
+            with torch.inference_mode():
+                return self.module(*inputs)
+        fingerprint = self._current_fingerprint()
+        if fingerprint != self._fingerprint:
+            self._graphs = {}
+            self._fingerprint = fingerprint
+        key = tuple((x.shape, x.dtype, x.device) for x in inputs)
+        if key not in self._graphs:
+            self._graphs[key] = self._trace(inputs)
+            if self._eager:
+                return self(*inputs)
+        with torch.inference_mode():
+            return self._graphs[key](*inputs)
+
+    def __getstate__(self):
+        # the traced graphs can't be pickled, they are rebuilt on the next call
+        state = self.__dict__.copy()
+        state["_graphs"] = {}
+        state["_fingerprint"] = None
+        state["_params"] = None
+        return state
+
+
+class ArgmaxHead(nn.Module):
+    """
+    `argmax(module(x), -1)`, to trace the greedy action into the same graph as the network.
+    """
+
+    def __init__(self, module):
+        super().__init__()
+        self.module = module
+
+    def forward(self, x):
+        return self.module(x).argmax(-1)
@@ -17,6 +17,44 @@ class VDNMixer(nn.Module):
         return torch.sum(qs, dim=2, keepdim=True)
 
 
+# (n_in, n_out, device) -> index used by replication_pad
+_PAD_INDEX = {}
+
+
+def replication_pad_index(n_in, n_out, device=None):
+    """
+    Index into the last dimension which is equivalent to (centered)
+    `nn.ReplicationPad1d` from `n_in` to `n_out`, cropping if `n_out < n_in`.
+    These are cached so padding never builds modules or index tensors.
+    """
+    key = (n_in, n_out, device)
+    if key not in _PAD_INDEX:
+        pad_target = (n_out - n_in) // 2
+        _PAD_INDEX[key] = torch.clamp(torch.arange(n_out, device=device) - pad_target, 0, n_in - 1)
+    return _PAD_INDEX[key]
+
+
+def replication_pad(x, size):
+    """
+    Replication pads (or crops) the last dimension of `x` to `size`
+    """
+    if x.size(-1) == size:
+        return x
+    return x.index_select(-1, replication_pad_index(x.size(-1), size, x.device))
+
+
+def mask_pad(x, size, mask=None):
+    """
+    Zeros out the masked entries of the last dimension of `x` and zero pads
+    (or crops) it to `size`
+    """
+    if mask is not None:
+        x = x * mask.reshape(x.shape)
+    if x.size(-1) == size:
+        return x
+    return F.pad(x, (0, size - x.size(-1)))
+
+
 class QMixer(nn.Module):
     def __init__(self, n_agents, state_shape, mixing_embed_dim):
         super(QMixer, self).__init__()
@@ -40,64 +78,42 @@ class QMixer(nn.Module):
             nn.Linear(self.embed_dim, 1),
         )
 
-    def forward(self, agent_qs, states):
+    def forward(self, agent_qs, states, agent_mask=None):
         """Forward pass for the mixer.
         Args:
-            agent_qs: Tensor of shape [B, T, n_agents, n_actions]
-            states: Tensor of shape [B, T, state_dim]
+            agent_qs: Tensor of shape [B, T, n_agents] (or [B, T, n_agents, 1])
+            states: Tensor of shape [B, T, state_dim] (or [B, T, 1, state_dim])
+            agent_mask: optional Tensor of shape [B, T, n_agents], the agents
+                which are masked out are zeroed and missing agents are zero
+                padded. Without it missing agents are replication padded.
         """
         bs = agent_qs.size(0)
         n_agents = agent_qs.size(2)
-        state_dim = states.size(2)
-
-        if n_agents != self.n_agents:
-            # need to pad it out with zeros
-            pad_target = (self.n_agents - n_agents) // 2
-            agent_qs = nn.ReplicationPad1d((pad_target, self.n_agents - pad_target - n_agents))(agent_qs)
-        if state_dim != self.state_dim:
-            pad_target = (self.state_dim - state_dim) // 2
-            states = nn.ReplicationPad1d((pad_target, self.state_dim - pad_target - state_dim))(states)
-        states = states.reshape(-1, self.state_dim)
-
-        try:
-            # First layer
-            w1 = torch.abs(self.hyper_w_1(states))
-            b1 = self.hyper_b_1(states)
-            # unsafe/dynamic mode
-            w1 = w1.view(-1, self.n_agents, self.embed_dim)
-            b1 = b1.view(-1, 1, self.embed_dim)
-            hidden = F.elu(torch.bmm(agent_qs, w1) + b1)
-            # Second layer
-            w_final = torch.abs(self.hyper_w_final(states))
-            w_final = w_final.view(-1, self.embed_dim, 1)
-            # State-dependent bias
-            v = self.V(states).view(-1, 1, 1)
-            # Compute final output
-            y = torch.bmm(hidden, w_final) + v
-            # Reshape and return
-            q_tot = y.view(bs, -1, 1)
-            return q_tot
-
-        except:
-            # try unsafe/dynamic mode
-            agent_qs = agent_qs.reshape(-1, 1, self.n_agents)
-            # First layer
-            w1 = torch.abs(self.hyper_w_1(states))
-            b1 = self.hyper_b_1(states)
-            # unsafe/dynamic mode
-            w1 = w1.view(-1, self.n_agents, self.embed_dim)
-            b1 = b1.view(-1, 1, self.embed_dim)
-            hidden = F.elu(torch.bmm(agent_qs, w1) + b1)
-            # Second layer
-            w_final = torch.abs(self.hyper_w_final(states))
-            w_final = w_final.view(-1, self.embed_dim, 1)
-            # State-dependent bias
-            v = self.V(states).view(-1, 1, 1)
-            # Compute final output
-            y = torch.bmm(hidden, w_final) + v
-            # Reshape and return
-            q_tot = y.view(bs, -1, 1)
-            return q_tot
+
+        agent_qs = agent_qs.reshape(-1, n_agents)
+        if agent_mask is not None:
+            agent_qs = mask_pad(agent_qs, self.n_agents, agent_mask)
+        else:
+            agent_qs = replication_pad(agent_qs, self.n_agents)
+        agent_qs = agent_qs.unsqueeze(1)
+        states = replication_pad(states, self.state_dim).reshape(-1, self.state_dim)
+
+        # First layer
+        w1 = torch.abs(self.hyper_w_1(states))
+        b1 = self.hyper_b_1(states)
+        w1 = w1.view(-1, self.n_agents, self.embed_dim)
+        b1 = b1.view(-1, 1, self.embed_dim)
+        hidden = F.elu(torch.bmm(agent_qs, w1) + b1)
+        # Second layer
+        w_final = torch.abs(self.hyper_w_final(states))
+        w_final = w_final.view(-1, self.embed_dim, 1)
+        # State-dependent bias
+        v = self.V(states).view(-1, 1, 1)
+        # Compute final output
+        y = torch.bmm(hidden, w_final) + v
+        # Reshape and return
+        q_tot = y.view(bs, -1, 1)
+        return q_tot
 
 
 class QTranBase(nn.Module):
@@ -134,40 +150,117 @@ class QTranBase(nn.Module):
         self.ae_input = ae_input
         self.action_encoding = nn.Sequential(nn.Linear(ae_input, ae_input), nn.ReLU(), nn.Linear(ae_input, ae_input))
 
-    def forward(self, obs, actions, states, hidden_states):
-        # TODO ensure everything is padded appropriately
-        agent_state_action_input = torch.cat([hidden_states, actions], dim=2)
-        if agent_state_action_input.size(-1) != self.ae_input:
-            padd = (self.ae_input - agent_state_action_input.shape[-1]) // 2
-            agent_state_action_input = nn.ReplicationPad1d(agent_state_action_input, (padd, self.ae_input - padd))
+    def forward(self, obs, actions, states, hidden_states, agent_mask=None):
+        """
+        Args:
+            actions, hidden_states: Tensors of shape [..., n_agents, dim]
+            states: Tensor of shape [..., 1, state_dim]
+            agent_mask: optional Tensor of shape [..., n_agents], masked out
+                agents do not contribute to the joint action encoding
+        """
+        agent_state_action_input = torch.cat([hidden_states, actions], dim=-1)
+        agent_state_action_input = replication_pad(agent_state_action_input, self.ae_input)
         agent_state_action_encoding = self.action_encoding(agent_state_action_input)
-        agent_state_action_encoding = agent_state_action_encoding.sum(dim=1)  # Sum across agents
-
-        inputs = torch.cat([states.squeeze(1), agent_state_action_encoding], dim=1)
-        if inputs.size(-1) != self.q_input_size:
-            # pad.
-            inputs = inputs.unsqueeze(1)
-            pad_target = (self.q_input_size - inputs.size(-1)) // 2
-
-            inputs = nn.ReplicationPad1d((pad_target, self.q_input_size - inputs.size(-1) - pad_target))(inputs)
-            inputs = inputs.squeeze(1)
-        q_outputs = self.Q(inputs)
-
-        if states.size(-1) != self.state_dim:
-            # states = states.unsqueeze(1)
-            pad_target = (self.state_dim - states.size(-1)) // 2
-            states = nn.ReplicationPad1d((pad_target, self.state_dim - pad_target - states.size(-1)))(states)
-            # states = states.squeeze(1)
-        v_outputs = self.V(states)
+        if agent_mask is not None:
+            agent_state_action_encoding = agent_state_action_encoding * agent_mask.unsqueeze(-1)
+        agent_state_action_encoding = agent_state_action_encoding.sum(dim=-2)  # Sum across agents
+
+        flat_states = states.reshape(agent_state_action_encoding.shape[:-1] + (-1,))
+        inputs = torch.cat([flat_states, agent_state_action_encoding], dim=-1)
+        q_outputs = self.Q(replication_pad(inputs, self.q_input_size))
+
+        v_outputs = self.V(replication_pad(states, self.state_dim))
         return q_outputs, v_outputs
 
 
+# (n_agents, device) -> identity used to build the agent graphs
+_EYE = {}
+
+
+def cached_eye(n_agents, device=None):
+    key = (n_agents, device)
+    if key not in _EYE:
+        _EYE[key] = torch.eye(n_agents, n_agents, device=device)
+    return _EYE[key]
+
+
+class AgentGraph(object):
+    """
+    Normalized agent adjacency `D A D` (with `D = diag(sqrt(colsum(A)))`) as
+    used by QCGraph, where every agent is linked to itself, to one agent
+    drawn with a hard gumbel softmax and to the agents whose assignment
+    score beats the state score.
+
+    With `top_k` the graph is kept sparse instead: every agent is linked to
+    itself and to the `top_k` agents with the highest gumbel perturbed
+    score, so that propagating over it costs O(N * k) rather than O(N^2).
+    """
+
+    def __init__(self, agent_score, state_score, top_k=None):
+        """
+        :param agent_score: [B, N, N] assignment scores
+        :param state_score: [B, N, 1] state score, broadcast over the neighbours
+        """
+        n_agents = agent_score.size(-1)
+        eye = cached_eye(n_agents, agent_score.device)
+        agent_score = agent_score + eye * -1e16
+        self.top_k = top_k
+        if top_k is None or top_k >= n_agents - 1:
+            self.top_k = None
+            oneness_knn = F.gumbel_softmax(agent_score, hard=True)
+            dynamic_knn = agent_score.softmax(-1) > state_score
+            # this provides agents with a hard assignment to at least one other agent
+            adjacency = torch.clamp(eye + dynamic_knn + oneness_knn, 0, 1)
+            # normalizing rowwise as per kipf et al.
+            d = torch.sqrt(torch.sum(adjacency, dim=-2))
+            self.adjacency = adjacency * d.unsqueeze(-1) * d.unsqueeze(-2)
+        else:
+            gumbels = -torch.empty_like(agent_score).exponential_().log()
+            perturbed = agent_score + gumbels
+            _, self.index = perturbed.topk(top_k, dim=-1)  # B, N, k
+            soft = perturbed.softmax(-1).gather(-1, self.index)
+            # straight through, the neighbours are hard assignments
+            weight = 1.0 - soft.detach() + soft
+            bs = agent_score.size(0)
+            degree = torch.ones(bs, n_agents, device=agent_score.device, dtype=weight.dtype)
+            degree = degree.scatter_add(1, self.index.reshape(bs, -1), weight.reshape(bs, -1))
+            self.d = torch.sqrt(degree)
+            self.weight = weight * self.d.gather(1, self.index.reshape(bs, -1)).view_as(weight)
+
+    def propagate(self, x):
+        """
+        Returns `D A D x` for `x` of shape [B, N, F]
+        """
+        if self.top_k is None:
+            return torch.bmm(self.adjacency, x)
+        bs, n_agents, k = self.index.shape
+        neighbours = x.gather(1, self.index.reshape(bs, n_agents * k, 1).expand(-1, -1, x.size(-1)))
+        neighbours = neighbours.view(bs, n_agents, k, x.size(-1))
+        d = self.d.unsqueeze(-1)
+        return d * (d * x + torch.sum(self.weight.unsqueeze(-1) * neighbours, dim=2))
+
+
+def graph_states(states, bs, n_agents, state_dim):
+    """
+    Pads the states to `state_dim` and gives every agent its own copy
+    (unless there already is one state per agent), [B, n_agents, state_dim]
+    """
+    if states.size(-1) != state_dim:
+        states = replication_pad(states, state_dim).reshape(bs, -1, state_dim)
+    elif int(np.prod(states.shape)) == (bs * n_agents * state_dim):
+        return states.reshape(bs, n_agents, state_dim)
+    else:
+        states = states.reshape(bs, -1, state_dim)
+    return states.repeat(1, n_agents, 1)
+
+
 class QCGraphQmix(nn.Module):
     # QMIX variation
-    def __init__(self, n_agents, state_shape, mixing_embed_dim, rnn_hidden_dim):
+    def __init__(self, n_agents, state_shape, mixing_embed_dim, rnn_hidden_dim, top_k=None):
         super(QCGraphQmix, self).__init__()
 
         self.n_agents = n_agents
+        self.top_k = top_k
         self.state_dim = int(np.prod(state_shape))
         self.rnn_hidden_dim = rnn_hidden_dim
 
@@ -195,49 +288,31 @@ class QCGraphQmix(nn.Module):
             nn.Linear(self.embed_dim, 1),
         )
 
-    def forward(self, agent_qs, states, hidden_states):
-        # assign each agent to another agent
-        agent_score = self.assign_agent(hidden_states)
-        n_agents = agent_score.size(-2)
-        bs = agent_score.shape[0]
-        if agent_score.size(-1) != agent_score.size(-2):
-            agent_score = agent_score[:, :, :n_agents]
-
-        if states.size(-1) != self.state_dim:
-            # states = states.unsqueeze(1)
-            pad_target = (self.state_dim - states.size(-1)) // 2
-            states = nn.ReplicationPad1d((pad_target, self.state_dim - pad_target - states.size(-1)))(states)
-            # states = states.squeeze(1)
-            states = states.repeat(1, n_agents, 1)
-        elif int(np.prod(states.shape)) == (bs * n_agents * self.state_dim):
-            states = states.view(bs, n_agents, self.state_dim)
-        else:
-            states = states.repeat(1, n_agents, 1)
-
-        state_score = self.assign_bias(states).repeat(1, n_agents, n_agents)  # B, n_agent, n_agent
-
-        embedding_eye = (torch.eye(n_agents, n_agents).unsqueeze(2)).expand(n_agents, n_agents, bs).permute(2, 0, 1)
-        agent_score = agent_score + (torch.eye(n_agents, n_agents).unsqueeze(0) * -1e16)
-        oneness_knn = F.gumbel_softmax(agent_score, hard=True)
-        dynamic_knn = agent_score.softmax(-1) > state_score[:, :n_agents, :n_agents]
-
-        # this provides agents with a hard assignment to at least one other agent
-        cluster_output = embedding_eye + dynamic_knn + oneness_knn
-        cluster_output = torch.clamp(cluster_output, 0, 1)
+    def forward(self, agent_qs, states, hidden_states, agent_mask=None):
+        """
+        Args:
+            agent_qs: Tensor of shape [..., 1, n_agents]
+            states: Tensor of shape [..., 1, state_dim]
+            hidden_states: Tensor of shape [..., n_agents, rnn_hidden_dim]
+        Every leading dimension (e.g. episodes and time) is batched over.
+        """
+        if agent_mask is not None:
+            agent_qs = mask_pad(agent_qs, agent_qs.size(-1), agent_mask)
+        n_agents = hidden_states.size(-2)
+        hidden_states = hidden_states.reshape(-1, n_agents, self.rnn_hidden_dim)
+        bs = hidden_states.size(0)
+        agent_qs = agent_qs.reshape(bs, 1, -1)[:, :, :n_agents]
 
-        # normalizing rowwise as per kipf et al.
-        adj_d = torch.sqrt(torch.sum(cluster_output, dim=-2, keepdim=True) * embedding_eye)
-        cluster_output = torch.bmm(adj_d, cluster_output)
-        cluster_output = torch.bmm(cluster_output, adj_d)
+        # assign each agent to another agent
+        agent_score = self.assign_agent(hidden_states)[:, :, :n_agents]
+        states = graph_states(states, bs, n_agents, self.state_dim)
+        graph = AgentGraph(agent_score, self.assign_bias(states), self.top_k)
 
         # add gcn - this is guarenteed to be monotonic
-        # print(cluster_output.shape, agent_qs.shape)
-        w1 = torch.bmm(cluster_output, agent_qs[:, :, :n_agents].permute(0, 2, 1))
+        w1 = graph.propagate(agent_qs.permute(0, 2, 1))
 
         # follow qmix, make sure monotonic
         # first layer
-        # print(torch.bmm(agent_qs, w1).shape) # 1 32!
-        # w1 = torch.abs(self.hyper_w_1(states))
         b1 = self.hyper_b_1(states)
 
         # w1 is size
@@ -246,10 +321,6 @@ class QCGraphQmix(nn.Module):
         # second layer
         w_final = self.hyper_w_final(states).permute(0, 2, 1)
 
-        # apply learned diffpool weights to "unpool"
-        # this is also monotonic
-        AF = torch.bmm(cluster_output, hidden)
-        s = torch.bmm(AF, w_final)
         # State-dependent bias
         v_outputs = self.V(states)
 
@@ -259,10 +330,13 @@ class QCGraphQmix(nn.Module):
 
 
 class QCGraph(nn.Module):
-    def __init__(self, n_agents, n_actions, state_shape, mixing_embed_dim, rnn_hidden_dim, graph_mode=False):
+    def __init__(
+        self, n_agents, n_actions, state_shape, mixing_embed_dim, rnn_hidden_dim, graph_mode=False, top_k=None
+    ):
         super(QCGraph, self).__init__()
 
         self.n_agents = n_agents
+        self.top_k = top_k
         self.state_dim = int(np.prod(state_shape))
         self.embed_dim = mixing_embed_dim
         self.rnn_hidden_dim = rnn_hidden_dim
@@ -290,56 +364,25 @@ class QCGraph(nn.Module):
         )
 
     def forward(self, obs, actions, states, hidden_states):
+        """
+        Args:
+            actions, hidden_states: Tensors of shape [..., n_agents, dim]
+            states: Tensor of shape [..., 1, state_dim] (or one state per agent)
+        Every leading dimension (e.g. episodes and time) is batched over.
+        """
         # copy the signature of QTran for easy integration
-        agent_state_action_input = torch.cat([hidden_states, actions], dim=2)  # input for our graph
-        # print("agent_state_action_input", agent_state_action_input.shape)
+        agent_state_action_input = torch.cat([hidden_states, actions], dim=-1)  # input for our graph
+        n_agents = agent_state_action_input.size(-2)
+        agent_state_action_input = agent_state_action_input.reshape(-1, n_agents, agent_state_action_input.size(-1))
+        bs = agent_state_action_input.size(0)
 
         # assign each agent to another agent
-        agent_score = self.assign_agent(agent_state_action_input)  # B, n_agent, n_agent
-
-        n_agents = agent_score.size(-2)
-        if agent_score.size(-1) != agent_score.size(-2):
-            agent_score = agent_score[:, :, :n_agents]
-        bs = agent_score.shape[0]
-
-        # maybe there should be a dynamic/unsafe
-        # change here to alter the shape before
-        # going into assign_bias.
-        print(states.shape, self.state_dim)
-        if states.size(-1) != self.state_dim:
-            # states = states.unsqueeze(1)
-            pad_target = (self.state_dim - states.size(-1)) // 2
-            states = nn.ReplicationPad1d((pad_target, self.state_dim - pad_target - states.size(-1)))(states)
-            # states = states.squeeze(1)
-            states = states.repeat(1, n_agents, 1)
-        elif int(np.prod(states.shape)) == (bs * n_agents * self.state_dim):
-            states = states.view(bs, n_agents, self.state_dim)
-        else:
-            states = states.repeat(1, n_agents, 1)
-
-        state_score = self.assign_bias(states).repeat(1, n_agents, n_agents)  # B, n_agent, n_agent
-        state_score = state_score[:, :n_agents, :n_agents]
-
-        embedding_eye = (torch.eye(n_agents, n_agents).unsqueeze(2)).expand(n_agents, n_agents, bs).permute(2, 0, 1)
-        # print(agent_score.shape)
-        agent_score = agent_score + (torch.eye(n_agents, n_agents).unsqueeze(0) * -1e16)
-        oneness_knn = F.gumbel_softmax(agent_score, hard=True)
-        # print(agent_state_action_input.shape)
-        # print(agent_score.shape)
-        # print(state_score.shape)
-        dynamic_knn = agent_score.softmax(-1) > state_score
-
-        # this provides agents with a hard assignment to at least one other agent
-        cluster_output = embedding_eye + dynamic_knn + oneness_knn
-        cluster_output = torch.clamp(cluster_output, 0, 1)
-
-        # normalizing rowwise as per kipf et al.
-        adj_d = torch.sqrt(torch.sum(cluster_output, dim=-2, keepdim=True) * embedding_eye)
-        cluster_output = torch.bmm(adj_d, cluster_output)
-        cluster_output = torch.bmm(cluster_output, adj_d)
+        agent_score = self.assign_agent(agent_state_action_input)[:, :, :n_agents]  # B, n_agent, n_agent
+        states = graph_states(states, bs, n_agents, self.state_dim)
+        graph = AgentGraph(agent_score, self.assign_bias(states), self.top_k)
 
         # add gcn
-        agent_all_perm_approx = torch.bmm(cluster_output, agent_state_action_input)
+        agent_all_perm_approx = graph.propagate(agent_state_action_input)
 
         # now follow qmix - first layer
         w1 = self.graph_w1(agent_all_perm_approx)
@@ -351,7 +394,7 @@ class QCGraph(nn.Module):
         w_final = self.hyper_w_final(states).permute(0, 2, 1)
 
         # apply learned diffpool weights to "unpool"
-        AF = torch.bmm(cluster_output, hidden)
+        AF = graph.propagate(hidden)
         s = torch.bmm(AF, w_final)
         # State-dependent bias
         v_outputs = self.V(states)
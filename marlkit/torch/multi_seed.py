@@ -0,0 +1,378 @@
+"""
+Training K independent seeds of the same configuration in one process.
+
+Each seed is a complete `TorchBatchMARLAlgorithm` (its own envs, path
+collectors, replay buffer and trainer), and `MultiSeedTorchBatchMARLAlgorithm`
+steps all of them through the epochs in lockstep, logging every seed to its
+own `setup_logger` style directory (`progress.csv`, `debug.log` and the
+snapshots).
+
+For `DoubleDQNTrainer` (IQL, or VDN/QMIX with a mixer) the seeds are also
+trained together. The networks of the K trainers are stacked into `[K, ...]`
+parameters (`StackedModules`), the per episode loss of every seed is computed
+in one `torch.func.vmap` over the stacked parameters, and the stacked
+parameters are updated by a single optimizer. The optimizers are
+elementwise, so this is the same update as K separate optimizers. The
+parameters of every seed's own networks are views of the stacked ones, so the
+rollout policies and snapshots always see the current weights.
+
+Other trainers are trained one seed after the other.
+
+    algorithms = [make_algorithm(variant, seed) for seed in seeds]
+    algorithm = MultiSeedTorchBatchMARLAlgorithm(algorithms)
+    algorithm.to(ptu.device)
+    algorithm.train()
+
+NOTE: the seeds share the global numpy and torch random streams of the
+process, each seed is still an independent run.
+"""
+
+import copy
+import os.path as osp
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import gtimer as gt
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+import marlkit.torch.pytorch_util as ptu
+from marlkit.core import logger
+from marlkit.core.eval_util import create_stats_ordered_dict
+from marlkit.core.logging import Logger
+from marlkit.torch.dqn.ma_mixer import DoubleDQNTrainer
+
+try:
+    from torch.func import functional_call, vmap
+except ImportError:
+    functional_call = vmap = None
+
+
+class StackedModules(object):
+    """
+    K modules with the same architecture, with their parameters stacked into
+    `[K, *shape]` leaf tensors. The parameters of each module are rebound
+    to views of the stacked ones, so updates to either are shared.
+    """
+
+    def __init__(self, modules):
+        self.modules = list(modules)
+        if len(list(self.modules[0].buffers())) > 0:
+            raise NotImplementedError("modules with buffers can't be stacked")
+        # stateless copy of the architecture for functional_call
+        self.base = copy.deepcopy(self.modules[0]).to("meta")
+        self.params = OrderedDict()
+        named = [dict(module.named_parameters()) for module in self.modules]
+        with torch.no_grad():
+            for name in named[0]:
+                stacked = nn.Parameter(torch.stack([params[name].detach() for params in named], 0))
+                for k, params in enumerate(named):
+                    params[name].data = stacked.data[k]
+                self.params[name] = stacked
+
+    def __len__(self):
+        return len(self.modules)
+
+    def parameters(self):
+        return list(self.params.values())
+
+    def functional(self, params):
+        """
+        The forward of the module with `params`, a dict of (unstacked) parameters.
+        """
+
+        def forward(*inputs):
+            return functional_call(self.base, params, inputs)
+
+        return forward
+
+    def __call__(self, *inputs):
+        """
+        Evaluates every module on its own inputs, `inputs` have a leading `K` dimension.
+        """
+        return vmap(lambda params, *x: self.functional(params)(*x))(dict(self.params), *inputs)
+
+
+def soft_update_stacked(source, target, tau):
+    with torch.no_grad():
+        for target_param, param in zip(target.parameters(), source.parameters()):
+            target_param.copy_(target_param * (1.0 - tau) + param * tau)
+
+
+def _pad_to(x, shape):
+    """
+    Zero pads the trailing dimensions of `x` up to `shape`.
+    """
+    pad = []
+    for size, target in reversed(list(zip(x.shape, shape))):
+        pad.extend([0, target - size])
+    return F.pad(x, pad)
+
+
+def stack_episodes(episodes):
+    """
+    Stacks one unpadded episode (see `EpisodeBatch.episode`) of each of the
+    K seeds into `[K, T, ...]` tensors, zero padded to the longest episode
+    and the largest number of agents.
+
+    :return: the stacked episodes, `[K, T]` mask of the valid steps and
+    `[K, N]` mask of the agents of each episode
+    """
+    stacked = {}
+    for key in episodes[0].keys():
+        values = [episode[key] for episode in episodes]
+        shape = tuple(np.max(np.array([value.shape for value in values]), 0))
+        stacked[key] = torch.stack([_pad_to(value, shape) for value in values], 0)
+    lengths = torch.as_tensor([len(episode["observations"]) for episode in episodes])
+    n_agents = torch.as_tensor([episode["observations"].shape[1] for episode in episodes])
+    steps = torch.arange(stacked["observations"].shape[1])
+    agents = torch.arange(stacked["observations"].shape[2])
+    step_mask = (steps.unsqueeze(0) < lengths.unsqueeze(1)).float().to(stacked["observations"].device)
+    agent_mask = (agents.unsqueeze(0) < n_agents.unsqueeze(1)).float().to(stacked["observations"].device)
+    return stacked, step_mask, agent_mask
+
+
+class MultiSeedDoubleDQNTrainer(object):
+    """
+    Trains K `DoubleDQNTrainer`s (one per seed) with vmapped losses over their
+    stacked networks. This follows `DoubleDQNTrainer.train_from_torch`: one
+    optimizer step per episode of the batch, and only the qf is optimized.
+    """
+
+    def __init__(self, trainers):
+        self.trainers = list(trainers)
+        trainer = self.trainers[0]
+        self.discount = trainer.discount
+        self.soft_target_tau = trainer.soft_target_tau
+        self.target_update_period = trainer.target_update_period
+        self.qf = StackedModules([t.qf for t in self.trainers])
+        self.target_qf = StackedModules([t.target_qf for t in self.trainers])
+        if trainer.mixer is not None:
+            self.mixer = StackedModules([t.mixer for t in self.trainers])
+            self.target_mixer = StackedModules([t.target_mixer for t in self.trainers])
+        else:
+            self.mixer = None
+            self.target_mixer = None
+        optimizer = trainer.qf_optimizer
+        self.qf_optimizer = type(optimizer)(self.qf.parameters(), **optimizer.defaults)
+        self._n_train_steps_total = 0
+
+    @staticmethod
+    def supports(trainers):
+        """
+        Whether the trainers can be trained together, otherwise they are
+        trained one after the other.
+        """
+        if vmap is None:
+            return False
+        for trainer in trainers:
+            if type(trainer) is not DoubleDQNTrainer:
+                return False
+            if trainer.mrl or trainer.use_shared_experience or trainer.inverse_weight:
+                return False
+            if type(trainer.qf_criterion) is not nn.MSELoss or trainer.qf_criterion.reduction != "mean":
+                return False
+        return True
+
+    def _episode_loss(self, params, episode, step_mask, agent_mask):
+        """
+        Loss of a single seed on a single (padded) episode, vmapped over the seeds.
+        """
+        qf = self.qf.functional(params["qf"])
+        target_qf = self.target_qf.functional(params["target_qf"])
+        obs = episode["observations"]
+        next_obs = episode["next_observations"]
+
+        obs_qs = qf(obs)
+        best_action_idxs = qf(next_obs).max(-1, keepdim=True)[1]
+        target_q_values = target_qf(next_obs).gather(-1, best_action_idxs).detach()
+        target_q_values = target_q_values.permute(0, 2, 1)
+
+        y_target = episode["rewards"] + (1.0 - episode["terminals"]) * self.discount * target_q_values
+        y_target = y_target.detach()
+        # actions is a one-hot vector
+        y_pred = torch.sum(obs_qs * episode["actions"], dim=-1, keepdim=True)
+
+        if self.mixer is not None:
+            mixer = self.mixer.functional(params["mixer"])
+            target_mixer = self.target_mixer.functional(params["target_mixer"])
+            state = episode["states"]
+            # the missing agents are zero padded up to the active agents, as in DoubleDQNTrainer
+            y_pred = _pad_to(y_pred.permute(0, 2, 1) * agent_mask, episode["active_agents"].shape)
+            y_target = _pad_to(y_target * agent_mask, episode["active_agents"].shape)
+            y_pred = mixer(y_pred, state)
+            y_target = target_mixer(y_target, state).detach().permute(0, 2, 1)
+            mask = step_mask.reshape(-1, 1, 1).expand_as(y_pred)
+        else:
+            y_target = y_target.permute(0, 2, 1)
+            mask = (step_mask.reshape(-1, 1, 1) * agent_mask.reshape(1, -1, 1)).expand_as(y_pred)
+        qf_loss = (mask * (y_pred - y_target) ** 2).sum() / mask.sum()
+        return qf_loss, y_pred
+
+    def train(self, batches):
+        """
+        :param batches: one `EpisodeBatch` per seed
+        """
+        total_qf_loss = []
+        total_y_pred = []
+        detached = lambda stacked: {name: param.detach() for name, param in stacked.params.items()}
+        params = dict(qf=dict(self.qf.params), target_qf=detached(self.target_qf))
+        if self.mixer is not None:
+            params.update(mixer=dict(self.mixer.params), target_mixer=detached(self.target_mixer))
+
+        for b in range(min(len(batch) for batch in batches)):
+            episodes = [batch.episode(b) for batch in batches]
+            episode, step_mask, agent_mask = stack_episodes(episodes)
+            qf_loss, y_pred = vmap(self._episode_loss)(params, episode, step_mask, agent_mask)
+
+            """
+            Update networks
+            """
+            self.qf_optimizer.zero_grad()
+            # the seeds don't share parameters, so this is every seed's own gradient
+            qf_loss.sum().backward()
+            self.qf_optimizer.step()
+
+            total_qf_loss.append(ptu.get_numpy(qf_loss))
+            lengths = [len(e["observations"]) for e in episodes]
+            total_y_pred.append([ptu.get_numpy(y_pred[k, : lengths[k]]) for k in range(len(episodes))])
+
+        """
+        Soft target network updates
+        """
+        if self._n_train_steps_total % self.target_update_period == 0:
+            soft_update_stacked(self.qf, self.target_qf, self.soft_target_tau)
+            if self.mixer is not None:
+                soft_update_stacked(self.mixer, self.target_mixer, self.soft_target_tau)
+
+        """
+        Save some statistics for eval using just one batch.
+        """
+        for k, trainer in enumerate(self.trainers):
+            trainer._num_train_steps += 1
+            trainer._n_train_steps_total += 1
+            if trainer._need_to_update_eval_statistics:
+                trainer._need_to_update_eval_statistics = False
+                trainer.eval_statistics["QF Loss"] = np.mean([loss[k] for loss in total_qf_loss])
+                try:
+                    trainer.eval_statistics.update(
+                        create_stats_ordered_dict(
+                            "Y Predictions",
+                            [y_pred[k] for y_pred in total_y_pred],
+                        )
+                    )
+                except:
+                    pass
+        self._n_train_steps_total += 1
+
+
+def seed_logger(log_dir, tabular_log_file="progress.csv", text_log_file="debug.log"):
+    """
+    A `Logger` writing to `log_dir` with the snapshot settings of the global logger.
+    """
+    seed_log = Logger()
+    seed_log.add_text_output(osp.join(log_dir, text_log_file))
+    seed_log.add_tabular_output(osp.join(log_dir, tabular_log_file))
+    seed_log.set_snapshot_dir(log_dir)
+    seed_log.set_snapshot_mode(logger.get_snapshot_mode())
+    seed_log.set_snapshot_gap(logger.get_snapshot_gap())
+    seed_log.set_log_tabular_only(logger.get_log_tabular_only())
+    seed_log.push_prefix("[%s] " % osp.basename(osp.normpath(log_dir)))
+    return seed_log
+
+
+@contextmanager
+def use_logger(seed_log):
+    """
+    Temporarily routes the global `logger` (used by the algorithms) to `seed_log`.
+    """
+    saved = logger.__dict__
+    logger.__dict__ = seed_log.__dict__
+    try:
+        yield
+    finally:
+        logger.__dict__ = saved
+
+
+class MultiSeedTorchBatchMARLAlgorithm(object):
+    def __init__(self, algorithms, log_dirs=None):
+        """
+        :param algorithms: one `TorchBatchMARLAlgorithm` per seed, with the
+        same configuration and no background prefetching
+        :param log_dirs: the log directory of every seed, by default `seed_<k>`
+        in the directory of the global logger
+        """
+        self.algorithms = list(algorithms)
+        if any(algorithm._prefetcher is not None for algorithm in self.algorithms):
+            raise ValueError("num_prefetch_batches is not supported with multiple seeds")
+        if log_dirs is None:
+            base_dir = logger.get_snapshot_dir()
+            if base_dir is None:
+                raise ValueError("log_dirs are needed if the logger has not been set up")
+            log_dirs = [osp.join(base_dir, "seed_{}".format(k)) for k in range(len(self.algorithms))]
+        self.loggers = [seed_logger(log_dir) for log_dir in log_dirs]
+        trainers = [algorithm.trainer for algorithm in self.algorithms]
+        if MultiSeedDoubleDQNTrainer.supports(trainers):
+            self.trainer = MultiSeedDoubleDQNTrainer(trainers)
+        else:
+            self.trainer = None
+        self._start_epoch = 0
+
+    def to(self, device):
+        for algorithm in self.algorithms:
+            algorithm.to(device)
+        if self.trainer is not None:
+            # moving the networks replaces their parameters, stack them again
+            self.trainer = MultiSeedDoubleDQNTrainer(self.trainer.trainers)
+
+    def training_mode(self, mode):
+        for algorithm in self.algorithms:
+            algorithm.training_mode(mode)
+
+    def train(self, start_epoch=0):
+        self._start_epoch = start_epoch
+        for algorithm, seed_log in zip(self.algorithms, self.loggers):
+            with use_logger(seed_log):
+                algorithm._start_epoch = start_epoch
+                algorithm._collect_initial_paths()
+
+        first = self.algorithms[0]
+        for epoch in gt.timed_for(
+            range(self._start_epoch, first.num_epochs),
+            save_itrs=True,
+        ):
+            for algorithm, seed_log in zip(self.algorithms, self.loggers):
+                with use_logger(seed_log):
+                    algorithm._evaluate(epoch)
+
+            for _ in range(first.num_train_loops_per_epoch):
+                for algorithm, seed_log in zip(self.algorithms, self.loggers):
+                    with use_logger(seed_log):
+                        algorithm._collect_exploration_paths()
+
+                self.training_mode(True)
+                for _ in range(first.num_trains_per_train_loop):
+                    self._train_batch()
+                gt.stamp("training", unique=False)
+                self.training_mode(False)
+
+            for algorithm, seed_log in zip(self.algorithms, self.loggers):
+                with use_logger(seed_log):
+                    algorithm._end_epoch(epoch)
+
+        for algorithm, seed_log in zip(self.algorithms, self.loggers):
+            with use_logger(seed_log):
+                algorithm._close_async_evaluator()
+
+    def _train_batch(self):
+        if self.trainer is None:
+            for algorithm in self.algorithms:
+                algorithm._train_batch()
+            return
+        batches = [
+            algorithm.trainer.collate(algorithm.replay_buffer.random_batch(algorithm.batch_size))
+            for algorithm in self.algorithms
+        ]
+        self.trainer.train(batches)
@@ -74,13 +74,21 @@ class Mlp(nn.Module):
         self.last_fc.bias.data.uniform_(-init_w, init_w)
 
     def forward(self, input, return_preactivations=False):
-        h = input
+        first_fc = self.fcs[0] if len(self.fcs) > 0 else self.last_fc
+        return self.forward_from_first_layer(first_fc(input), return_preactivations=return_preactivations)
+
+    def forward_from_first_layer(self, h, return_preactivations=False):
+        """
+        The rest of `forward`, from the pre-activations `h` of the first
+        layer (`fcs[0]`, or `last_fc` without hidden layers).
+        """
         for i, fc in enumerate(self.fcs):
-            h = fc(h)
+            if i > 0:
+                h = fc(h)
             if self.layer_norm and i < len(self.fcs) - 1:
                 h = self.layer_norms[i](h)
             h = self.hidden_activation(h)
-        preactivation = self.last_fc(h)
+        preactivation = self.last_fc(h) if len(self.fcs) > 0 else h
         output = self.output_activation(preactivation)
         if return_preactivations:
             return output, preactivation
@@ -100,6 +108,144 @@ class FlattenMlp(Mlp):
         return super().forward(flat_inputs, **kwargs)
 
 
+class EnsembleFlattenMlp(nn.Module):
+    """
+    `ensemble_size` FlattenMlps (e.g. the twin critics of SAC, or a REDQ
+    style ensemble) stored as stacked `[K, in, out]` weights, so that every
+    member is evaluated in one batched matmul per layer.
+
+    The inputs are shared by all of the members, or are given per member
+    with a leading `K` dimension (`shared_inputs=False`), and the output is
+    `[K, *batch_shape, output_size]`.
+    """
+
+    def __init__(
+        self,
+        ensemble_size,
+        hidden_sizes,
+        output_size,
+        input_size,
+        init_w=3e-3,
+        hidden_activation=F.relu,
+        output_activation=identity,
+        hidden_init=ptu.fanin_init,
+        b_init_value=0.1,
+    ):
+        super().__init__()
+        self.ensemble_size = ensemble_size
+        self.input_size = input_size
+        self.output_size = output_size
+        self.hidden_activation = hidden_activation
+        self.output_activation = output_activation
+        self.weights = nn.ParameterList()
+        self.biases = nn.ParameterList()
+
+        sizes = [input_size] + list(hidden_sizes) + [output_size]
+        for i, (in_size, next_size) in enumerate(zip(sizes[:-1], sizes[1:])):
+            # initialised member by member in the nn.Linear layout, as in Mlp
+            weight = torch.empty(ensemble_size, next_size, in_size)
+            bias = torch.empty(ensemble_size, 1, next_size)
+            for k in range(ensemble_size):
+                if i < len(hidden_sizes):
+                    hidden_init(weight[k])
+                    bias[k].fill_(b_init_value)
+                else:
+                    weight[k].uniform_(-init_w, init_w)
+                    bias[k].uniform_(-init_w, init_w)
+            self.weights.append(nn.Parameter(weight.transpose(1, 2).contiguous()))
+            self.biases.append(nn.Parameter(bias))
+
+    @classmethod
+    def from_mlps(cls, mlps):
+        """
+        Builds the ensemble with the weights (and activations) of `mlps`,
+        a list of `Mlp`s with the same architecture and no layer norm.
+        """
+        first = mlps[0]
+        if any(mlp.layer_norm for mlp in mlps):
+            raise NotImplementedError("layer norm is not supported in EnsembleFlattenMlp")
+        ensemble = cls(
+            len(mlps),
+            [fc.out_features for fc in first.fcs],
+            first.output_size,
+            first.input_size,
+            hidden_activation=first.hidden_activation,
+            output_activation=first.output_activation,
+        )
+        with torch.no_grad():
+            for i in range(len(ensemble.weights)):
+                layers = [(mlp.fcs + [mlp.last_fc])[i] for mlp in mlps]
+                ensemble.weights[i].copy_(torch.stack([fc.weight.t() for fc in layers], 0))
+                ensemble.biases[i].copy_(torch.stack([fc.bias.unsqueeze(0) for fc in layers], 0))
+        return ensemble.to(first.last_fc.weight.device)
+
+    def forward(self, *inputs, shared_inputs=True):
+        flat_inputs = torch.cat(inputs, dim=-1)
+        if shared_inputs:
+            batch_shape = flat_inputs.shape[:-1]
+            h = flat_inputs.reshape(1, -1, flat_inputs.shape[-1]).expand(self.ensemble_size, -1, -1)
+        else:
+            batch_shape = flat_inputs.shape[1:-1]
+            h = flat_inputs.reshape(self.ensemble_size, -1, flat_inputs.shape[-1])
+        for weight, bias in zip(self.weights[:-1], self.biases[:-1]):
+            h = self.hidden_activation(torch.baddbmm(bias, h, weight))
+        output = self.output_activation(torch.baddbmm(self.biases[-1], h, self.weights[-1]))
+        return output.view((self.ensemble_size,) + tuple(batch_shape) + (self.output_size,))
+
+    def member(self, k):
+        """
+        A `FlattenMlp` copy of the `k`-th member, e.g. to evaluate a single
+        critic. Training the copy doesn't change the ensemble.
+        """
+        mlp = FlattenMlp(
+            [weight.shape[2] for weight in self.weights[:-1]],
+            self.output_size,
+            self.input_size,
+            hidden_activation=self.hidden_activation,
+            output_activation=self.output_activation,
+        )
+        with torch.no_grad():
+            for fc, weight, bias in zip(mlp.fcs + [mlp.last_fc], self.weights, self.biases):
+                fc.weight.copy_(weight[k].t())
+                fc.bias.copy_(bias[k, 0])
+        return mlp.to(self.weights[0].device)
+
+    def soft_update_from(self, source, tau):
+        """
+        Fused `soft_update_from_to(source, self, tau)`, one lerp per stacked
+        parameter rather than one per member and layer.
+        """
+        with torch.no_grad():
+            targets = list(self.parameters())
+            sources = [param.detach() for param in source.parameters()]
+            if hasattr(torch, "_foreach_lerp_"):
+                torch._foreach_lerp_(targets, sources, tau)
+            else:
+                for target, param in zip(targets, sources):
+                    target.lerp_(param, tau)
+
+
+def ensemble_min(values, num_min=None):
+    """
+    Minimum over the ensemble (the first dimension) of `values`. With
+    `num_min`, the minimum is over a random subset of that many members as
+    in REDQ.
+    """
+    if num_min is not None and num_min < values.shape[0]:
+        values = values[torch.randperm(values.shape[0], device=values.device)[:num_min]]
+    return values.min(0)[0]
+
+
+def ensemble_mse(preds, target):
+    """
+    `[K]` mean squared error of each member of the ensemble predictions
+    `preds` (`[K, *batch_shape, d]`) against `target`. The sum of these is
+    the loss of the ensemble, which gives every member the gradient of its
+    own `nn.MSELoss`.
+    """
+    return (preds - target).pow(2).reshape(preds.shape[0], -1).mean(1)
+
+
 class RNNNetwork(nn.Module):
     """
     lifted from here: https://github.com/oxwhirl/pymarl/blob/master/src/modules/agents/rnn_agent.py
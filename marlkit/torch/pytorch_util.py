@@ -1,17 +1,132 @@
+import weakref
+
 import torch
 import numpy as np
 
 
 def soft_update_from_to(source, target, tau):
+    source_flat, target_flat = _flat_pair(source, target)
+    if source_flat is not None:
+        with torch.no_grad():
+            target_flat.lerp_(source_flat, tau)
+        return
     for target_param, param in zip(target.parameters(), source.parameters()):
         target_param.data.copy_(target_param.data * (1.0 - tau) + param.data * tau)
 
 
 def copy_model_params_from_to(source, target):
+    source_flat, target_flat = _flat_pair(source, target)
+    if source_flat is not None:
+        with torch.no_grad():
+            target_flat.copy_(source_flat)
+        return
     for target_param, param in zip(target.parameters(), source.parameters()):
         target_param.data.copy_(param.data)
 
 
+"""
+Flat parameter storage
+"""
+
+# module -> FlatParameters, kept out of the module so that it is not pickled
+# or deep copied along with it
+_flat_parameters = weakref.WeakKeyDictionary()
+
+
+class FlatParameters(object):
+    """
+    The parameters of a module laid out in one contiguous buffer, every
+    parameter is rebound to a view of it. The parameter objects (and so the
+    optimizers holding them) are unchanged.
+
+    The views are lost if the parameters are replaced, e.g. by `module.to(...)`
+    or `copy.deepcopy(module)`, so flatten after moving and copying modules.
+    The flat functions fall back to the per parameter loops in that case.
+    """
+
+    def __init__(self, module):
+        self.params = list(module.parameters())
+        if len(set((p.dtype, p.device) for p in self.params)) > 1:
+            raise ValueError("flat parameters need every parameter on the same device and of the same dtype")
+        with torch.no_grad():
+            if len(self.params) > 0:
+                self.buffer = torch.cat([p.detach().reshape(-1) for p in self.params])
+            else:
+                self.buffer = torch.zeros(0)
+            self._offsets = []
+            offset = 0
+            for p in self.params:
+                p.data = self.buffer[offset : offset + p.numel()].view_as(p)
+                self._offsets.append(offset)
+                offset += p.numel()
+
+    def is_valid(self, module):
+        params = list(module.parameters())
+        if len(params) != len(self.params):
+            return False
+        base, itemsize = self.buffer.data_ptr(), self.buffer.element_size()
+        return all(
+            p is q and p.data_ptr() == base + offset * itemsize
+            for p, q, offset in zip(params, self.params, self._offsets)
+        )
+
+
+def flatten_parameters(module):
+    """
+    Opt in to flat parameter storage for `module`, which makes
+    `soft_update_from_to` and `copy_model_params_from_to` a single `lerp_` or
+    `copy_` when both modules are flat, and `get_flat_params` zero-copy.
+    """
+    flat = _flat_parameters.get(module)
+    if flat is None or not flat.is_valid(module):
+        flat = FlatParameters(module)
+        _flat_parameters[module] = flat
+    return flat
+
+
+def _flat_buffer(module):
+    flat = _flat_parameters.get(module)
+    if flat is None or not flat.is_valid(module):
+        return None
+    return flat.buffer
+
+
+def _flat_pair(source, target):
+    source_flat, target_flat = _flat_buffer(source), _flat_buffer(target)
+    if source_flat is None or target_flat is None or source_flat.shape != target_flat.shape:
+        return None, None
+    return source_flat, target_flat
+
+
+def get_flat_params(module):
+    """
+    All parameters of `module` as one 1d tensor. For a flattened module this
+    is the (detached) buffer itself, so it aliases the parameters.
+    """
+    flat = _flat_buffer(module)
+    if flat is not None:
+        return flat.detach()
+    return torch.cat([p.detach().reshape(-1) for p in module.parameters()])
+
+
+def set_flat_params(module, flat_params):
+    """
+    Copies the 1d `flat_params` (a tensor or numpy array) into the parameters
+    of `module` in place, a single copy if the module is flattened.
+    """
+    with torch.no_grad():
+        flat = _flat_buffer(module)
+        if flat is not None:
+            flat.copy_(torch.as_tensor(flat_params).reshape(-1))
+            return module
+        flat_params = torch.as_tensor(flat_params).reshape(-1)
+        offset = 0
+        for p in module.parameters():
+            p.copy_(flat_params[offset : offset + p.numel()].view_as(p))
+            offset += p.numel()
+    return module
+
+
 def fanin_init(tensor):
     size = tensor.size()
     if len(size) == 2:
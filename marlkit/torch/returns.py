@@ -0,0 +1,135 @@
+"""
+Return and advantage operators over padded episode batches.
+
+All of the inputs are `[B, T, ...]` tensors with time on dim 1 (e.g. the
+`[B, T, 1, N]` rewards, terminals and `active_agents` of an `EpisodeBatch`),
+and everything after the time dimension is broadcast elementwise, so the
+same operators serve per agent and shared rewards.
+
+Rather than a python loop over the time steps, a reverse discounted sum
+
+    y[t] = sum_{k >= t} discount^(k - t) x[k]
+
+is a single matmul with the upper triangular `[T, T]` matrix of discount
+powers (see `discounted_reverse_cumsum`), which is cached per length and
+discount.
+
+A terminal or inactive step is assumed to end the trajectory of an agent,
+i.e. the steps after it are masked out (as in the padded episode buffers).
+"""
+
+import torch
+
+# (T, discount, dtype, device) -> [T, T] matrix of discount powers
+_DISCOUNT_MATRICES = {}
+
+
+def discount_matrix(length, discount, dtype=torch.float32, device=None):
+    """
+    `[T, T]` matrix with `discount^(k - t)` at `[t, k]` for `k >= t` and 0 below the diagonal.
+    """
+    key = (length, float(discount), dtype, str(device))
+    if key not in _DISCOUNT_MATRICES:
+        steps = torch.arange(length, device=device)
+        powers = (steps.unsqueeze(0) - steps.unsqueeze(1)).to(dtype)
+        matrix = torch.pow(torch.tensor(discount, dtype=dtype, device=device), powers.clamp(min=0))
+        _DISCOUNT_MATRICES[key] = matrix * (powers >= 0).to(dtype)
+    return _DISCOUNT_MATRICES[key]
+
+
+def discounted_reverse_cumsum(x, discount, dim=1):
+    """
+    `y[t] = sum_{k >= t} discount^(k - t) x[k]` along `dim`.
+    """
+    x = x.movedim(dim, -1)
+    matrix = discount_matrix(x.shape[-1], discount, dtype=x.dtype, device=x.device)
+    return torch.matmul(x, matrix.t()).movedim(-1, dim)
+
+
+def td_lambda_targets(rewards, terminals, mask, target_qs, gamma, td_lambda):
+    """
+    TD(lambda) targets of pymarl's `build_td_lambda_targets`, i.e. the
+    backwards recursion
+
+        ret[T - 1] = target_qs[T - 1] * (1 - sum_t terminals[t])
+        ret[t] = td_lambda * gamma * ret[t + 1]
+            + mask[t] * (rewards[t] + (1 - td_lambda) * gamma * target_qs[t + 1] * (1 - terminals[t]))
+
+    :param rewards: `[B, T, ...]`, only the first `T - 1` steps are used
+    :param terminals: `[B, T, ...]`
+    :param mask: `[B, T, ...]` active (not padded) steps
+    :param target_qs: `[B, T, ...]` target values of the taken actions
+    :return: `[B, T - 1, ...]` lambda-returns
+    """
+    length = target_qs.shape[1]
+    last = target_qs[:, -1] * (1 - torch.sum(terminals, dim=1))
+    tail = mask[:, :-1] * (
+        rewards[:, : length - 1] + (1 - td_lambda) * gamma * target_qs[:, 1:] * (1 - terminals[:, :-1])
+    )
+    tail = torch.cat([tail, last.unsqueeze(1)], dim=1)
+    return discounted_reverse_cumsum(tail, td_lambda * gamma)[:, :-1]
+
+
+def _shift(x, steps):
+    """
+    `x[:, t + steps]`, zero padded past the end of the episode.
+    """
+    if steps == 0:
+        return x
+    pad = x.new_zeros((x.shape[0], min(steps, x.shape[1])) + x.shape[2:])
+    return torch.cat([x[:, steps:], pad], dim=1)
+
+
+def n_step_returns(rewards, terminals, next_values, gamma, n, mask=None):
+    """
+    Masked n-step returns
+
+        G[t] = sum_{i < m} gamma^i r[t + i] + gamma^m (1 - terminal) next_values[t + m - 1]
+
+    where `m <= n` stops at the first terminal or at the end of the active
+    steps, so that the return bootstraps from the last step it reached.
+
+    :param next_values: `[B, T, ...]` values of the next observation of every step
+    :param mask: `[B, T, ...]` active (not padded) steps, all active if None
+    :return: `[B, T, ...]` returns, zero on the inactive steps
+    """
+    if mask is None:
+        mask = torch.ones_like(rewards)
+    returns = torch.zeros_like(rewards * mask)
+    # 1 while the trajectory from t has not ended before step t + i
+    alive = torch.ones_like(returns)
+    mask_i = mask
+    for i in range(n):
+        mask_next = _shift(mask, i + 1)
+        live = alive * mask_i
+        returns = returns + (gamma ** i) * live * _shift(rewards, i)
+        # bootstrap on the last step of the window or of the trajectory
+        last = 1.0 if i == n - 1 else 1.0 - mask_next
+        not_done = 1.0 - _shift(terminals, i)
+        returns = returns + (gamma ** (i + 1)) * live * not_done * last * _shift(next_values, i)
+        alive = live * not_done
+        mask_i = mask_next
+    return returns * mask
+
+
+def gae(rewards, terminals, values, next_values, gamma, gae_lambda, mask=None):
+    """
+    Generalised advantage estimates
+
+        delta[t] = r[t] + gamma * (1 - terminals[t]) * next_values[t] - values[t]
+        A[t] = sum_{k >= t} (gamma * gae_lambda)^(k - t) delta[k]
+
+    :param values: `[B, T, ...]` values of the observation of every step
+    :param next_values: `[B, T, ...]` values of the next observation of every step
+    :param mask: `[B, T, ...]` active (not padded) steps, all active if None
+    :return: `(advantages, returns)`, both `[B, T, ...]` and zero on the inactive steps
+    """
+    deltas = rewards + gamma * (1 - terminals) * next_values - values
+    if mask is not None:
+        deltas = deltas * mask
+    advantages = discounted_reverse_cumsum(deltas, gamma * gae_lambda)
+    returns = advantages + values
+    if mask is not None:
+        advantages = advantages * mask
+        returns = returns * mask
+    return advantages, returns
@@ -7,20 +7,22 @@ from torch import nn as nn
 
 import marlkit.torch.pytorch_util as ptu
 from marlkit.core.eval_util import create_stats_ordered_dict
-from marlkit.torch.torch_rl_algorithm import TorchTrainer
+from marlkit.torch.networks import EnsembleFlattenMlp, ensemble_mse
+from marlkit.torch.sac.mmd import MMDLoss
+from marlkit.torch.torch_rl_algorithm import EnsembleCriticsMixin, TorchTrainer
 from torch import autograd
 
 
-class BEARTrainer(TorchTrainer):
+class BEARTrainer(EnsembleCriticsMixin, TorchTrainer):
     def __init__(
         self,
         env,
         policy,
-        qf1,
-        qf2,
-        target_qf1,
-        target_qf2,
-        vae,
+        qf1=None,
+        qf2=None,
+        target_qf1=None,
+        target_qf2=None,
+        vae=None,
         discount=0.99,
         reward_scale=1.0,
         policy_lr=1e-3,
@@ -38,14 +40,18 @@ class BEARTrainer(TorchTrainer):
         target_mmd_thresh=0.05,
         num_samples_mmd_match=4,
         use_target_nets=True,
+        mmd_num_features=None,
+        qfs=None,
+        target_qfs=None,
     ):
         super().__init__()
         self.env = env
         self.policy = policy
-        self.qf1 = qf1
-        self.qf2 = qf2
-        self.target_qf1 = target_qf1
-        self.target_qf2 = target_qf2
+        if qfs is None:
+            qfs = EnsembleFlattenMlp.from_mlps([qf1, qf2])
+            target_qfs = EnsembleFlattenMlp.from_mlps([target_qf1, target_qf2])
+        self.qfs = qfs
+        self.target_qfs = target_qfs
         self.vae = vae
         self.soft_target_tau = soft_target_tau
         self.target_update_period = target_update_period
@@ -60,12 +66,8 @@ class BEARTrainer(TorchTrainer):
             self.policy.parameters(),
             lr=policy_lr,
         )
-        self.qf1_optimizer = optimizer_class(
-            self.qf1.parameters(),
-            lr=qf_lr,
-        )
-        self.qf2_optimizer = optimizer_class(
-            self.qf2.parameters(),
+        self.qf_optimizer = optimizer_class(
+            self.qfs.parameters(),
             lr=qf_lr,
         )
         self.vae_optimizer = optimizer_class(
@@ -83,6 +85,9 @@ class BEARTrainer(TorchTrainer):
         self.mmd_sigma = mmd_sigma
         self.kernel_choice = kernel_choice
         self.num_samples_mmd_match = num_samples_mmd_match
+        # exact kernels if None, otherwise the number of random Fourier features
+        self.mmd_num_features = mmd_num_features
+        self._mmd_losses = {}
         self.policy_update_style = policy_update_style
         self.target_mmd_thresh = target_mmd_thresh
 
@@ -100,7 +105,7 @@ class BEARTrainer(TorchTrainer):
 
     def eval_q_custom(self, custom_policy, data_batch, q_function=None):
         if q_function is None:
-            q_function = self.qf1
+            q_function = lambda *inputs: self.qfs(*inputs)[0]
 
         obs = data_batch["observations"]
         # Evaluate policy Loss
@@ -112,35 +117,22 @@ class BEARTrainer(TorchTrainer):
         q_new_actions = q_function(obs, new_obs_actions)
         return float(q_new_actions.mean().detach().cpu().numpy())
 
+    def _mmd_loss(self, kernel, sigma, per_dim=False):
+        # kept per kernel so the random features are drawn once
+        key = (kernel, sigma, per_dim)
+        if key not in self._mmd_losses:
+            self._mmd_losses[key] = MMDLoss(kernel, sigma, per_dim=per_dim, num_features=self.mmd_num_features)
+        return self._mmd_losses[key]
+
     def mmd_loss_laplacian(self, samples1, samples2, sigma=0.2):
         """MMD constraint with Laplacian kernel for support matching"""
         # sigma is set to 20.0 for hopper, cheetah and 50 for walker/ant
-        diff_x_x = samples1.unsqueeze(2) - samples1.unsqueeze(1)  # B x N x N x d
-        diff_x_x = torch.mean((-(diff_x_x.abs()).sum(-1) / (2.0 * sigma)).exp(), dim=(1, 2))
-
-        diff_x_y = samples1.unsqueeze(2) - samples2.unsqueeze(1)
-        diff_x_y = torch.mean((-(diff_x_y.abs()).sum(-1) / (2.0 * sigma)).exp(), dim=(1, 2))
-
-        diff_y_y = samples2.unsqueeze(2) - samples2.unsqueeze(1)  # B x N x N x d
-        diff_y_y = torch.mean((-(diff_y_y.abs()).sum(-1) / (2.0 * sigma)).exp(), dim=(1, 2))
-
-        overall_loss = (diff_x_x + diff_y_y - 2.0 * diff_x_y + 1e-6).sqrt()
-        return overall_loss
+        return self._mmd_loss("laplacian", sigma)(samples1, samples2)
 
     def mmd_loss_gaussian(self, samples1, samples2, sigma=0.2):
         """MMD constraint with Gaussian Kernel support matching"""
         # sigma is set to 20.0 for hopper, cheetah and 50 for walker/ant
-        diff_x_x = samples1.unsqueeze(2) - samples1.unsqueeze(1)  # B x N x N x d
-        diff_x_x = torch.mean((-(diff_x_x.pow(2)).sum(-1) / (2.0 * sigma)).exp(), dim=(1, 2))
-
-        diff_x_y = samples1.unsqueeze(2) - samples2.unsqueeze(1)
-        diff_x_y = torch.mean((-(diff_x_y.pow(2)).sum(-1) / (2.0 * sigma)).exp(), dim=(1, 2))
-
-        diff_y_y = samples2.unsqueeze(2) - samples2.unsqueeze(1)  # B x N x N x d
-        diff_y_y = torch.mean((-(diff_y_y.pow(2)).sum(-1) / (2.0 * sigma)).exp(), dim=(1, 2))
-
-        overall_loss = (diff_x_x + diff_y_y - 2.0 * diff_x_y + 1e-6).sqrt()
-        return overall_loss
+        return self._mmd_loss("gaussian", sigma)(samples1, samples2)
 
     def train_from_torch(self, batch):
         self._current_epoch += 1
@@ -172,19 +164,16 @@ class BEARTrainer(TorchTrainer):
 
             # Compute value of perturbed actions sampled from the VAE
             action_rep = self.policy(state_rep)[0]
-            target_qf1 = self.target_qf1(state_rep, action_rep)
-            target_qf2 = self.target_qf2(state_rep, action_rep)
+            target_qs = self.target_qfs(state_rep, action_rep)
 
             # Soft Clipped Double Q-learning
-            target_Q = 0.75 * torch.min(target_qf1, target_qf2) + 0.25 * torch.max(target_qf1, target_qf2)
+            target_Q = 0.75 * target_qs.min(0)[0] + 0.25 * target_qs.max(0)[0]
             target_Q = target_Q.view(next_obs.shape[0], -1).max(1)[0].view(-1, 1)
             target_Q = self.reward_scale * rewards + (1.0 - terminals) * self.discount * target_Q
 
-        qf1_pred = self.qf1(obs, actions)
-        qf2_pred = self.qf2(obs, actions)
+        q_preds = self.qfs(obs, actions)
 
-        qf1_loss = (qf1_pred - target_Q.detach()).pow(2).mean()
-        qf2_loss = (qf2_pred - target_Q.detach()).pow(2).mean()
+        qf_losses = ensemble_mse(q_preds, target_Q.detach())
 
         """
         Actor Training
@@ -205,13 +194,12 @@ class BEARTrainer(TorchTrainer):
         action_divergence = ((sampled_actions - actor_samples) ** 2).sum(-1)
         raw_action_divergence = ((raw_sampled_actions - raw_actor_actions) ** 2).sum(-1)
 
-        q_val1 = self.qf1(obs, actor_samples[:, 0, :])
-        q_val2 = self.qf2(obs, actor_samples[:, 0, :])
+        q_vals = self.qfs(obs, actor_samples[:, 0, :])
 
         if self.policy_update_style == "0":
-            policy_loss = torch.min(q_val1, q_val2)[:, 0]
+            policy_loss = q_vals.min(0)[0][:, 0]
         elif self.policy_update_style == "1":
-            policy_loss = torch.mean(q_val1, q_val2)[:, 0]
+            policy_loss = q_vals.mean(0)[:, 0]
 
         if self._n_train_steps_total >= 40000:
             # Now we can update the policy
@@ -228,22 +216,24 @@ class BEARTrainer(TorchTrainer):
         """
         Update Networks
         """
-        self.qf1_optimizer.zero_grad()
-        qf1_loss.backward()
-        self.qf1_optimizer.step()
-
-        self.qf2_optimizer.zero_grad()
-        qf2_loss.backward()
-        self.qf2_optimizer.step()
-
+        # every gradient is computed before the first step, the optimizers
+        # update the parameters in place and the policy loss depends on them
         self.policy_optimizer.zero_grad()
         if self.mode == "auto":
             policy_loss.backward(retain_graph=True)
-        self.policy_optimizer.step()
+
+        self.qf_optimizer.zero_grad()
+        qf_losses.sum().backward()
 
         if self.mode == "auto":
+            # the gradient of -policy_loss w.r.t. log_alpha
+            alpha_loss = -(self.log_alpha.exp() * (mmd_loss - self.target_mmd_thresh).detach()).mean()
             self.alpha_optimizer.zero_grad()
-            (-policy_loss).backward()
+            alpha_loss.backward()
+
+        self.qf_optimizer.step()
+        self.policy_optimizer.step()
+        if self.mode == "auto":
             self.alpha_optimizer.step()
             self.log_alpha.data.clamp_(min=-5.0, max=10.0)
 
@@ -251,8 +241,7 @@ class BEARTrainer(TorchTrainer):
         Update networks
         """
         if self._n_train_steps_total % self.target_update_period == 0:
-            ptu.soft_update_from_to(self.qf1, self.target_qf1, self.soft_target_tau)
-            ptu.soft_update_from_to(self.qf2, self.target_qf2, self.soft_target_tau)
+            self.target_qfs.soft_update_from(self.qfs, self.soft_target_tau)
 
         """
         Some statistics for eval
@@ -263,23 +252,18 @@ class BEARTrainer(TorchTrainer):
             Eval should set this to None.
             This way, these statistics are only computed for one batch.
             """
-            self.eval_statistics["QF1 Loss"] = np.mean(ptu.get_numpy(qf1_loss))
-            self.eval_statistics["QF2 Loss"] = np.mean(ptu.get_numpy(qf2_loss))
+            for k, qf_loss in enumerate(ptu.get_numpy(qf_losses)):
+                self.eval_statistics["QF{} Loss".format(k + 1)] = qf_loss
             self.eval_statistics["Num Q Updates"] = self._num_q_update_steps
             self.eval_statistics["Num Policy Updates"] = self._num_policy_update_steps
             self.eval_statistics["Policy Loss"] = np.mean(ptu.get_numpy(policy_loss))
-            self.eval_statistics.update(
-                create_stats_ordered_dict(
-                    "Q1 Predictions",
-                    ptu.get_numpy(qf1_pred),
+            for k, q_pred in enumerate(ptu.get_numpy(q_preds)):
+                self.eval_statistics.update(
+                    create_stats_ordered_dict(
+                        "Q{} Predictions".format(k + 1),
+                        q_pred,
+                    )
                 )
-            )
-            self.eval_statistics.update(
-                create_stats_ordered_dict(
-                    "Q2 Predictions",
-                    ptu.get_numpy(qf2_pred),
-                )
-            )
             self.eval_statistics.update(
                 create_stats_ordered_dict(
                     "Q Targets",
@@ -308,19 +292,15 @@ class BEARTrainer(TorchTrainer):
     def networks(self):
         return [
             self.policy,
-            self.qf1,
-            self.qf2,
-            self.target_qf1,
-            self.target_qf2,
+            self.qfs,
+            self.target_qfs,
             self.vae,
         ]
 
     def get_snapshot(self):
-        return dict(
+        snapshot = dict(
             policy=self.policy,
-            qf1=self.qf1,
-            qf2=self.qf2,
-            target_qf1=self.target_qf1,
-            target_qf2=self.target_qf2,
             vae=self.vae,
         )
+        snapshot.update(self.get_critics_snapshot())
+        return snapshot
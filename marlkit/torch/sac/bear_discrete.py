@@ -7,21 +7,23 @@ from torch import nn as nn
 
 import marlkit.torch.pytorch_util as ptu
 from marlkit.core.eval_util import create_stats_ordered_dict
-from marlkit.torch.torch_rl_algorithm import TorchTrainer
+from marlkit.torch.networks import EnsembleFlattenMlp, ensemble_mse
+from marlkit.torch.sac.mmd import MMDLoss
+from marlkit.torch.torch_rl_algorithm import EnsembleCriticsMixin, TorchTrainer
 
 from sklearn.preprocessing import StandardScaler, MinMaxScaler
 
 
-class BEARTrainer(TorchTrainer):
+class BEARTrainer(EnsembleCriticsMixin, TorchTrainer):
     def __init__(
         self,
         env,
         policy,
-        qf1,
-        qf2,
-        target_qf1,
-        target_qf2,
-        vae,
+        qf1=None,
+        qf2=None,
+        target_qf1=None,
+        target_qf2=None,
+        vae=None,
         discount=0.99,
         reward_scale=1.0,
         policy_lr=1e-3,
@@ -41,14 +43,18 @@ class BEARTrainer(TorchTrainer):
         target_mmd_thresh=0.05,
         num_samples_mmd_match=4,
         use_target_nets=True,
+        mmd_num_features=None,
+        qfs=None,
+        target_qfs=None,
     ):
         super().__init__()
         self.env = env
         self.policy = policy
-        self.qf1 = qf1
-        self.qf2 = qf2
-        self.target_qf1 = target_qf1
-        self.target_qf2 = target_qf2
+        if qfs is None:
+            qfs = EnsembleFlattenMlp.from_mlps([qf1, qf2])
+            target_qfs = EnsembleFlattenMlp.from_mlps([target_qf1, target_qf2])
+        self.qfs = qfs
+        self.target_qfs = target_qfs
         self.vae = vae
         self.soft_target_tau = soft_target_tau
         self.target_update_period = target_update_period
@@ -75,12 +81,8 @@ class BEARTrainer(TorchTrainer):
             self.policy.parameters(),
             lr=policy_lr,
         )
-        self.qf1_optimizer = optimizer_class(
-            self.qf1.parameters(),
-            lr=qf_lr,
-        )
-        self.qf2_optimizer = optimizer_class(
-            self.qf2.parameters(),
+        self.qf_optimizer = optimizer_class(
+            self.qfs.parameters(),
             lr=qf_lr,
         )
 
@@ -101,6 +103,9 @@ class BEARTrainer(TorchTrainer):
         self.mmd_sigma = mmd_sigma
         self.kernel_choice = kernel_choice
         self.num_samples_mmd_match = num_samples_mmd_match
+        # exact kernels if None, otherwise the number of random Fourier features
+        self.mmd_num_features = mmd_num_features
+        self._mmd_losses = {}
         self.policy_update_style = policy_update_style  # not used, assumed to be 0
         self.target_mmd_thresh = target_mmd_thresh
 
@@ -114,67 +119,32 @@ class BEARTrainer(TorchTrainer):
         # self.standard_scalar = StandardScaler()
         # self.minmax_scalar = MinMaxScaler()
 
+    def _mmd_loss(self, kernel, sigma, per_dim=False):
+        # kept per kernel so the random features are drawn once
+        key = (kernel, sigma, per_dim)
+        if key not in self._mmd_losses:
+            self._mmd_losses[key] = MMDLoss(kernel, sigma, per_dim=per_dim, num_features=self.mmd_num_features)
+        return self._mmd_losses[key]
+
     def mmd_loss_laplacian(self, samples1, samples2, sigma=0.2):
         """MMD constraint with Laplacian kernel for support matching"""
         # sigma is set to 20.0 for hopper, cheetah and 50 for walker/ant
-        diff_x_x = samples1.unsqueeze(2) - samples1.unsqueeze(1)  # B x N x N x d
-        diff_x_x = torch.mean((-(diff_x_x.abs()).sum(-1) / (2.0 * sigma)).exp(), dim=(1, 2))
-
-        diff_x_y = samples1.unsqueeze(2) - samples2.unsqueeze(1)
-        diff_x_y = torch.mean((-(diff_x_y.abs()).sum(-1) / (2.0 * sigma)).exp(), dim=(1, 2))
-
-        diff_y_y = samples2.unsqueeze(2) - samples2.unsqueeze(1)  # B x N x N x d
-        diff_y_y = torch.mean((-(diff_y_y.abs()).sum(-1) / (2.0 * sigma)).exp(), dim=(1, 2))
-
-        overall_loss = (diff_x_x + diff_y_y - 2.0 * diff_x_y + 1e-6).sqrt()
-        return overall_loss
+        return self._mmd_loss("laplacian", sigma)(samples1, samples2)
 
     def mmd_loss_gaussian(self, samples1, samples2, sigma=0.2):
         """MMD constraint with Gaussian Kernel support matching"""
         # sigma is set to 20.0 for hopper, cheetah and 50 for walker/ant
-        diff_x_x = samples1.unsqueeze(2) - samples1.unsqueeze(1)  # B x N x N x d
-        diff_x_x = torch.mean((-(diff_x_x.pow(2)).sum(-1) / (2.0 * sigma)).exp(), dim=(1, 2))
-
-        diff_x_y = samples1.unsqueeze(2) - samples2.unsqueeze(1)
-        diff_x_y = torch.mean((-(diff_x_y.pow(2)).sum(-1) / (2.0 * sigma)).exp(), dim=(1, 2))
-
-        diff_y_y = samples2.unsqueeze(2) - samples2.unsqueeze(1)  # B x N x N x d
-        diff_y_y = torch.mean((-(diff_y_y.pow(2)).sum(-1) / (2.0 * sigma)).exp(), dim=(1, 2))
-
-        overall_loss = (diff_x_x + diff_y_y - 2.0 * diff_x_y + 1e-6).sqrt()
-        return overall_loss
+        return self._mmd_loss("gaussian", sigma)(samples1, samples2)
 
     def multi_mmd_loss_laplacian(self, samples1, samples2, sigma=0.2):
         """MMD constraint with Laplacian kernel for support matching"""
         # sigma is set to 20.0 for hopper, cheetah and 50 for walker/ant
-        action_dim = samples1.shape[-1]
-        return torch.stack(
-            [
-                self.mmd_loss_laplacian(
-                    samples1[:, :, idx].unsqueeze(2),
-                    samples2[:, :, idx].unsqueeze(2),
-                    sigma,
-                )
-                for idx in range(action_dim)
-            ],
-            -1,
-        )
+        return self._mmd_loss("laplacian", sigma, per_dim=True)(samples1, samples2)
 
     def multi_mmd_loss_gaussian(self, samples1, samples2, sigma=0.2):
         """MMD constraint with Gaussian Kernel support matching"""
         # sigma is set to 20.0 for hopper, cheetah and 50 for walker/ant
-        action_dim = samples1.shape[-1]
-        return torch.stack(
-            [
-                self.mmd_loss_gaussian(
-                    samples1[:, :, idx].unsqueeze(2),
-                    samples2[:, :, idx].unsqueeze(2),
-                    sigma,
-                )
-                for idx in range(action_dim)
-            ],
-            -1,
-        )
+        return self._mmd_loss("gaussian", sigma, per_dim=True)(samples1, samples2)
 
     def train_from_torch(self, batch):
         # need to learn the mid point so that we
@@ -308,10 +278,7 @@ class BEARTrainer(TorchTrainer):
             alpha = 1
 
         # assume policy_update_style == "0" not using self.policy_update_style
-        q_new_actions = torch.min(
-            self.qf1(obs),
-            self.qf2(obs),
-        )
+        q_new_actions = self.qfs(obs).min(0)[0]
 
         if self.mode == "auto":
             mmd_loss = self.log_alpha.exp() * (mmd_loss - self.target_mmd_thresh)
@@ -323,8 +290,7 @@ class BEARTrainer(TorchTrainer):
         """
         QF Loss
         """
-        q1_pred = self.qf1(obs)
-        q2_pred = self.qf2(obs)
+        q_preds = self.qfs(obs)
 
         # Make sure policy accounts for squashing functions like tanh correctly!
         _, new_action_prob, new_log_pi, _ = self.policy(
@@ -332,40 +298,29 @@ class BEARTrainer(TorchTrainer):
             reparameterize=True,
             return_log_prob=True,
         )
-        target_q_values = (
-            new_action_prob
-            * torch.min(
-                self.target_qf1(next_obs),
-                self.target_qf2(next_obs),
-            )
-            - alpha * new_log_pi
-        )
+        target_q_values = new_action_prob * self.target_qfs(next_obs).min(0)[0] - alpha * new_log_pi
 
         q_target = self.reward_scale * rewards + (1.0 - terminals) * self.discount * target_q_values
-        qf1_loss = self.qf_criterion(q1_pred, q_target.detach())
-        qf2_loss = self.qf_criterion(q2_pred, q_target.detach())
+        qf_losses = ensemble_mse(q_preds, q_target.detach())
 
         """
         Update networks
         """
-        self.qf1_optimizer.zero_grad()
-        qf1_loss.backward()
-        self.qf1_optimizer.step()
-
-        self.qf2_optimizer.zero_grad()
-        qf2_loss.backward()
-        self.qf2_optimizer.step()
-
+        # the policy loss depends on the critics, which the qf step updates
+        # in place, so every gradient is computed before the first step
         self.policy_optimizer.zero_grad()
         policy_loss.backward()
+        self.qf_optimizer.zero_grad()
+        qf_losses.sum().backward()
+
+        self.qf_optimizer.step()
         self.policy_optimizer.step()
 
         """
         Soft Updates
         """
         if self._n_train_steps_total % self.target_update_period == 0:
-            ptu.soft_update_from_to(self.qf1, self.target_qf1, self.soft_target_tau)
-            ptu.soft_update_from_to(self.qf2, self.target_qf2, self.soft_target_tau)
+            self.target_qfs.soft_update_from(self.qfs, self.soft_target_tau)
 
         """
         Save some statistics for eval
@@ -378,21 +333,16 @@ class BEARTrainer(TorchTrainer):
             """
             policy_loss = (log_pi - q_new_actions).mean()
 
-            self.eval_statistics["QF1 Loss"] = np.mean(ptu.get_numpy(qf1_loss))
-            self.eval_statistics["QF2 Loss"] = np.mean(ptu.get_numpy(qf2_loss))
+            for k, qf_loss in enumerate(ptu.get_numpy(qf_losses)):
+                self.eval_statistics["QF{} Loss".format(k + 1)] = qf_loss
             self.eval_statistics["Policy Loss"] = np.mean(ptu.get_numpy(policy_loss))
-            self.eval_statistics.update(
-                create_stats_ordered_dict(
-                    "Q1 Predictions",
-                    ptu.get_numpy(q1_pred),
-                )
-            )
-            self.eval_statistics.update(
-                create_stats_ordered_dict(
-                    "Q2 Predictions",
-                    ptu.get_numpy(q2_pred),
+            for k, q_pred in enumerate(ptu.get_numpy(q_preds)):
+                self.eval_statistics.update(
+                    create_stats_ordered_dict(
+                        "Q{} Predictions".format(k + 1),
+                        q_pred,
+                    )
                 )
-            )
             self.eval_statistics.update(
                 create_stats_ordered_dict(
                     "Q Targets",
@@ -427,17 +377,13 @@ class BEARTrainer(TorchTrainer):
     def networks(self):
         return [
             self.policy,
-            self.qf1,
-            self.qf2,
-            self.target_qf1,
-            self.target_qf2,
+            self.qfs,
+            self.target_qfs,
         ]
 
     def get_snapshot(self):
-        return dict(
+        snapshot = dict(
             policy=self.policy,
-            qf1=self.qf1,
-            qf2=self.qf2,
-            target_qf1=self.qf1,
-            target_qf2=self.qf2,
         )
+        snapshot.update(self.get_critics_snapshot())
+        return snapshot
@@ -15,19 +15,21 @@ import torch.nn.functional as F
 import rlkit.torch.pytorch_util as ptu
 from rlkit.core.eval_util import create_stats_ordered_dict
 from rlkit.torch.torch_rl_algorithm import TorchTrainer
+from marlkit.torch.torch_rl_algorithm import EnsembleCriticsMixin
+from marlkit.torch.networks import EnsembleFlattenMlp, ensemble_mse
 from torch import autograd
 
 
-class BEARTrainer(TorchTrainer):
+class BEARTrainer(EnsembleCriticsMixin, TorchTrainer):
     def __init__(
         self,
         env,
         policy,
-        qf1,
-        qf2,
-        target_qf1,
-        target_qf2,
-        vae,
+        qf1=None,
+        qf2=None,
+        target_qf1=None,
+        target_qf2=None,
+        vae=None,
         discount=0.99,
         reward_scale=1.0,
         policy_lr=1e-3,
@@ -45,14 +47,17 @@ class BEARTrainer(TorchTrainer):
         target_mmd_thresh=0.05,
         num_samples_mmd_match=4,
         use_target_nets=True,
+        qfs=None,
+        target_qfs=None,
     ):
         super().__init__()
         self.env = env
         self.policy = policy
-        self.qf1 = qf1
-        self.qf2 = qf2
-        self.target_qf1 = target_qf1
-        self.target_qf2 = target_qf2
+        if qfs is None:
+            qfs = EnsembleFlattenMlp.from_mlps([qf1, qf2])
+            target_qfs = EnsembleFlattenMlp.from_mlps([target_qf1, target_qf2])
+        self.qfs = qfs
+        self.target_qfs = target_qfs
         self.vae = vae
         self.soft_target_tau = soft_target_tau
         self.target_update_period = target_update_period
@@ -67,12 +72,8 @@ class BEARTrainer(TorchTrainer):
             self.policy.parameters(),
             lr=policy_lr,
         )
-        self.qf1_optimizer = optimizer_class(
-            self.qf1.parameters(),
-            lr=qf_lr,
-        )
-        self.qf2_optimizer = optimizer_class(
-            self.qf2.parameters(),
+        self.qf_optimizer = optimizer_class(
+            self.qfs.parameters(),
             lr=qf_lr,
         )
         self.vae_optimizer = optimizer_class(
@@ -107,7 +108,7 @@ class BEARTrainer(TorchTrainer):
 
     def eval_q_custom(self, custom_policy, data_batch, q_function=None):
         if q_function is None:
-            q_function = self.qf1
+            q_function = lambda *inputs: self.qfs(*inputs)[0]
 
         obs = data_batch["observations"]
         # Evaluate policy Loss
@@ -184,19 +185,16 @@ class BEARTrainer(TorchTrainer):
 
             # Compute value of perturbed actions sampled from the VAE
             action_rep = self.policy(state_rep)[0]
-            target_qf1 = self.target_qf1(state_rep, action_rep)
-            target_qf2 = self.target_qf2(state_rep, action_rep)
+            target_qs = self.target_qfs(state_rep, action_rep)
 
             # Soft Clipped Double Q-learning
-            target_Q = 0.75 * torch.min(target_qf1, target_qf2) + 0.25 * torch.max(target_qf1, target_qf2)
+            target_Q = 0.75 * target_qs.min(0)[0] + 0.25 * target_qs.max(0)[0]
             target_Q = target_Q.view(next_obs.shape[0], -1).max(1)[0].view(-1, 1)
             target_Q = self.reward_scale * rewards + (1.0 - terminals) * self.discount * target_Q
 
-        qf1_pred = self.qf1(obs, actions)
-        qf2_pred = self.qf2(obs, actions)
+        q_preds = self.qfs(obs, actions)
 
-        qf1_loss = (qf1_pred - target_Q.detach()).pow(2).mean()
-        qf2_loss = (qf2_pred - target_Q.detach()).pow(2).mean()
+        qf_losses = ensemble_mse(q_preds, target_Q.detach())
 
         """
         Actor Training
@@ -219,13 +217,12 @@ class BEARTrainer(TorchTrainer):
         action_divergence = ((sampled_actions - actor_samples) ** 2).sum(-1)
         raw_action_divergence = ((raw_sampled_actions - raw_actor_actions) ** 2).sum(-1)
 
-        q_val1 = self.qf1(obs, actor_samples[:, 0, :])
-        q_val2 = self.qf2(obs, actor_samples[:, 0, :])
+        q_vals = self.qfs(obs, actor_samples[:, 0, :])
 
         if self.policy_update_style == "0":
-            policy_loss = torch.min(q_val1, q_val2)[:, 0]
+            policy_loss = q_vals.min(0)[0][:, 0]
         elif self.policy_update_style == "1":
-            policy_loss = torch.mean(q_val1, q_val2)[:, 0]
+            policy_loss = q_vals.mean(0)[:, 0]
 
         if self._n_train_steps_total >= 40000:
             # Now we can update the policy
@@ -242,22 +239,24 @@ class BEARTrainer(TorchTrainer):
         """
         Update Networks
         """
-        self.qf1_optimizer.zero_grad()
-        qf1_loss.backward()
-        self.qf1_optimizer.step()
-
-        self.qf2_optimizer.zero_grad()
-        qf2_loss.backward()
-        self.qf2_optimizer.step()
-
+        # every gradient is computed before the first step, the optimizers
+        # update the parameters in place and the policy loss depends on them
         self.policy_optimizer.zero_grad()
         if self.mode == "auto":
             policy_loss.backward(retain_graph=True)
-        self.policy_optimizer.step()
+
+        self.qf_optimizer.zero_grad()
+        qf_losses.sum().backward()
 
         if self.mode == "auto":
+            # the gradient of -policy_loss w.r.t. log_alpha
+            alpha_loss = -(self.log_alpha.exp() * (div_loss - self.target_mmd_thresh).detach()).mean()
             self.alpha_optimizer.zero_grad()
-            (-policy_loss).backward()
+            alpha_loss.backward()
+
+        self.qf_optimizer.step()
+        self.policy_optimizer.step()
+        if self.mode == "auto":
             self.alpha_optimizer.step()
             self.log_alpha.data.clamp_(min=-5.0, max=10.0)
 
@@ -265,8 +264,7 @@ class BEARTrainer(TorchTrainer):
         Update networks
         """
         if self._n_train_steps_total % self.target_update_period == 0:
-            ptu.soft_update_from_to(self.qf1, self.target_qf1, self.soft_target_tau)
-            ptu.soft_update_from_to(self.qf2, self.target_qf2, self.soft_target_tau)
+            self.target_qfs.soft_update_from(self.qfs, self.soft_target_tau)
 
         """
         Some statistics for eval
@@ -277,23 +275,18 @@ class BEARTrainer(TorchTrainer):
             Eval should set this to None.
             This way, these statistics are only computed for one batch.
             """
-            self.eval_statistics["QF1 Loss"] = np.mean(ptu.get_numpy(qf1_loss))
-            self.eval_statistics["QF2 Loss"] = np.mean(ptu.get_numpy(qf2_loss))
+            for k, qf_loss in enumerate(ptu.get_numpy(qf_losses)):
+                self.eval_statistics["QF{} Loss".format(k + 1)] = qf_loss
             self.eval_statistics["Num Q Updates"] = self._num_q_update_steps
             self.eval_statistics["Num Policy Updates"] = self._num_policy_update_steps
             self.eval_statistics["Policy Loss"] = np.mean(ptu.get_numpy(policy_loss))
-            self.eval_statistics.update(
-                create_stats_ordered_dict(
-                    "Q1 Predictions",
-                    ptu.get_numpy(qf1_pred),
-                )
-            )
-            self.eval_statistics.update(
-                create_stats_ordered_dict(
-                    "Q2 Predictions",
-                    ptu.get_numpy(qf2_pred),
+            for k, q_pred in enumerate(ptu.get_numpy(q_preds)):
+                self.eval_statistics.update(
+                    create_stats_ordered_dict(
+                        "Q{} Predictions".format(k + 1),
+                        q_pred,
+                    )
                 )
-            )
             self.eval_statistics.update(
                 create_stats_ordered_dict(
                     "Q Targets",
@@ -322,19 +315,15 @@ class BEARTrainer(TorchTrainer):
     def networks(self):
         return [
             self.policy,
-            self.qf1,
-            self.qf2,
-            self.target_qf1,
-            self.target_qf2,
+            self.qfs,
+            self.target_qfs,
             self.vae,
         ]
 
     def get_snapshot(self):
-        return dict(
+        snapshot = dict(
             policy=self.policy,
-            qf1=self.qf1,
-            qf2=self.qf2,
-            target_qf1=self.target_qf1,
-            target_qf2=self.target_qf2,
             vae=self.vae,
         )
+        snapshot.update(self.get_critics_snapshot())
+        return snapshot
@@ -7,19 +7,20 @@ from torch import nn as nn
 
 import marlkit.torch.pytorch_util as ptu
 from marlkit.core.eval_util import create_stats_ordered_dict
-from marlkit.torch.torch_rl_algorithm import TorchTrainer
+from marlkit.torch.networks import EnsembleFlattenMlp, ensemble_min, ensemble_mse
+from marlkit.torch.torch_rl_algorithm import EnsembleCriticsMixin, TorchTrainer
 from torch import autograd
 
 
-class CQLTrainer(TorchTrainer):
+class CQLTrainer(EnsembleCriticsMixin, TorchTrainer):
     def __init__(
         self,
         env,
         policy,
-        qf1,
-        qf2,
-        target_qf1,
-        target_qf2,
+        qf1=None,
+        qf2=None,
+        target_qf1=None,
+        target_qf2=None,
         discount=0.99,
         reward_scale=1.0,
         policy_lr=1e-3,
@@ -42,14 +43,19 @@ class CQLTrainer(TorchTrainer):
         num_random=10,
         with_lagrange=False,
         lagrange_thresh=0.0,
+        qfs=None,
+        target_qfs=None,
+        num_min_qs=None,
     ):
         super().__init__()
         self.env = env
         self.policy = policy
-        self.qf1 = qf1
-        self.qf2 = qf2
-        self.target_qf1 = target_qf1
-        self.target_qf2 = target_qf2
+        if qfs is None:
+            qfs = EnsembleFlattenMlp.from_mlps([qf1, qf2][:num_qs])
+            target_qfs = EnsembleFlattenMlp.from_mlps([target_qf1, target_qf2][:num_qs])
+        self.qfs = qfs
+        self.target_qfs = target_qfs
+        self.num_min_qs = num_min_qs
         self.soft_target_tau = soft_target_tau
 
         self.use_automatic_entropy_tuning = use_automatic_entropy_tuning
@@ -83,12 +89,8 @@ class CQLTrainer(TorchTrainer):
             self.policy.parameters(),
             lr=policy_lr,
         )
-        self.qf1_optimizer = optimizer_class(
-            self.qf1.parameters(),
-            lr=qf_lr,
-        )
-        self.qf2_optimizer = optimizer_class(
-            self.qf2.parameters(),
+        self.qf_optimizer = optimizer_class(
+            self.qfs.parameters(),
             lr=qf_lr,
         )
 
@@ -105,7 +107,7 @@ class CQLTrainer(TorchTrainer):
         self._num_policy_update_steps = 0
         self._num_policy_steps = 1
 
-        self.num_qs = num_qs
+        self.num_qs = self.qfs.ensemble_size
 
         ## min Q
         self.temp = temp
@@ -128,7 +130,8 @@ class CQLTrainer(TorchTrainer):
         num_repeat = int(action_shape / obs_shape)
         obs_temp = obs.unsqueeze(1).repeat(1, num_repeat, 1).view(obs.shape[0] * num_repeat, obs.shape[1])
         preds = network(obs_temp, actions)
-        preds = preds.view(obs.shape[0], num_repeat, 1)
+        # an ensemble keeps its leading dimension
+        preds = preds.view(preds.shape[:-2] + (obs.shape[0], num_repeat, 1))
         return preds
 
     def _get_policy_actions(self, obs, num_actions, network=None):
@@ -170,13 +173,7 @@ class CQLTrainer(TorchTrainer):
             alpha_loss = 0
             alpha = 1
 
-        if self.num_qs == 1:
-            q_new_actions = self.qf1(obs, new_obs_actions)
-        else:
-            q_new_actions = torch.min(
-                self.qf1(obs, new_obs_actions),
-                self.qf2(obs, new_obs_actions),
-            )
+        q_new_actions = self.qfs(obs, new_obs_actions).min(0)[0]
 
         policy_loss = (alpha * log_pi - q_new_actions).mean()
 
@@ -192,9 +189,7 @@ class CQLTrainer(TorchTrainer):
         """
         QF Loss
         """
-        q1_pred = self.qf1(obs, actions)
-        if self.num_qs > 1:
-            q2_pred = self.qf2(obs, actions)
+        q_preds = self.qfs(obs, actions)
 
         new_next_actions, _, _, new_log_pi, *_ = self.policy(
             next_obs,
@@ -208,13 +203,7 @@ class CQLTrainer(TorchTrainer):
         )
 
         if not self.max_q_backup:
-            if self.num_qs == 1:
-                target_q_values = self.target_qf1(next_obs, new_next_actions)
-            else:
-                target_q_values = torch.min(
-                    self.target_qf1(next_obs, new_next_actions),
-                    self.target_qf2(next_obs, new_next_actions),
-                )
+            target_q_values = ensemble_min(self.target_qfs(next_obs, new_next_actions), self.num_min_qs)
 
             if not self.deterministic_backup:
                 target_q_values = target_q_values - alpha * new_log_pi
@@ -222,23 +211,16 @@ class CQLTrainer(TorchTrainer):
         if self.max_q_backup:
             """when using max q backup"""
             next_actions_temp, _ = self._get_policy_actions(next_obs, num_actions=10, network=self.policy)
-            target_qf1_values = (
-                self._get_tensor_values(next_obs, next_actions_temp, network=self.target_qf1).max(1)[0].view(-1, 1)
-            )
-            target_qf2_values = (
-                self._get_tensor_values(next_obs, next_actions_temp, network=self.target_qf2).max(1)[0].view(-1, 1)
-            )
-            target_q_values = torch.min(target_qf1_values, target_qf2_values)
+            target_qs_values = self._get_tensor_values(next_obs, next_actions_temp, network=self.target_qfs).max(2)[0]
+            target_q_values = ensemble_min(target_qs_values, self.num_min_qs)
 
         q_target = self.reward_scale * rewards + (1.0 - terminals) * self.discount * target_q_values
         q_target = q_target.detach()
 
-        qf1_loss = self.qf_criterion(q1_pred, q_target)
-        if self.num_qs > 1:
-            qf2_loss = self.qf_criterion(q2_pred, q_target)
+        qf_losses = ensemble_mse(q_preds, q_target)
 
         ## add CQL
-        random_actions_tensor = torch.FloatTensor(q2_pred.shape[0] * self.num_random, actions.shape[-1]).uniform_(
+        random_actions_tensor = torch.FloatTensor(obs.shape[0] * self.num_random, actions.shape[-1]).uniform_(
             -1, 1
         )  # .cuda()
         curr_actions_tensor, curr_log_pis = self._get_policy_actions(
@@ -247,97 +229,73 @@ class CQLTrainer(TorchTrainer):
         new_curr_actions_tensor, new_log_pis = self._get_policy_actions(
             next_obs, num_actions=self.num_random, network=self.policy
         )
-        q1_rand = self._get_tensor_values(obs, random_actions_tensor, network=self.qf1)
-        q2_rand = self._get_tensor_values(obs, random_actions_tensor, network=self.qf2)
-        q1_curr_actions = self._get_tensor_values(obs, curr_actions_tensor, network=self.qf1)
-        q2_curr_actions = self._get_tensor_values(obs, curr_actions_tensor, network=self.qf2)
-        q1_next_actions = self._get_tensor_values(obs, new_curr_actions_tensor, network=self.qf1)
-        q2_next_actions = self._get_tensor_values(obs, new_curr_actions_tensor, network=self.qf2)
-
-        cat_q1 = torch.cat([q1_rand, q1_pred.unsqueeze(1), q1_next_actions, q1_curr_actions], 1)
-        cat_q2 = torch.cat([q2_rand, q2_pred.unsqueeze(1), q2_next_actions, q2_curr_actions], 1)
-        std_q1 = torch.std(cat_q1, dim=1)
-        std_q2 = torch.std(cat_q2, dim=1)
+        # [num_qs, batch_size, num_random, 1], every critic in one pass
+        q_rand = self._get_tensor_values(obs, random_actions_tensor, network=self.qfs)
+        q_curr_actions = self._get_tensor_values(obs, curr_actions_tensor, network=self.qfs)
+        q_next_actions = self._get_tensor_values(obs, new_curr_actions_tensor, network=self.qfs)
+
+        cat_q = torch.cat([q_rand, q_preds.unsqueeze(2), q_next_actions, q_curr_actions], 2)
+        std_q = torch.std(cat_q, dim=2)
 
         if self.min_q_version == 3:
             # importance sammpled version
             random_density = np.log(0.5 ** curr_actions_tensor.shape[-1])
-            cat_q1 = torch.cat(
-                [
-                    q1_rand - random_density,
-                    q1_next_actions - new_log_pis.detach(),
-                    q1_curr_actions - curr_log_pis.detach(),
-                ],
-                1,
-            )
-            cat_q2 = torch.cat(
+            cat_q = torch.cat(
                 [
-                    q2_rand - random_density,
-                    q2_next_actions - new_log_pis.detach(),
-                    q2_curr_actions - curr_log_pis.detach(),
+                    q_rand - random_density,
+                    q_next_actions - new_log_pis.detach(),
+                    q_curr_actions - curr_log_pis.detach(),
                 ],
-                1,
+                2,
             )
 
-        min_qf1_loss = (
+        min_qf_losses = (
             torch.logsumexp(
-                cat_q1 / self.temp,
-                dim=1,
-            ).mean()
-            * self.min_q_weight
-            * self.temp
-        )
-        min_qf2_loss = (
-            torch.logsumexp(
-                cat_q2 / self.temp,
-                dim=1,
-            ).mean()
+                cat_q / self.temp,
+                dim=2,
+            )
+            .reshape(self.num_qs, -1)
+            .mean(1)
             * self.min_q_weight
             * self.temp
         )
 
         """Subtract the log likelihood of data"""
-        min_qf1_loss = min_qf1_loss - q1_pred.mean() * self.min_q_weight
-        min_qf2_loss = min_qf2_loss - q2_pred.mean() * self.min_q_weight
+        min_qf_losses = min_qf_losses - q_preds.reshape(self.num_qs, -1).mean(1) * self.min_q_weight
 
         if self.with_lagrange:
             alpha_prime = torch.clamp(self.log_alpha_prime.exp(), min=0.0, max=1000000.0)
-            min_qf1_loss = alpha_prime * (min_qf1_loss - self.target_action_gap)
-            min_qf2_loss = alpha_prime * (min_qf2_loss - self.target_action_gap)
+            min_qf_losses = alpha_prime * (min_qf_losses - self.target_action_gap)
 
             self.alpha_prime_optimizer.zero_grad()
-            alpha_prime_loss = (-min_qf1_loss - min_qf2_loss) * 0.5
+            alpha_prime_loss = -min_qf_losses.mean()
             alpha_prime_loss.backward(retain_graph=True)
             self.alpha_prime_optimizer.step()
 
-        qf1_loss = qf1_loss + min_qf1_loss
-        qf2_loss = qf2_loss + min_qf2_loss
+        qf_losses = qf_losses + min_qf_losses
 
         """
         Update networks
         """
         # Update the Q-functions iff
-        self._num_q_update_steps += 1
-        self.qf1_optimizer.zero_grad()
-        qf1_loss.backward(retain_graph=True)
-        self.qf1_optimizer.step()
-
-        if self.num_qs > 1:
-            self.qf2_optimizer.zero_grad()
-            qf2_loss.backward(retain_graph=True)
-            self.qf2_optimizer.step()
-
+        # the policy loss depends on the critics, which the qf step updates
+        # in place, so every gradient is computed before the first step. The
+        # losses depend on both networks, each only updates its own
         self._num_policy_update_steps += 1
         self.policy_optimizer.zero_grad()
-        policy_loss.backward(retain_graph=False)
+        policy_loss.backward(retain_graph=True, inputs=list(self.policy.parameters()))
+
+        self._num_q_update_steps += 1
+        self.qf_optimizer.zero_grad()
+        qf_losses.sum().backward(inputs=list(self.qfs.parameters()))
+
+        self.qf_optimizer.step()
         self.policy_optimizer.step()
 
         """
         Soft Updates
         """
-        ptu.soft_update_from_to(self.qf1, self.target_qf1, self.soft_target_tau)
-        if self.num_qs > 1:
-            ptu.soft_update_from_to(self.qf2, self.target_qf2, self.soft_target_tau)
+        self.target_qfs.soft_update_from(self.qfs, self.soft_target_tau)
         """
         Save some statistics for eval
         """
@@ -349,68 +307,45 @@ class CQLTrainer(TorchTrainer):
             """
             policy_loss = (log_pi - q_new_actions).mean()
 
-            self.eval_statistics["QF1 Loss"] = np.mean(ptu.get_numpy(qf1_loss))
-            self.eval_statistics["min QF1 Loss"] = np.mean(ptu.get_numpy(min_qf1_loss))
-            if self.num_qs > 1:
-                self.eval_statistics["QF2 Loss"] = np.mean(ptu.get_numpy(qf2_loss))
-                self.eval_statistics["min QF2 Loss"] = np.mean(ptu.get_numpy(min_qf2_loss))
+            for k in range(self.num_qs):
+                self.eval_statistics["QF{} Loss".format(k + 1)] = np.mean(ptu.get_numpy(qf_losses[k]))
+                self.eval_statistics["min QF{} Loss".format(k + 1)] = np.mean(ptu.get_numpy(min_qf_losses[k]))
 
             if not self.discrete:
-                self.eval_statistics["Std QF1 values"] = np.mean(ptu.get_numpy(std_q1))
-                self.eval_statistics["Std QF2 values"] = np.mean(ptu.get_numpy(std_q2))
-                self.eval_statistics.update(
-                    create_stats_ordered_dict(
-                        "QF1 in-distribution values",
-                        ptu.get_numpy(q1_curr_actions),
-                    )
-                )
-                self.eval_statistics.update(
-                    create_stats_ordered_dict(
-                        "QF2 in-distribution values",
-                        ptu.get_numpy(q2_curr_actions),
-                    )
-                )
-                self.eval_statistics.update(
-                    create_stats_ordered_dict(
-                        "QF1 random values",
-                        ptu.get_numpy(q1_rand),
-                    )
-                )
-                self.eval_statistics.update(
-                    create_stats_ordered_dict(
-                        "QF2 random values",
-                        ptu.get_numpy(q2_rand),
+                for k in range(self.num_qs):
+                    self.eval_statistics["Std QF{} values".format(k + 1)] = np.mean(ptu.get_numpy(std_q[k]))
+                for k in range(self.num_qs):
+                    self.eval_statistics.update(
+                        create_stats_ordered_dict(
+                            "QF{} in-distribution values".format(k + 1),
+                            ptu.get_numpy(q_curr_actions[k]),
+                        )
                     )
-                )
-                self.eval_statistics.update(
-                    create_stats_ordered_dict(
-                        "QF1 next_actions values",
-                        ptu.get_numpy(q1_next_actions),
+                for k in range(self.num_qs):
+                    self.eval_statistics.update(
+                        create_stats_ordered_dict(
+                            "QF{} random values".format(k + 1),
+                            ptu.get_numpy(q_rand[k]),
+                        )
                     )
-                )
-                self.eval_statistics.update(
-                    create_stats_ordered_dict(
-                        "QF2 next_actions values",
-                        ptu.get_numpy(q2_next_actions),
+                for k in range(self.num_qs):
+                    self.eval_statistics.update(
+                        create_stats_ordered_dict(
+                            "QF{} next_actions values".format(k + 1),
+                            ptu.get_numpy(q_next_actions[k]),
+                        )
                     )
-                )
                 self.eval_statistics.update(create_stats_ordered_dict("actions", ptu.get_numpy(actions)))
                 self.eval_statistics.update(create_stats_ordered_dict("rewards", ptu.get_numpy(rewards)))
 
             self.eval_statistics["Num Q Updates"] = self._num_q_update_steps
             self.eval_statistics["Num Policy Updates"] = self._num_policy_update_steps
             self.eval_statistics["Policy Loss"] = np.mean(ptu.get_numpy(policy_loss))
-            self.eval_statistics.update(
-                create_stats_ordered_dict(
-                    "Q1 Predictions",
-                    ptu.get_numpy(q1_pred),
-                )
-            )
-            if self.num_qs > 1:
+            for k, q_pred in enumerate(ptu.get_numpy(q_preds)):
                 self.eval_statistics.update(
                     create_stats_ordered_dict(
-                        "Q2 Predictions",
-                        ptu.get_numpy(q2_pred),
+                        "Q{} Predictions".format(k + 1),
+                        q_pred,
                     )
                 )
             self.eval_statistics.update(
@@ -445,8 +380,8 @@ class CQLTrainer(TorchTrainer):
 
             if self.with_lagrange:
                 self.eval_statistics["Alpha_prime"] = alpha_prime.item()
-                self.eval_statistics["min_q1_loss"] = ptu.get_numpy(min_qf1_loss).mean()
-                self.eval_statistics["min_q2_loss"] = ptu.get_numpy(min_qf2_loss).mean()
+                for k in range(self.num_qs):
+                    self.eval_statistics["min_q{}_loss".format(k + 1)] = ptu.get_numpy(min_qf_losses[k]).mean()
                 self.eval_statistics["threshold action gap"] = self.target_action_gap
                 self.eval_statistics["alpha prime loss"] = alpha_prime_loss.item()
 
@@ -462,18 +397,14 @@ class CQLTrainer(TorchTrainer):
     def networks(self):
         base_list = [
             self.policy,
-            self.qf1,
-            self.qf2,
-            self.target_qf1,
-            self.target_qf2,
+            self.qfs,
+            self.target_qfs,
         ]
         return base_list
 
     def get_snapshot(self):
-        return dict(
+        snapshot = dict(
             policy=self.policy,
-            qf1=self.qf1,
-            qf2=self.qf2,
-            target_qf1=self.target_qf1,
-            target_qf2=self.target_qf2,
         )
+        snapshot.update(self.get_critics_snapshot())
+        return snapshot
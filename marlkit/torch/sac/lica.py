@@ -207,24 +207,9 @@ class LICATrainer(MATorchTrainer):
         self._need_to_update_eval_statistics = True
 
     def train_from_torch(self, batch):
-        rewards = batch["rewards"]
-        terminals = batch["terminals"]
-        obs = batch["observations"]
-        actions = batch["actions"]
-        next_obs = batch["next_observations"]
-        states = batch["states"]
-
         """
         Policy and Alpha Loss
         """
-        """
-        obs = torch.from_numpy(np.concatenate(obs, axis=0)).float()
-        next_obs = torch.from_numpy(np.concatenate(next_obs, axis=0)).float()
-        terminals = torch.from_numpy(np.concatenate(terminals, axis=0)).float()
-        actions = torch.from_numpy(np.concatenate(actions, axis=0)).float()
-        rewards = torch.from_numpy(np.concatenate(rewards, axis=0)).float()
-        states = torch.from_numpy(np.concatenate(states, axis=0)).float()
-        """
 
         # do it per batch
         total_critic_loss = []
@@ -237,43 +222,25 @@ class LICATrainer(MATorchTrainer):
         total_entropy_loss = []
         total_grad_norm = []
 
-        def to_tensor(x, filter_n=None):
-            try:
-                if filter_n is None:
-                    return torch.from_numpy(np.array(x, dtype=float)).float()
-                else:
-                    return torch.from_numpy(np.array(x[:filter_n], dtype=float)).float()
-            except:
-                x = [np.array(x_) for x_ in x]
-                if filter_n is None:
-                    x = np.stack(x, 0)
-                else:
-                    x = x[:filter_n]
-                    x = np.stack(x, 0)
-                return torch.from_numpy(x).float()
+        # the target critic is fixed until the soft update after the loop, so
+        # it is evaluated once per agent count rather than once per episode
+        # (it pads the agents and the state of an episode itself)
+        with torch.no_grad():
+            target_critic_q_vals = batch.map_steps(
+                lambda actions, states: self.target_critic(actions, states).view(-1, 1), "actions", "states"
+            )
 
-        for b in range(len(obs)):
-            try:
-                rewards = to_tensor(batch["rewards"][b])
-                terminals = to_tensor(batch["terminals"][b])
-                obs = to_tensor(batch["observations"][b])
-                states = to_tensor(batch["states"][b])
-                active_agent = to_tensor(batch["active_agents"][b])
-                # state_0 = batch["states_0"]
-                actions = to_tensor(batch["actions"][b])
-                next_obs = to_tensor(batch["next_observations"][b])
-                next_states = to_tensor(batch["next_states"][b])
-            except:
-                filter_n = max(len(batch["observations"][b]) - 1, 1)
-                rewards = to_tensor(batch["rewards"][b], filter_n)
-                terminals = to_tensor(batch["terminals"][b], filter_n)
-                obs = to_tensor(batch["observations"][b], filter_n)
-                states = to_tensor(batch["states"][b], filter_n)
-                active_agent = to_tensor(batch["active_agents"][b], filter_n)
-                # state_0 = batch["states_0"]
-                actions = to_tensor(batch["actions"][b], filter_n)
-                next_obs = to_tensor(batch["next_observations"][b], filter_n)
-                next_states = to_tensor(batch["next_states"][b], filter_n)
+        for b in range(len(batch)):
+            episode = batch.episode(b)
+            rewards = episode["rewards"]
+            terminals = episode["terminals"]
+            obs = episode["observations"]
+            states = episode["states"]
+            active_agent = episode["active_agents"]
+            # state_0 = batch["states_0"]
+            actions = episode["actions"]
+            next_obs = episode["next_observations"]
+            next_states = episode["next_states"]
 
             try:
                 # see https://github.com/mzho7212/LICA/blob/main/src/run.py
@@ -281,9 +248,8 @@ class LICATrainer(MATorchTrainer):
                 # self.train_critic_td
 
                 # optimise critic
-                target_q_vals = self.target_critic(
-                    actions[1:], states[1:]
-                )  # check dim, and reformat - it should be one hot
+                # check dim, and reformat - it should be one hot
+                target_q_vals = target_critic_q_vals[b][1:].view(1, -1, 1)
 
                 # calculate td-lambda targets
                 targets = rewards + (1.0 - terminals) * self.discount * target_q_vals
@@ -109,11 +109,11 @@ class SACTrainer(MATorchTrainer):
         Policy and Alpha Loss
         """
         # no need to worry about groups of games. in the IAC setting.
-        obs = torch.from_numpy(np.concatenate(obs, axis=0)).float()
-        next_obs = torch.from_numpy(np.concatenate(next_obs, axis=0)).float()
-        terminals = torch.from_numpy(np.concatenate(terminals, axis=0)).float()
-        actions = torch.from_numpy(np.concatenate(actions, axis=0)).float()
-        rewards = torch.from_numpy(np.concatenate(rewards, axis=0)).float()
+        obs = batch.concatenated("observations")
+        next_obs = batch.concatenated("next_observations")
+        terminals = batch.concatenated("terminals")
+        actions = batch.concatenated("actions")
+        rewards = batch.concatenated("rewards")
 
         _, action_prob, log_pi, _ = self.policy(
             obs,
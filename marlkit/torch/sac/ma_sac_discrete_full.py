@@ -11,6 +11,7 @@ from torch import nn as nn
 
 import marlkit.torch.pytorch_util as ptu
 from marlkit.core.eval_util import create_stats_ordered_dict
+from marlkit.torch.shared_experience import shared_experience_loss
 from marlkit.torch.torch_rl_algorithm import MATorchTrainer
 
 
@@ -36,6 +37,7 @@ class SACTrainer(MATorchTrainer):
         target_entropy=None,
         # mac stuff
         use_shared_experience=False,
+        shared_experience_clip=None,
         use_central_critic=False,
         n_agents=None,
         state_dim=None,
@@ -51,6 +53,7 @@ class SACTrainer(MATorchTrainer):
         self.soft_target_tau = soft_target_tau
         self.target_update_period = target_update_period
         self.use_shared_experience = use_shared_experience
+        self.shared_experience_clip = shared_experience_clip
         self.use_central_critic = use_central_critic
         self.n_agents = n_agents
         self.state_dim = state_dim
@@ -101,39 +104,6 @@ class SACTrainer(MATorchTrainer):
         self._need_to_update_eval_statistics = True
 
     def train_from_torch(self, batch):
-        rewards = batch["rewards"]
-        terminals = batch["terminals"]
-        obs = batch["observations"]
-        states = batch["states"]
-        next_states = batch["next_states"]
-        actions = batch["actions"]
-        next_obs = batch["next_observations"]
-
-        # since this is IAC paradigm, we can just stack everything and move on
-        # since we're in the MA paradigm, we need to be careful of ragged
-        """
-        obs = torch.from_numpy(np.stack(obs, 0)).float()
-        actions = torch.from_numpy(np.stack(actions, 0)).float()
-        states = torch.from_numpy(np.stack(states, 0)).float()
-        next_obs = torch.from_numpy(np.stack(next_obs, 0)).float()
-        next_states = torch.from_numpy(np.stack(next_states, 0)).float()
-        """
-
-        def to_tensor(x, filter_n=None):
-            try:
-                if filter_n is None:
-                    return torch.from_numpy(np.array(x, dtype=float)).float()
-                else:
-                    return torch.from_numpy(np.array(x[:filter_n], dtype=float)).float()
-            except:
-                x = [np.array(x_) for x_ in x]
-                if filter_n is None:
-                    x = np.stack(x, 0)
-                else:
-                    x = x[:filter_n]
-                    x = np.stack(x, 0)
-                return torch.from_numpy(x).float()
-
         # statistics
         total_qf1_loss = []
         total_qf2_loss = []
@@ -142,28 +112,17 @@ class SACTrainer(MATorchTrainer):
         total_q_target = []
         total_policy_loss = []
 
-        for b in range(len(obs)):
-            try:
-                rewards = to_tensor(batch["rewards"][b])
-                terminals = to_tensor(batch["terminals"][b])
-                obs = to_tensor(batch["observations"][b])
-                states = to_tensor(batch["states"][b])
-                active_agent = to_tensor(batch["active_agents"][b])
-                # state_0 = batch["states_0"]
-                actions = to_tensor(batch["actions"][b])
-                next_obs = to_tensor(batch["next_observations"][b])
-                next_states = to_tensor(batch["next_states"][b])
-            except:
-                filter_n = len(batch["observations"][b]) - 1
-                rewards = to_tensor(batch["rewards"][b], filter_n)
-                terminals = to_tensor(batch["terminals"][b], filter_n)
-                obs = to_tensor(batch["observations"][b], filter_n)
-                states = to_tensor(batch["states"][b], filter_n)
-                active_agent = to_tensor(batch["active_agents"][b], filter_n)
-                # state_0 = batch["states_0"]
-                actions = to_tensor(batch["actions"][b], filter_n)
-                next_obs = to_tensor(batch["next_observations"][b], filter_n)
-                next_states = to_tensor(batch["next_states"][b], filter_n)
+        for b in range(len(batch)):
+            episode = batch.episode(b)
+            rewards = episode["rewards"]
+            terminals = episode["terminals"]
+            obs = episode["observations"]
+            states = episode["states"]
+            active_agent = episode["active_agents"]
+            # state_0 = batch["states_0"]
+            actions = episode["actions"]
+            next_obs = episode["next_observations"]
+            next_states = episode["next_states"]
 
             rewards = rewards.unsqueeze(0)
             terminals = terminals.unsqueeze(0)
@@ -260,18 +219,7 @@ class SACTrainer(MATorchTrainer):
                 n_agents = obs.shape[-2]
                 policy_loss_ = action_probs * (alpha * log_pis - q_new_actions)
 
-                policy_loss = None
-                for ag in range(n_agents):
-                    # iterate through all of them...
-                    if policy_loss is None:
-                        policy_loss = (
-                            torch.exp(log_pis - log_pis[:, :, [ag], :]).detach() * policy_loss_[:, :, [ag], :]
-                        ) * 0.1
-                    else:
-                        policy_loss += (
-                            torch.exp(log_pis - log_pis[:, :, [ag], :]).detach() * policy_loss_[:, :, [ag], :]
-                        ) * 0.1
-                policy_loss = policy_loss.mean()
+                policy_loss = shared_experience_loss(policy_loss_, log_pis, clip=self.shared_experience_clip) * 0.1
             else:
                 n_agents = action_probs.size(2)
                 if self.n_agents is not None:
@@ -347,10 +295,8 @@ class SACTrainer(MATorchTrainer):
 
             # update q_target
             n_action = target_q_values.shape[-1]
-            rewards = torch.from_numpy(np.stack(rewards, axis=0)).float().permute(0, 1, 3, 2).repeat(1, 1, 1, n_action)
-            terminals = (
-                torch.from_numpy(np.stack(terminals, axis=0)).float().permute(0, 1, 3, 2).repeat(1, 1, 1, n_action)
-            )
+            rewards = rewards.permute(0, 1, 3, 2).repeat(1, 1, 1, n_action)
+            terminals = terminals.permute(0, 1, 3, 2).repeat(1, 1, 1, n_action)
             if self.mrl:
                 # the munchausen RL augmentation in this setting is to regularise with other agent policies and not itself...
                 mrl_log_proba = self.policy.get_log_proba(obs)
@@ -380,19 +326,8 @@ class SACTrainer(MATorchTrainer):
                 qf1_loss_ = (q1_preds - q_target.detach()) ** 2
                 qf2_loss_ = (q2_preds - q_target.detach()) ** 2
 
-                qf1_loss = None
-                qf2_loss = None
-                for ag in range(n_agents):
-                    # iterate through all of them...
-                    if qf1_loss is None:
-                        qf1_loss = torch.exp(log_pis - log_pis[:, :, [ag], :]).detach() * qf1_loss_[:, :, [ag], :]
-                        qf2_loss = torch.exp(log_pis - log_pis[:, :, [ag], :]).detach() * qf2_loss_[:, :, [ag], :]
-                    else:
-                        qf1_loss += torch.exp(log_pis - log_pis[:, :, [ag], :]).detach() * qf1_loss_[:, :, [ag], :]
-                        qf2_loss += torch.exp(log_pis - log_pis[:, :, [ag], :]).detach() * qf2_loss_[:, :, [ag], :]
-
-                qf1_loss = qf1_loss.mean()
-                qf2_loss = qf2_loss.mean()
+                qf1_loss = shared_experience_loss(qf1_loss_, log_pis, clip=self.shared_experience_clip)
+                qf2_loss = shared_experience_loss(qf2_loss_, log_pis, clip=self.shared_experience_clip)
             else:
                 qf1_loss = self.qf_criterion(q1_preds, q_target.detach())
                 qf2_loss = self.qf_criterion(q2_preds, q_target.detach())
@@ -11,6 +11,7 @@ from torch import nn as nn
 
 import marlkit.torch.pytorch_util as ptu
 from marlkit.core.eval_util import create_stats_ordered_dict
+from marlkit.torch.shared_experience import shared_experience_loss
 from marlkit.torch.torch_rl_algorithm import MATorchTrainer
 
 
@@ -37,6 +38,7 @@ class SACTrainer(MATorchTrainer):
         # mac stuff
         mode="simple",
         use_shared_experience=False,
+        shared_experience_clip=None,
         use_central_critic=True,
     ):
         super().__init__()
@@ -50,6 +52,7 @@ class SACTrainer(MATorchTrainer):
         self.target_update_period = target_update_period
         self.mode = mode
         self.use_shared_experience = use_shared_experience
+        self.shared_experience_clip = shared_experience_clip
         self.use_central_critic = use_central_critic
 
         self.use_automatic_entropy_tuning = use_automatic_entropy_tuning
@@ -142,28 +145,28 @@ class SACTrainer(MATorchTrainer):
                 new_log_pi = []
                 for t in range(path_len):
 
-                    _, ap, logpi, _, hidden = self.policy(torch.from_numpy(obs[batch][t, :, :]).float(), hidden)
+                    _, ap, logpi, _, hidden = self.policy(obs[batch][t, :, :], hidden)
                     """
                     q1 = self.qf1(
-                        *[torch.from_numpy(obs[batch][t, :, :]).float(), ap]
+                        *[obs[batch][t, :, :], ap]
                     )
                     q2 = self.qf2(
-                        *[torch.from_numpy(obs[batch][t, :, :]).float(), ap]
+                        *[obs[batch][t, :, :], ap]
                     )
-                    act_ = torch.from_numpy(actions[batch][t, :, :]).float()
+                    act_ = actions[batch][t, :, :]
                     q1_p = self.qf1(
-                    *[torch.from_numpy(obs[batch][t, :, :]).float(), act_]
+                    *[obs[batch][t, :, :], act_]
                     )
                     q2_p = self.qf2(
-                        *[torch.from_numpy(obs[batch][t, :, :]).float(), act_]
+                        *[obs[batch][t, :, :], act_]
                     )
 
                     # targets...
                     target_q1 = self.target_qf1(
-                        *[torch.from_numpy(obs[batch][t, :, :]).float(), ap],
+                        *[obs[batch][t, :, :], ap],
                     )
                     target_q2 = self.target_qf2(
-                        *[torch.from_numpy(obs[batch][t, :, :]).float(), ap],
+                        *[obs[batch][t, :, :], ap],
                     )
                     """
                     action_prob.append(ap)
@@ -182,13 +185,13 @@ class SACTrainer(MATorchTrainer):
                         target_q2_val.append(target_q2)
                         """
                 # do one more of new_action_prob
-                _, ap, logpi, _, hidden = self.policy(torch.from_numpy(next_obs[batch][-1, :, :]).float(), hidden)
+                _, ap, logpi, _, hidden = self.policy(next_obs[batch][-1, :, :], hidden)
                 """
                 target_q1 = self.target_qf1(
-                    *[torch.from_numpy(next_obs[batch][-1, :, :]).float(), ap],
+                    *[next_obs[batch][-1, :, :], ap],
                 )
                 target_q2 = self.target_qf2(
-                    *[torch.from_numpy(next_obs[batch][-1, :, :]).float(), ap],
+                    *[next_obs[batch][-1, :, :], ap],
                 )
                 """
                 new_action_prob.append(ap)
@@ -249,29 +252,16 @@ class SACTrainer(MATorchTrainer):
                 alpha = 1
 
             # now calculate things off the q functions for the critic.
-            q1_new_actions = self.qf1(torch.cat([torch.from_numpy(np.stack(obs, 0)).float(), action_probs], -1))
-            q2_new_actions = self.qf2(torch.cat([torch.from_numpy(np.stack(obs, 0)).float(), action_probs], -1))
+            q1_new_actions = self.qf1(torch.cat([obs, action_probs], -1))
+            q2_new_actions = self.qf2(torch.cat([obs, action_probs], -1))
             q_new_actions = torch.min(q1_new_actions, q2_new_actions)
             if self.use_shared_experience:
                 # assume lambda = 1 as per paper, so we only need to iterate and not do the top part
-                obs = torch.from_numpy(np.stack(obs, 0)).float()
-                n_agents = obs.shape[-2]
                 policy_loss_ = action_probs * (alpha * log_pis - q_new_actions)
 
-                policy_loss = None
-                for ag in range(n_agents):
-                    # iterate through all of them...
-                    if policy_loss is None:
-                        policy_loss = (
-                            torch.exp(torch.exp(log_pis - log_pis[:, :, [ag], :])).detach()
-                            * policy_loss_[:, :, [ag], :]
-                        )
-                    else:
-                        policy_loss += (
-                            torch.exp(torch.exp(log_pis - log_pis[:, :, [ag], :])).detach()
-                            * policy_loss_[:, :, [ag], :]
-                        )
-                policy_loss = policy_loss.mean()
+                policy_loss = shared_experience_loss(
+                    policy_loss_, log_pis, double_exp=True, clip=self.shared_experience_clip
+                )
             else:
                 policy_loss = (action_probs * (alpha * log_pis - q_new_actions)).mean()
             # policy_loss = (alpha * log_pi - q_new_actions).mean()
@@ -282,13 +272,13 @@ class SACTrainer(MATorchTrainer):
             # q1_preds, q2_preds, new_action_probs, new_log_pis, target_q1_vals, target_q2_vals
             target_q1_vals = self.target_qf1(
                 torch.cat(
-                    [torch.from_numpy(np.stack(next_obs, 0)).float(), new_action_probs],
+                    [next_obs, new_action_probs],
                     -1,
                 )
             )
             target_q2_vals = self.target_qf2(
                 torch.cat(
-                    [torch.from_numpy(np.stack(next_obs, 0)).float(), new_action_probs],
+                    [next_obs, new_action_probs],
                     -1,
                 )
             )
@@ -296,16 +286,14 @@ class SACTrainer(MATorchTrainer):
 
             # update q_target
             n_action = target_q_values.shape[-1]
-            rewards = torch.from_numpy(np.stack(rewards, axis=0)).float().permute(0, 1, 3, 2).repeat(1, 1, 1, n_action)
-            terminals = (
-                torch.from_numpy(np.stack(terminals, axis=0)).float().permute(0, 1, 3, 2).repeat(1, 1, 1, n_action)
-            )
+            rewards = rewards.permute(0, 1, 3, 2).repeat(1, 1, 1, n_action)
+            terminals = terminals.permute(0, 1, 3, 2).repeat(1, 1, 1, n_action)
 
             q1_preds = self.qf1(
                 torch.cat(
                     [
-                        torch.from_numpy(np.stack(obs, 0)).float(),
-                        torch.from_numpy(np.stack(actions, 0)).float(),
+                        obs,
+                        actions,
                     ],
                     -1,
                 )
@@ -313,8 +301,8 @@ class SACTrainer(MATorchTrainer):
             q2_preds = self.qf2(
                 torch.cat(
                     [
-                        torch.from_numpy(np.stack(obs, 0)).float(),
-                        torch.from_numpy(np.stack(actions, 0)).float(),
+                        obs,
+                        actions,
                     ],
                     -1,
                 )
@@ -359,26 +347,26 @@ class SACTrainer(MATorchTrainer):
                 target_q2_val = []
                 for t in range(path_len):
 
-                    _, ap, logpi, _, hidden = self.policy(torch.from_numpy(obs[batch][t, :, :]).float(), hidden)
-                    q1, qf1_hidden = self.qf1([torch.from_numpy(obs[batch][t, :, :]).float(), ap], qf1_hidden)
-                    q2, qf2_hidden = self.qf2([torch.from_numpy(obs[batch][t, :, :]).float(), ap], qf2_hidden)
-                    act_ = torch.from_numpy(actions[batch][t, :, :]).float()
+                    _, ap, logpi, _, hidden = self.policy(obs[batch][t, :, :], hidden)
+                    q1, qf1_hidden = self.qf1([obs[batch][t, :, :], ap], qf1_hidden)
+                    q2, qf2_hidden = self.qf2([obs[batch][t, :, :], ap], qf2_hidden)
+                    act_ = actions[batch][t, :, :]
                     q1_p, qf1_p_hidden = self.qf1(
-                        [torch.from_numpy(obs[batch][t, :, :]).float(), act_],
+                        [obs[batch][t, :, :], act_],
                         qf1_p_hidden,
                     )
                     q2_p, qf2_p_hidden = self.qf2(
-                        [torch.from_numpy(obs[batch][t, :, :]).float(), act_],
+                        [obs[batch][t, :, :], act_],
                         qf2_p_hidden,
                     )
 
                     # targets...
                     target_q1, target_qf1_hidden = self.target_qf1(
-                        [torch.from_numpy(obs[batch][t, :, :]).float(), ap],
+                        [obs[batch][t, :, :], ap],
                         target_qf1_hidden,
                     )
                     target_q2, target_qf2_hidden = self.target_qf2(
-                        [torch.from_numpy(obs[batch][t, :, :]).float(), ap],
+                        [obs[batch][t, :, :], ap],
                         target_qf2_hidden,
                     )
                     action_prob.append(ap)
@@ -393,13 +381,13 @@ class SACTrainer(MATorchTrainer):
                         target_q1_val.append(target_q1)
                         target_q2_val.append(target_q2)
                 # do one more of new_action_prob
-                _, ap, logpi, _, hidden = self.policy(torch.from_numpy(next_obs[batch][-1, :, :]).float(), hidden)
+                _, ap, logpi, _, hidden = self.policy(next_obs[batch][-1, :, :], hidden)
                 target_q1, target_qf1_hidden = self.target_qf1(
-                    [torch.from_numpy(next_obs[batch][-1, :, :]).float(), ap],
+                    [next_obs[batch][-1, :, :], ap],
                     target_qf1_hidden,
                 )
                 target_q2, target_qf2_hidden = self.target_qf2(
-                    [torch.from_numpy(next_obs[batch][-1, :, :]).float(), ap],
+                    [next_obs[batch][-1, :, :], ap],
                     target_qf2_hidden,
                 )
                 new_action_prob.append(ap)
@@ -464,41 +452,20 @@ class SACTrainer(MATorchTrainer):
 
             # update q_target
             n_action = target_q_values.shape[-1]
-            rewards = torch.from_numpy(np.stack(rewards, axis=0)).float().permute(0, 1, 3, 2).repeat(1, 1, 1, n_action)
-            terminals = (
-                torch.from_numpy(np.stack(terminals, axis=0)).float().permute(0, 1, 3, 2).repeat(1, 1, 1, n_action)
-            )
+            rewards = rewards.permute(0, 1, 3, 2).repeat(1, 1, 1, n_action)
+            terminals = terminals.permute(0, 1, 3, 2).repeat(1, 1, 1, n_action)
 
             q_target = self.reward_scale * rewards + (1.0 - terminals) * self.discount * target_q_values
 
         if self.use_shared_experience:
             # assume lambda = 1 as per paper, so we only need to iterate and not do the top part
             # otherwise we add additional loss when we have ag = ag style item or an identity matrix
-            n_agents = obs[0].shape[-2]
             # policy_loss_ = (action_probs * (alpha * log_pis - q_new_actions))
             qf1_loss_ = (q1_preds - q_target.detach()) ** 2
             qf2_loss_ = (q2_preds - q_target.detach()) ** 2
 
-            qf1_loss = None
-            qf2_loss = None
-            for ag in range(n_agents):
-                # iterate through all of them...
-                if qf1_loss is None:
-                    qf1_loss = (
-                        torch.exp(torch.exp(log_pis - log_pis[:, :, [ag], :])).detach() * qf1_loss_[:, :, [ag], :]
-                    )
-                    qf2_loss = (
-                        torch.exp(torch.exp(log_pis - log_pis[:, :, [ag], :])).detach() * qf2_loss_[:, :, [ag], :]
-                    )
-                else:
-                    qf1_loss += (
-                        torch.exp(torch.exp(log_pis - log_pis[:, :, [ag], :])).detach() * qf1_loss_[:, :, [ag], :]
-                    )
-                    qf2_loss += (
-                        torch.exp(torch.exp(log_pis - log_pis[:, :, [ag], :])).detach() * qf2_loss_[:, :, [ag], :]
-                    )
-            qf1_loss = qf1_loss.mean()
-            qf2_loss = qf2_loss.mean()
+            qf1_loss = shared_experience_loss(qf1_loss_, log_pis, double_exp=True, clip=self.shared_experience_clip)
+            qf2_loss = shared_experience_loss(qf2_loss_, log_pis, double_exp=True, clip=self.shared_experience_clip)
         else:
             qf1_loss = self.qf_criterion(q1_preds, q_target.detach())
             qf2_loss = self.qf_criterion(q2_preds, q_target.detach())
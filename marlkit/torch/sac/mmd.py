@@ -0,0 +1,91 @@
+"""
+MMD support matching losses for BEAR.
+
+`MMDLoss` computes the same (biased) MMD estimate as the pairwise difference
+implementation BEAR used, but through `torch.cdist` so that the `B x N x N x d`
+difference tensors are never built, and the per action dimension variant
+(`per_dim=True`) is a single batched call rather than a loop over the action
+dimensions.
+
+With `num_features` the kernel is approximated with random Fourier features,
+which is linear rather than quadratic in the number of samples:
+
+*  gaussian `exp(-|x - y|^2 / (2 sigma))`: frequencies drawn from `N(0, 1 / sigma)`
+*  laplacian `exp(-|x - y|_1 / (2 sigma))`: frequencies drawn from `Cauchy(0, 1 / (2 sigma))`
+"""
+
+import math
+
+import torch
+
+KERNELS = ("laplacian", "gaussian")
+
+
+def _exact_kernel_mean(x, y, kernel, sigma):
+    """
+    Mean of the kernel over all `[N, M]` pairs of `x` (`[..., N, d]`) and `y`
+    (`[..., M, d]`)
+    """
+    if kernel == "laplacian":
+        dist = torch.cdist(x, y, p=1)
+    else:
+        dist = torch.cdist(x, y, p=2, compute_mode="donot_use_mm_for_euclid_dist").pow(2)
+    return (-dist / (2.0 * sigma)).exp().mean(dim=(-2, -1))
+
+
+class MMDLoss(object):
+    def __init__(self, kernel="laplacian", sigma=10.0, per_dim=False, num_features=None):
+        """
+        :param kernel: "laplacian" or "gaussian"
+        :param per_dim: the MMD of every action dimension separately, `[B, d]`
+        rather than `[B]`, as used by the discrete BEAR trainer
+        :param num_features: number of random Fourier features, the exact
+        kernel is used if this is None
+        """
+        if kernel not in KERNELS:
+            raise ValueError("unknown kernel {}, expected one of {}".format(kernel, KERNELS))
+        self.kernel = kernel
+        self.sigma = sigma
+        self.per_dim = per_dim
+        self.num_features = num_features
+        self._omega = None
+        self._phase = None
+
+    def __call__(self, samples1, samples2):
+        """
+        :param samples1: `[B, N, d]`
+        :param samples2: `[B, M, d]`
+        """
+        if self.per_dim:
+            # every action dimension as its own set of 1 dimensional samples
+            samples1 = samples1.transpose(1, 2).unsqueeze(-1)
+            samples2 = samples2.transpose(1, 2).unsqueeze(-1)
+        if self.num_features is None:
+            k_xx = _exact_kernel_mean(samples1, samples1, self.kernel, self.sigma)
+            k_xy = _exact_kernel_mean(samples1, samples2, self.kernel, self.sigma)
+            k_yy = _exact_kernel_mean(samples2, samples2, self.kernel, self.sigma)
+            return (k_xx + k_yy - 2.0 * k_xy + 1e-6).sqrt()
+
+        mean_diff = self._features(samples1).mean(-2) - self._features(samples2).mean(-2)
+        return (mean_diff.pow(2).sum(-1) + 1e-6).sqrt()
+
+    def _features(self, samples):
+        """
+        `[..., N, num_features]` random Fourier features of `samples`, the
+        frequencies are drawn once and reused, per action dimension if
+        `per_dim`
+        """
+        dim = samples.shape[-1]
+        n_sets = samples.shape[1] if self.per_dim else 1
+        if self._omega is None or self._omega.shape[:2] != (n_sets, dim) or self._omega.device != samples.device:
+            shape = (n_sets, dim, self.num_features)
+            if self.kernel == "gaussian":
+                omega = torch.randn(shape, device=samples.device) / math.sqrt(self.sigma)
+            else:
+                omega = torch.empty(shape, device=samples.device).cauchy_(0.0, 1.0 / (2.0 * self.sigma))
+            self._omega = omega
+            self._phase = torch.rand(n_sets, 1, self.num_features, device=samples.device) * 2 * math.pi
+        omega, phase = self._omega, self._phase
+        if not self.per_dim:
+            omega, phase = omega[0], phase[0]
+        return math.sqrt(2.0 / self.num_features) * torch.cos(torch.matmul(samples, omega) + phase)
@@ -7,18 +7,19 @@ from torch import nn as nn
 
 import marlkit.torch.pytorch_util as ptu
 from marlkit.core.eval_util import create_stats_ordered_dict
-from marlkit.torch.torch_rl_algorithm import TorchTrainer
+from marlkit.torch.networks import EnsembleFlattenMlp, ensemble_min, ensemble_mse
+from marlkit.torch.torch_rl_algorithm import EnsembleCriticsMixin, TorchTrainer
 
 
-class SACTrainer(TorchTrainer):
+class SACTrainer(EnsembleCriticsMixin, TorchTrainer):
     def __init__(
         self,
         env,
         policy,
-        qf1,
-        qf2,
-        target_qf1,
-        target_qf2,
+        qf1=None,
+        qf2=None,
+        target_qf1=None,
+        target_qf2=None,
         discount=0.99,
         reward_scale=1.0,
         policy_lr=1e-3,
@@ -30,14 +31,27 @@ class SACTrainer(TorchTrainer):
         render_eval_paths=False,
         use_automatic_entropy_tuning=True,
         target_entropy=None,
+        qfs=None,
+        target_qfs=None,
+        num_min_qs=None,
     ):
+        """
+        The critics are either `qf1`, `qf2` (and their targets), which are
+        stacked into an `EnsembleFlattenMlp`, or an `EnsembleFlattenMlp` of
+        any size as `qfs` and `target_qfs`.
+
+        :param num_min_qs: size of the random subset of the ensemble the
+        target is the minimum of (REDQ), all of the critics if None
+        """
         super().__init__()
         self.env = env
         self.policy = policy
-        self.qf1 = qf1
-        self.qf2 = qf2
-        self.target_qf1 = target_qf1
-        self.target_qf2 = target_qf2
+        if qfs is None:
+            qfs = EnsembleFlattenMlp.from_mlps([qf1, qf2])
+            target_qfs = EnsembleFlattenMlp.from_mlps([target_qf1, target_qf2])
+        self.qfs = qfs
+        self.target_qfs = target_qfs
+        self.num_min_qs = num_min_qs
         self.soft_target_tau = soft_target_tau
         self.target_update_period = target_update_period
 
@@ -63,12 +77,8 @@ class SACTrainer(TorchTrainer):
             self.policy.parameters(),
             lr=policy_lr,
         )
-        self.qf1_optimizer = optimizer_class(
-            self.qf1.parameters(),
-            lr=qf_lr,
-        )
-        self.qf2_optimizer = optimizer_class(
-            self.qf2.parameters(),
+        self.qf_optimizer = optimizer_class(
+            self.qfs.parameters(),
             lr=qf_lr,
         )
 
@@ -103,17 +113,13 @@ class SACTrainer(TorchTrainer):
             alpha_loss = 0
             alpha = 1
 
-        q_new_actions = torch.min(
-            self.qf1(obs, new_obs_actions),
-            self.qf2(obs, new_obs_actions),
-        )
+        q_new_actions = self.qfs(obs, new_obs_actions).min(0)[0]
         policy_loss = (alpha * log_pi - q_new_actions).mean()
 
         """
         QF Loss
         """
-        q1_pred = self.qf1(obs, actions)
-        q2_pred = self.qf2(obs, actions)
+        q_preds = self.qfs(obs, actions)
         # Make sure policy accounts for squashing functions like tanh correctly!
         new_next_actions, _, _, new_log_pi, *_ = self.policy(
             next_obs,
@@ -121,38 +127,30 @@ class SACTrainer(TorchTrainer):
             return_log_prob=True,
         )
         target_q_values = (
-            torch.min(
-                self.target_qf1(next_obs, new_next_actions),
-                self.target_qf2(next_obs, new_next_actions),
-            )
-            - alpha * new_log_pi
+            ensemble_min(self.target_qfs(next_obs, new_next_actions), self.num_min_qs) - alpha * new_log_pi
         )
 
         q_target = self.reward_scale * rewards + (1.0 - terminals) * self.discount * target_q_values
-        qf1_loss = self.qf_criterion(q1_pred, q_target.detach())
-        qf2_loss = self.qf_criterion(q2_pred, q_target.detach())
+        qf_losses = ensemble_mse(q_preds, q_target.detach())
 
         """
         Update networks
         """
-        self.qf1_optimizer.zero_grad()
-        qf1_loss.backward()
-        self.qf1_optimizer.step()
-
-        self.qf2_optimizer.zero_grad()
-        qf2_loss.backward()
-        self.qf2_optimizer.step()
-
+        # the policy loss depends on the critics, which the qf step updates
+        # in place, so every gradient is computed before the first step
         self.policy_optimizer.zero_grad()
         policy_loss.backward()
+        self.qf_optimizer.zero_grad()
+        qf_losses.sum().backward()
+
+        self.qf_optimizer.step()
         self.policy_optimizer.step()
 
         """
         Soft Updates
         """
         if self._n_train_steps_total % self.target_update_period == 0:
-            ptu.soft_update_from_to(self.qf1, self.target_qf1, self.soft_target_tau)
-            ptu.soft_update_from_to(self.qf2, self.target_qf2, self.soft_target_tau)
+            self.target_qfs.soft_update_from(self.qfs, self.soft_target_tau)
 
         """
         Save some statistics for eval
@@ -165,21 +163,16 @@ class SACTrainer(TorchTrainer):
             """
             policy_loss = (log_pi - q_new_actions).mean()
 
-            self.eval_statistics["QF1 Loss"] = np.mean(ptu.get_numpy(qf1_loss))
-            self.eval_statistics["QF2 Loss"] = np.mean(ptu.get_numpy(qf2_loss))
+            for k, qf_loss in enumerate(ptu.get_numpy(qf_losses)):
+                self.eval_statistics["QF{} Loss".format(k + 1)] = qf_loss
             self.eval_statistics["Policy Loss"] = np.mean(ptu.get_numpy(policy_loss))
-            self.eval_statistics.update(
-                create_stats_ordered_dict(
-                    "Q1 Predictions",
-                    ptu.get_numpy(q1_pred),
-                )
-            )
-            self.eval_statistics.update(
-                create_stats_ordered_dict(
-                    "Q2 Predictions",
-                    ptu.get_numpy(q2_pred),
+            for k, q_pred in enumerate(ptu.get_numpy(q_preds)):
+                self.eval_statistics.update(
+                    create_stats_ordered_dict(
+                        "Q{} Predictions".format(k + 1),
+                        q_pred,
+                    )
                 )
-            )
             self.eval_statistics.update(
                 create_stats_ordered_dict(
                     "Q Targets",
@@ -219,17 +212,13 @@ class SACTrainer(TorchTrainer):
     def networks(self):
         return [
             self.policy,
-            self.qf1,
-            self.qf2,
-            self.target_qf1,
-            self.target_qf2,
+            self.qfs,
+            self.target_qfs,
         ]
 
     def get_snapshot(self):
-        return dict(
+        snapshot = dict(
             policy=self.policy,
-            qf1=self.qf1,
-            qf2=self.qf2,
-            target_qf1=self.qf1,
-            target_qf2=self.qf2,
         )
+        snapshot.update(self.get_critics_snapshot())
+        return snapshot
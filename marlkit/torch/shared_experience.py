@@ -0,0 +1,53 @@
+"""
+Shared experience (SEAC style) losses.
+
+Every agent `i` learns from the experience of every agent `ag`, weighted by
+the importance ratio `pi_i / pi_ag` of the action taken, i.e.
+
+    loss_i = sum_ag exp(log_pi_i - log_pi_ag) * loss_ag
+
+The trainers used to build this with a python loop over `ag`. Here all of
+the pairwise ratios are built in one broadcasted `[..., N, N, ...]` tensor
+and the weighted loss is reduced in a single `sum`.
+"""
+
+import torch
+
+
+def importance_ratios(log_pi, clip=None, double_exp=False):
+    """
+    All pairwise agent importance ratios.
+
+    :param log_pi: `[..., N, A]` log probabilities with agents on dim -2
+    :param clip: optional upper bound of the ratios
+    :param double_exp: apply `exp` once more to the ratios, this is the
+    weighting the GRU, QTran and QCGraph trainers have always used
+    :return: `[..., N, N, A]` detached ratios, `ratios[..., i, ag, :]` is
+    `exp(log_pi[..., i, :] - log_pi[..., ag, :])`
+    """
+    log_pi = log_pi.detach()
+    ratios = torch.exp(log_pi.unsqueeze(-2) - log_pi.unsqueeze(-3))
+    if double_exp:
+        ratios = torch.exp(ratios)
+    if clip is not None:
+        ratios = ratios.clamp(max=clip)
+    return ratios
+
+
+def shared_experience_loss(loss, log_pi, clip=None, double_exp=False, reduction="mean"):
+    """
+    :param loss: `[..., N, A]` (or `[..., N, 1]`) per agent loss, agents on dim -2
+    :param log_pi: `[..., N, A]` log probabilities used for the ratios
+    :param clip: optional upper bound of the importance ratios
+    :param double_exp: see `importance_ratios`
+    :param reduction: "mean", "sum" or "none" over the weighted loss
+    """
+    ratios = importance_ratios(log_pi, clip=clip, double_exp=double_exp)
+    weighted = (ratios * loss.unsqueeze(-3)).sum(-2)
+    if reduction == "mean":
+        return weighted.mean()
+    if reduction == "sum":
+        return weighted.sum()
+    if reduction == "none":
+        return weighted
+    raise ValueError("unknown reduction {}".format(reduction))
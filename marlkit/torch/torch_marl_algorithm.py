@@ -35,8 +35,18 @@ class TorchTrainer(Trainer, metaclass=abc.ABCMeta):
         self._num_train_steps = 0
 
     def train(self, np_batch):
+        self.train_collated(self.collate(np_batch))
+
+    def collate(self, np_batch):
+        """
+        Converts a replay buffer batch to what `train_from_torch` expects.
+        This has no side effects, so it may run in a background thread
+        (see marlkit.torch.data.BatchPrefetcher).
+        """
+        return np_to_pytorch_batch(np_batch)
+
+    def train_collated(self, batch):
         self._num_train_steps += 1
-        batch = np_to_pytorch_batch(np_batch)
         self.train_from_torch(batch)
 
     def get_diagnostics(self):
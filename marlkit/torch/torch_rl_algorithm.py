@@ -8,6 +8,7 @@ from marlkit.core.batch_rl_algorithm import BatchRLAlgorithm
 from marlkit.core.online_rl_algorithm import OnlineRLAlgorithm
 from marlkit.core.trainer import Trainer
 from marlkit.torch.core import np_to_pytorch_batch
+from marlkit.torch.episode_batch import EpisodeBatch
 
 
 class TorchOnlineRLAlgorithm(OnlineRLAlgorithm):
@@ -35,8 +36,18 @@ class TorchTrainer(Trainer, metaclass=abc.ABCMeta):
         self._num_train_steps = 0
 
     def train(self, np_batch):
+        self.train_collated(self.collate(np_batch))
+
+    def collate(self, np_batch):
+        """
+        Converts a replay buffer batch to what `train_from_torch` expects.
+        This has no side effects, so it may run in a background thread
+        (see marlkit.torch.data.BatchPrefetcher).
+        """
+        return np_to_pytorch_batch(np_batch)
+
+    def train_collated(self, batch):
         self._num_train_steps += 1
-        batch = np_to_pytorch_batch(np_batch)
         self.train_from_torch(batch)
 
     def get_diagnostics(self):
@@ -56,13 +67,56 @@ class TorchTrainer(Trainer, metaclass=abc.ABCMeta):
         pass
 
 
+class EnsembleCriticsMixin(object):
+    """
+    For the trainers which stack their critics in `qfs`/`target_qfs`
+    (`EnsembleFlattenMlp`s): read-only `qf1`, `qf2`, `target_qf1`,
+    `target_qf2` accessors, which return copies of the ensemble members,
+    and the snapshot of the critics in the per critic layout.
+    """
+
+    @property
+    def qf1(self):
+        return self.qfs.member(0)
+
+    @property
+    def qf2(self):
+        return self.qfs.member(1)
+
+    @property
+    def target_qf1(self):
+        return self.target_qfs.member(0)
+
+    @property
+    def target_qf2(self):
+        return self.target_qfs.member(1)
+
+    def get_critics_snapshot(self):
+        """
+        `qf1`, ..., `qf<K>` and `target_qf1`, ..., `target_qf<K>`
+        """
+        snapshot = {}
+        for k in range(self.qfs.ensemble_size):
+            snapshot["qf{}".format(k + 1)] = self.qfs.member(k)
+            snapshot["target_qf{}".format(k + 1)] = self.target_qfs.member(k)
+        return snapshot
+
+
 class MATorchTrainer(Trainer, metaclass=abc.ABCMeta):
     def __init__(self):
         self._num_train_steps = 0
 
     def train(self, batch):
+        self.train_collated(self.collate(batch))
+
+    def collate(self, batch):
+        # whole episodes, padded once to [B, T, ...] float tensors
+        if isinstance(batch, EpisodeBatch):
+            return batch
+        return EpisodeBatch.from_random_batch(batch)
+
+    def train_collated(self, batch):
         self._num_train_steps += 1
-        # batch = np_to_pytorch_batch(np_batch)
         self.train_from_torch(batch)
 
     def get_diagnostics(self):
@@ -0,0 +1,130 @@
+"""
+Checks that the bucketed sampler of the whole path replay buffers draws
+every batch from a single (agent count, length) bucket, and only from the
+episodes which are still stored, while the buffers evict their oldest
+episodes.
+"""
+import sys
+import os
+
+sys.path.append(os.path.dirname(sys.path[0]))
+from collections import deque
+
+import numpy as np
+
+from marlkit.data_management.bucket_sampler import BucketSampler
+from marlkit.data_management.simple_replay_buffer import WholeMAReplayBuffer
+from marlkit.data_management.spill_replay_buffer import BudgetWholeMAReplayBuffer
+from marlkit.data_management.torch_replay_buffer import TorchWholeMAReplayBuffer
+from marlkit.torch.episode_batch import EpisodeBatch
+
+OBS_DIM = 2
+STATE_DIM = 3
+ACTION_DIM = 2
+MAX_PATH_LENGTH = 12
+MAX_NUM_AGENTS = 4
+
+
+def test_sampler_under_eviction():
+    np.random.seed(0)
+    sampler = BucketSampler(length_bucket_width=4)
+    # (n_agents, length) of the stored episodes, oldest first
+    stored = deque()
+    for step in range(500):
+        n_agents, length = np.random.randint(1, 4), np.random.randint(1, 13)
+        sampler.add(n_agents, length)
+        stored.append((n_agents, length))
+        # evict in bursts, so that buckets empty and come back
+        while len(stored) > 20 or (len(stored) > 1 and np.random.rand() < 0.3):
+            sampler.evict_oldest()
+            stored.popleft()
+        assert len(sampler) == len(stored)
+
+        positions = sampler.sample(16)
+        assert positions.min() >= 0 and positions.max() < len(stored)
+        keys = {sampler._key(*stored[position]) for position in positions}
+        assert len(keys) == 1, keys
+    assert sampler.get_diagnostics()["largest bucket"] <= 20
+
+
+def add_episode(replay_buffer, episode_id, n_agents, length):
+    # every observation holds the episode id
+    replay_buffer.add_sample(
+        observation=[np.full((n_agents, OBS_DIM), episode_id, dtype=float) for _ in range(length)],
+        states=[np.zeros((1, STATE_DIM)) for _ in range(length)],
+        states_0=[np.zeros((1, STATE_DIM)) for _ in range(length)],
+        active_agents=[np.ones((1, MAX_NUM_AGENTS)) for _ in range(length)],
+        action=[np.eye(ACTION_DIM)[np.zeros(n_agents, dtype=int)] for _ in range(length)],
+        reward=[np.zeros((1, n_agents)) for _ in range(length)],
+        next_observation=[np.zeros((n_agents, OBS_DIM)) for _ in range(length)],
+        next_states=[np.zeros((1, STATE_DIM)) for _ in range(length)],
+        next_states_0=[np.zeros((1, STATE_DIM)) for _ in range(length)],
+        terminal=[np.zeros((1, n_agents)) for _ in range(length)],
+        env_info={},
+    )
+
+
+def sampled_episodes(batch):
+    """
+    `(episode ids, agent counts, lengths)` of a `random_batch`
+    """
+    if isinstance(batch, EpisodeBatch):
+        return list(batch["observations"][:, 0, 0, 0].long().numpy()), list(batch.n_agents), list(batch.lengths)
+    observations = batch["observations"]
+    return (
+        [int(episode[0][0, 0]) for episode in observations],
+        [len(episode[0]) for episode in observations],
+        [len(episode) for episode in observations],
+    )
+
+
+def check_buffer(replay_buffer, capacity, live):
+    """
+    :param live: returns the ids of the episodes the buffer still stores
+    """
+    np.random.seed(1)
+    shapes = {}
+    for episode_id in range(3 * capacity):
+        n_agents, length = np.random.randint(2, MAX_NUM_AGENTS + 1), np.random.randint(1, MAX_PATH_LENGTH + 1)
+        shapes[episode_id] = (n_agents, length)
+        add_episode(replay_buffer, episode_id, n_agents, length)
+        stored = live(episode_id)
+        for _ in range(3):
+            ids, n_agents, lengths = sampled_episodes(replay_buffer.random_batch(8))
+            # a single bucket, from the stored episodes
+            assert len(set(n_agents)) == 1, n_agents
+            assert len({(length - 1) // 4 for length in lengths}) == 1, lengths
+            assert set(ids) <= stored, (ids, stored)
+            assert all(shapes[i] == (n, length) for i, n, length in zip(ids, n_agents, lengths))
+
+
+def test_whole_path_buffers():
+    capacity = 10
+    kwargs = dict(env_info_sizes={}, sampler="bucket", length_bucket_width=4)
+    # the numpy and torch buffers keep the newest `capacity` episodes
+    newest = lambda episode_id: set(range(max(episode_id + 1 - capacity, 0), episode_id + 1))
+    check_buffer(WholeMAReplayBuffer(capacity, OBS_DIM, STATE_DIM, ACTION_DIM, **kwargs), capacity, newest)
+    check_buffer(
+        TorchWholeMAReplayBuffer(
+            capacity,
+            OBS_DIM,
+            STATE_DIM,
+            ACTION_DIM,
+            max_path_length=MAX_PATH_LENGTH,
+            max_num_agents=MAX_NUM_AGENTS,
+            **kwargs,
+        ),
+        capacity,
+        newest,
+    )
+
+    # the memory budget evicts more, the buffer reports how many
+    budget = BudgetWholeMAReplayBuffer(capacity, OBS_DIM, STATE_DIM, ACTION_DIM, max_replay_buffer_bytes=4096, **kwargs)
+    live = lambda episode_id: set(range(budget._num_evicted, episode_id + 1))
+    check_buffer(budget, capacity, live)
+    assert budget._num_evicted > 2 * capacity
+
+
+if __name__ == "__main__":
+    test_sampler_under_eviction()
+    test_whole_path_buffers()
@@ -0,0 +1,206 @@
+"""
+Checks the stacked critic ensembles of the SAC and CQL trainers against
+the previous per critic updates (two `FlattenMlp`s, each with its own
+optimizer and `nn.MSELoss`), on the same seed, and the `qf1`/`qf2`
+accessors and snapshot keys kept for the callers of the per critic layout.
+"""
+import sys
+import os
+
+sys.path.append(os.path.dirname(sys.path[0]))
+import copy
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+from torch import nn as nn
+
+from marlkit.torch.networks import FlattenMlp
+from marlkit.torch.sac.cql import CQLTrainer
+from marlkit.torch.sac.policies import TanhGaussianPolicy
+from marlkit.torch.sac.sac import SACTrainer
+
+OBS_DIM = 5
+ACTION_DIM = 2
+BATCH_SIZE = 16
+NUM_STEPS = 5
+LR = 3e-3
+
+
+def make_networks(seed=0):
+    torch.manual_seed(seed)
+    policy = TanhGaussianPolicy([32, 32], obs_dim=OBS_DIM, action_dim=ACTION_DIM)
+    qfs = [FlattenMlp([32, 32], 1, OBS_DIM + ACTION_DIM) for _ in range(2)]
+    target_qfs = [copy.deepcopy(qf) for qf in qfs]
+    return policy, qfs, target_qfs
+
+
+def make_batches(seed=0):
+    rng = np.random.RandomState(seed)
+    batches = []
+    for _ in range(NUM_STEPS):
+        batch = dict(
+            observations=rng.randn(BATCH_SIZE, OBS_DIM),
+            actions=rng.uniform(-1, 1, (BATCH_SIZE, ACTION_DIM)),
+            rewards=rng.randn(BATCH_SIZE, 1),
+            terminals=(rng.rand(BATCH_SIZE, 1) < 0.2).astype(float),
+            next_observations=rng.randn(BATCH_SIZE, OBS_DIM),
+        )
+        batches.append({key: torch.as_tensor(value, dtype=torch.float32) for key, value in batch.items()})
+    return batches
+
+
+class ReferenceCritics(object):
+    """
+    The per critic updates the trainers did before the ensemble
+    """
+
+    def __init__(self, policy, qfs, target_qfs, tau):
+        self.policy = policy
+        self.qfs = qfs
+        self.target_qfs = target_qfs
+        self.tau = tau
+        self.log_alpha = torch.zeros(1, requires_grad=True)
+        self.alpha_optimizer = torch.optim.Adam([self.log_alpha], lr=LR)
+        self.policy_optimizer = torch.optim.Adam(policy.parameters(), lr=LR)
+        self.qf_optimizers = [torch.optim.Adam(qf.parameters(), lr=LR) for qf in qfs]
+        self.qf_criterion = nn.MSELoss()
+
+    def policy_and_alpha_loss(self, obs):
+        new_obs_actions, _, _, log_pi, *_ = self.policy(obs, reparameterize=True, return_log_prob=True)
+        alpha_loss = -(self.log_alpha * (log_pi - ACTION_DIM).detach()).mean()
+        self.alpha_optimizer.zero_grad()
+        alpha_loss.backward()
+        self.alpha_optimizer.step()
+        alpha = self.log_alpha.exp()
+        q_new_actions = torch.min(*[qf(obs, new_obs_actions) for qf in self.qfs])
+        return alpha, (alpha * log_pi - q_new_actions).mean()
+
+    def step(self, qf_losses, policy_loss):
+        # every gradient before the first parameter update, each loss only
+        # updates its own network
+        for optimizer in self.qf_optimizers + [self.policy_optimizer]:
+            optimizer.zero_grad()
+        policy_loss.backward(retain_graph=True, inputs=list(self.policy.parameters()))
+        for qf, qf_loss in zip(self.qfs, qf_losses):
+            qf_loss.backward(retain_graph=True, inputs=list(qf.parameters()))
+        for optimizer in self.qf_optimizers + [self.policy_optimizer]:
+            optimizer.step()
+        with torch.no_grad():
+            for qf, target_qf in zip(self.qfs, self.target_qfs):
+                for param, target_param in zip(qf.parameters(), target_qf.parameters()):
+                    target_param.mul_(1 - self.tau).add_(param, alpha=self.tau)
+
+    def sac_step(self, batch, discount):
+        obs, actions = batch["observations"], batch["actions"]
+        alpha, policy_loss = self.policy_and_alpha_loss(obs)
+        q_preds = [qf(obs, actions) for qf in self.qfs]
+        new_next_actions, _, _, new_log_pi, *_ = self.policy(
+            batch["next_observations"], reparameterize=True, return_log_prob=True
+        )
+        target_q_values = (
+            torch.min(*[target_qf(batch["next_observations"], new_next_actions) for target_qf in self.target_qfs])
+            - alpha * new_log_pi
+        )
+        q_target = batch["rewards"] + (1.0 - batch["terminals"]) * discount * target_q_values
+        self.step([self.qf_criterion(q_pred, q_target.detach()) for q_pred in q_preds], policy_loss)
+
+    def _tensor_values(self, obs, actions, qf):
+        num_repeat = actions.shape[0] // obs.shape[0]
+        obs_temp = obs.unsqueeze(1).repeat(1, num_repeat, 1).view(obs.shape[0] * num_repeat, obs.shape[1])
+        return qf(obs_temp, actions).view(obs.shape[0], num_repeat, 1)
+
+    def _policy_actions(self, obs, num_actions):
+        obs_temp = obs.unsqueeze(1).repeat(1, num_actions, 1).view(obs.shape[0] * num_actions, obs.shape[1])
+        new_obs_actions, _, _, new_obs_log_pi, *_ = self.policy(obs_temp, reparameterize=True, return_log_prob=True)
+        return new_obs_actions, new_obs_log_pi.view(obs.shape[0], num_actions, 1)
+
+    def cql_step(self, batch, discount, num_random, min_q_weight):
+        obs, actions, next_obs = batch["observations"], batch["actions"], batch["next_observations"]
+        alpha, policy_loss = self.policy_and_alpha_loss(obs)
+        q_preds = [qf(obs, actions) for qf in self.qfs]
+        new_next_actions, *_ = self.policy(next_obs, reparameterize=True, return_log_prob=True)
+        self.policy(obs, reparameterize=True, return_log_prob=True)
+        target_q_values = torch.min(*[target_qf(next_obs, new_next_actions) for target_qf in self.target_qfs])
+        q_target = (batch["rewards"] + (1.0 - batch["terminals"]) * discount * target_q_values).detach()
+
+        random_actions = torch.FloatTensor(obs.shape[0] * num_random, actions.shape[-1]).uniform_(-1, 1)
+        curr_actions, curr_log_pis = self._policy_actions(obs, num_random)
+        new_curr_actions, new_log_pis = self._policy_actions(next_obs, num_random)
+        random_density = np.log(0.5 ** ACTION_DIM)
+        qf_losses = []
+        for qf, q_pred in zip(self.qfs, q_preds):
+            cat_q = torch.cat(
+                [
+                    self._tensor_values(obs, random_actions, qf) - random_density,
+                    self._tensor_values(obs, new_curr_actions, qf) - new_log_pis.detach(),
+                    self._tensor_values(obs, curr_actions, qf) - curr_log_pis.detach(),
+                ],
+                1,
+            )
+            min_qf_loss = torch.logsumexp(cat_q, dim=1).mean() * min_q_weight - q_pred.mean() * min_q_weight
+            qf_losses.append(self.qf_criterion(q_pred, q_target) + min_qf_loss)
+        self.step(qf_losses, policy_loss)
+
+
+def check_against_reference(make_trainer, reference_step):
+    policy, qfs, target_qfs = make_networks()
+    env = SimpleNamespace(action_space=SimpleNamespace(shape=(ACTION_DIM,)))
+    trainer = make_trainer(env, copy.deepcopy(policy), copy.deepcopy(qfs), copy.deepcopy(target_qfs))
+    reference = ReferenceCritics(policy, qfs, target_qfs, tau=trainer.soft_target_tau)
+
+    for i, batch in enumerate(make_batches()):
+        torch.manual_seed(i)
+        trainer.train_from_torch(batch)
+        torch.manual_seed(i)
+        reference_step(reference, batch)
+
+        for k in range(2):
+            for name, member, expected in [
+                ("qf", trainer.qfs.member(k), qfs[k]),
+                ("target qf", trainer.target_qfs.member(k), target_qfs[k]),
+            ]:
+                for param, expected_param in zip(member.parameters(), expected.parameters()):
+                    np.testing.assert_allclose(
+                        param.detach().numpy(), expected_param.detach().numpy(), rtol=1e-5, atol=1e-6, err_msg=name
+                    )
+        for param, expected_param in zip(trainer.policy.parameters(), policy.parameters()):
+            np.testing.assert_allclose(param.detach().numpy(), expected_param.detach().numpy(), rtol=1e-5, atol=1e-6)
+    return trainer
+
+
+def test_sac():
+    trainer = check_against_reference(
+        lambda env, policy, qfs, target_qfs: SACTrainer(
+            env, policy, *qfs, *target_qfs, discount=0.9, policy_lr=LR, qf_lr=LR
+        ),
+        lambda reference, batch: reference.sac_step(batch, discount=0.9),
+    )
+
+    # the per critic accessors and snapshot layout
+    obs, actions = torch.randn(3, OBS_DIM), torch.randn(3, ACTION_DIM)
+    np.testing.assert_allclose(
+        trainer.qf2(obs, actions).detach().numpy(), trainer.qfs(obs, actions)[1].detach().numpy(), rtol=1e-6
+    )
+    snapshot = trainer.get_snapshot()
+    assert set(snapshot.keys()) == {"policy", "qf1", "qf2", "target_qf1", "target_qf2"}
+    assert isinstance(snapshot["target_qf1"], FlattenMlp)
+    np.testing.assert_allclose(
+        snapshot["target_qf1"](obs, actions).detach().numpy(),
+        trainer.target_qfs(obs, actions)[0].detach().numpy(),
+        rtol=1e-6,
+    )
+
+
+def test_cql():
+    check_against_reference(
+        lambda env, policy, qfs, target_qfs: CQLTrainer(
+            env, policy, *qfs, *target_qfs, discount=0.9, policy_lr=LR, qf_lr=LR, min_q_weight=2.0, num_random=4
+        ),
+        lambda reference, batch: reference.cql_step(batch, discount=0.9, num_random=4, min_q_weight=2.0),
+    )
+
+
+if __name__ == "__main__":
+    test_sac()
+    test_cql()
@@ -0,0 +1,144 @@
+"""
+Checks the padding of `EpisodeBatch.from_random_batch` on ragged whole path
+batches (different lengths and agent counts), and the handling of a final
+step whose shape does not match the rest of the episode.
+"""
+import sys
+import os
+
+sys.path.append(os.path.dirname(sys.path[0]))
+import numpy as np
+import torch
+
+from marlkit.torch.episode_batch import EpisodeBatch
+
+OBS_DIM = 3
+STATE_DIM = 5
+ACTION_DIM = 4
+
+
+def make_episode(length, n_agents):
+    # per step lists, as emitted by marl_rollout
+    return dict(
+        observations=[np.random.randn(n_agents, OBS_DIM) for _ in range(length)],
+        next_observations=[np.random.randn(n_agents, OBS_DIM) for _ in range(length)],
+        actions=[np.eye(ACTION_DIM)[np.random.randint(ACTION_DIM, size=n_agents)] for _ in range(length)],
+        rewards=[np.random.randn(1, n_agents) for _ in range(length)],
+        terminals=[np.zeros((1, n_agents)) for _ in range(length)],
+        states=[np.random.randn(1, STATE_DIM) for _ in range(length)],
+        next_states=[np.random.randn(1, STATE_DIM) for _ in range(length)],
+    )
+
+
+def to_random_batch(episodes):
+    return {key: [episode[key] for episode in episodes] for key in episodes[0].keys()}
+
+
+def test_padding():
+    episodes = [make_episode(5, 2), make_episode(3, 4), make_episode(7, 3)]
+    batch = EpisodeBatch.from_random_batch(to_random_batch(episodes), device="cpu")
+
+    assert len(batch) == 3
+    assert batch.max_seq_length == 7
+    assert list(batch.lengths) == [5, 3, 7]
+    assert list(batch.n_agents) == [2, 4, 3]
+    assert batch["observations"].shape == (3, 7, 4, OBS_DIM)
+    assert batch["rewards"].shape == (3, 7, 1, 4)
+    assert batch["states"].shape == (3, 7, 1, STATE_DIM)
+    assert batch["observations"].dtype == torch.float32
+
+    for b, episode in enumerate(episodes):
+        length, n_agents = batch.lengths[b], batch.n_agents[b]
+        # the unpadded views hold the episode as it was
+        unpadded = batch.episode(b)
+        for key, steps in episode.items():
+            np.testing.assert_allclose(unpadded[key].numpy(), np.stack(steps, 0), rtol=1e-6)
+        # and everything else is zero
+        observations = batch["observations"][b].clone()
+        observations[:length, :n_agents] = 0
+        assert (observations == 0).all()
+        rewards = batch["rewards"][b].clone()
+        rewards[:length, :, :n_agents] = 0
+        assert (rewards == 0).all()
+
+        assert batch.filled[b].sum() == length
+        assert (batch.filled[b, :length] == 1).all()
+        assert batch.agent_mask[b].sum() == length * n_agents
+        assert (batch.agent_mask[b, :length, :n_agents] == 1).all()
+
+
+def test_ragged_final_step():
+    # the final next observation is missing an agent which has left the env,
+    # it can't be stacked so the episode ends at that step for every key
+    episode = make_episode(6, 3)
+    episode["next_observations"][-1] = [np.random.randn(OBS_DIM) for _ in range(2)] + [np.random.randn(OBS_DIM + 1)]
+    batch = EpisodeBatch.from_random_batch(to_random_batch([episode, make_episode(4, 3)]), device="cpu")
+    assert list(batch.lengths) == [5, 4]
+    assert batch.max_seq_length == 5
+    for key, steps in episode.items():
+        np.testing.assert_allclose(batch.episode(0)[key].numpy(), np.stack(steps[:5], 0), rtol=1e-6)
+    assert (batch["next_observations"][0, 5:] == 0).all()
+
+    # a flattened final state only differs by a reshape, it is kept
+    episode = make_episode(4, 2)
+    episode["next_states"][-1] = episode["next_states"][-1].flatten()
+    batch = EpisodeBatch.from_random_batch(to_random_batch([episode]), device="cpu")
+    assert list(batch.lengths) == [4]
+    np.testing.assert_allclose(batch["next_states"][0, -1].numpy(), episode["next_states"][-1][None, :], rtol=1e-6)
+
+
+def test_slicing():
+    episodes = [make_episode(5, 2), make_episode(3, 4)]
+    batch = EpisodeBatch.from_random_batch(to_random_batch(episodes), device="cpu")
+
+    second = batch[1]
+    assert len(second) == 1 and list(second.lengths) == [3]
+    assert torch.equal(second["observations"][0], batch["observations"][1])
+
+    head = batch.time_slice(1, 4)
+    assert list(head.lengths) == [3, 2]
+    assert torch.equal(head["actions"], batch["actions"][:, 1:4])
+
+    agents = batch.agent_slice([0, 1])
+    assert agents["observations"].shape[2] == 2 and agents["rewards"].shape[3] == 2
+    assert list(agents.n_agents) == [2, 2]
+    assert torch.equal(agents["states"], batch["states"])
+
+    assert torch.equal(batch.shifted("observations")[:, :-1], batch["observations"][:, 1:])
+    assert (batch.last_actions[:, 0] == 0).all()
+    assert torch.equal(batch.last_actions[:, 1:], batch["actions"][:, :-1])
+
+
+def test_batched_steps():
+    episodes = [make_episode(5, 2), make_episode(3, 4), make_episode(6, 2)]
+    batch = EpisodeBatch.from_random_batch(to_random_batch(episodes), device="cpu")
+    weight = torch.randn(OBS_DIM, ACTION_DIM)
+
+    # a step wise function of the padded tensors, cut back to every episode
+    padded = batch["next_observations"] @ weight
+    for b in range(len(batch)):
+        expected = batch.episode(b)["next_observations"] @ weight
+        np.testing.assert_allclose(
+            batch.unpadded(b, padded, "next_observations").numpy(), expected.numpy(), rtol=1e-5, atol=1e-6
+        )
+
+    assert batch.shape_groups("observations", "states") == {
+        ((2, OBS_DIM), (1, STATE_DIM)): [0, 2],
+        ((4, OBS_DIM), (1, STATE_DIM)): [1],
+    }
+
+    # the agent count dependent function sees the unpadded agents only
+    outputs = batch.map_steps(
+        lambda obs, states: obs.sum(1) @ weight + states[:, 0, :ACTION_DIM], "observations", "states"
+    )
+    for b in range(len(batch)):
+        episode = batch.episode(b)
+        expected = episode["observations"].sum(1) @ weight + episode["states"][:, 0, :ACTION_DIM]
+        np.testing.assert_allclose(outputs[b].numpy(), expected.numpy(), rtol=1e-5, atol=1e-6)
+
+
+if __name__ == "__main__":
+    test_padding()
+    test_ragged_final_step()
+    test_slicing()
+    test_batched_steps()
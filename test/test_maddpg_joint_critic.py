@@ -0,0 +1,102 @@
+"""
+Checks the factorized MADDPG joint space critic (`DDPGTrainer._joint_q_values`)
+against the critic on the explicitly concatenated and replication padded
+input, as it was built before, for every padding option and with or without
+layer norm. Critics which override `forward` get the concatenated input.
+"""
+import sys
+import os
+
+sys.path.append(os.path.dirname(sys.path[0]))
+import itertools
+
+import numpy as np
+import torch
+from torch import nn as nn
+
+from marlkit.torch.ddpg.ma_ddpg_discrete import DDPGTrainer
+from marlkit.torch.networks import FlattenMlp, Mlp
+
+T = 5
+OBS_DIM = 4
+ACTION_DIM = 3
+STATE_DIM = 6
+N_AGENTS = 2
+
+
+def replication_pad(x, size):
+    # nn.ReplicationPad1d over the last dimension, as the trainer did
+    pad = (size - x.size(-1)) // 2
+    return nn.ReplicationPad1d((pad, size - x.size(-1) - pad))(x)
+
+
+def reference_q_values(trainer, qf, obs, actions, joint_actions, states):
+    n_agents = actions.shape[-2]
+    rep_actions = joint_actions.repeat(1, 1, n_agents)
+    rep_states = states.repeat(1, n_agents, 1)
+    if trainer.n_actions is not None and trainer.n_agents is not None:
+        rep_actions = replication_pad(rep_actions, trainer.n_actions * trainer.n_agents)
+    if trainer.state_dim is not None:
+        rep_states = replication_pad(rep_states, trainer.state_dim)
+    flat_inputs = torch.cat([obs, actions, rep_actions, rep_states], dim=-1)
+    if trainer.n_agents is not None and n_agents != trainer.n_agents:
+        flat_inputs = replication_pad(flat_inputs.permute(0, 2, 1), trainer.n_agents).permute(0, 2, 1)
+    if trainer.qf_size is not None:
+        flat_inputs = replication_pad(flat_inputs, trainer.qf_size)
+    return qf(flat_inputs)
+
+
+class ScaledMlp(Mlp):
+    def forward(self, input):
+        return 2 * super().forward(input)
+
+
+def make_trainer(qf, n_agents, n_actions, state_dim, qf_size):
+    policy = Mlp([8], ACTION_DIM, OBS_DIM)
+    return DDPGTrainer(
+        qf,
+        qf,
+        policy,
+        policy,
+        use_joint_space=True,
+        n_agents=n_agents,
+        n_actions=n_actions,
+        state_dim=state_dim,
+        qf_size=qf_size,
+    )
+
+
+def test_joint_q_values():
+    torch.manual_seed(0)
+    obs = torch.randn(T, N_AGENTS, OBS_DIM)
+    actions = torch.randn(T, N_AGENTS, ACTION_DIM)
+    joint_actions = torch.randn(T, N_AGENTS, ACTION_DIM)
+    states = torch.randn(T, 1, STATE_DIM)
+
+    paddings = itertools.product([None, 4], [None, ACTION_DIM], [None, STATE_DIM + 3], [None, 64])
+    for (n_agents, n_actions, state_dim, qf_size), layer_norm, cls in itertools.product(
+        paddings, [False, True], [Mlp, FlattenMlp, ScaledMlp]
+    ):
+        if n_agents is None and n_actions is not None:
+            continue
+        joint_size = (n_agents or N_AGENTS) * ACTION_DIM if n_actions is not None else N_AGENTS * ACTION_DIM
+        input_size = qf_size or OBS_DIM + ACTION_DIM + joint_size + (state_dim or STATE_DIM)
+        qf = cls([16, 16], 1, input_size, layer_norm=layer_norm)
+        trainer = make_trainer(qf, n_agents, n_actions, state_dim, qf_size)
+
+        q_values = trainer._joint_q_values(qf, obs, actions, joint_actions, states)
+        expected = reference_q_values(trainer, qf, obs, actions, joint_actions, states)
+        assert q_values.shape == expected.shape
+        np.testing.assert_allclose(q_values.detach().numpy(), expected.detach().numpy(), rtol=1e-5, atol=1e-6)
+
+        # the gradients w.r.t. the critic match too (the last layer norm is unused)
+        grads = torch.autograd.grad(q_values.sum(), list(qf.parameters()), allow_unused=True)
+        expected_grads = torch.autograd.grad(expected.sum(), list(qf.parameters()), allow_unused=True)
+        for grad, expected_grad in zip(grads, expected_grads):
+            assert (grad is None) == (expected_grad is None)
+            if grad is not None:
+                np.testing.assert_allclose(grad.numpy(), expected_grad.numpy(), rtol=1e-4, atol=1e-5)
+
+
+if __name__ == "__main__":
+    test_joint_q_values()
@@ -0,0 +1,103 @@
+"""
+Checks that `MultiSeedDoubleDQNTrainer`, which trains the stacked networks
+of K seeds with one vmapped loss and one optimizer, makes the same updates
+as the K `DoubleDQNTrainer`s trained separately, on ragged episodes (with
+different lengths and agent counts), with and without a QMixer.
+"""
+import sys
+import os
+
+sys.path.append(os.path.dirname(sys.path[0]))
+import copy
+
+import numpy as np
+import torch
+
+from marlkit.torch.dqn.ma_mixer import DoubleDQNTrainer
+from marlkit.torch.episode_batch import EpisodeBatch
+from marlkit.torch.mixers import QMixer
+from marlkit.torch.multi_seed import MultiSeedDoubleDQNTrainer
+from marlkit.torch.networks import Mlp
+
+NUM_SEEDS = 3
+OBS_DIM = 4
+STATE_DIM = 6
+NUM_ACTIONS = 3
+MAX_NUM_AGENTS = 3
+BATCH_SIZE = 4
+NUM_STEPS = 3
+
+
+def make_trainers(use_mixer):
+    trainers = []
+    for seed in range(NUM_SEEDS):
+        torch.manual_seed(seed)
+        qf = Mlp([16, 16], NUM_ACTIONS, OBS_DIM)
+        mixer = QMixer(MAX_NUM_AGENTS, STATE_DIM, 8) if use_mixer else None
+        trainers.append(
+            DoubleDQNTrainer(
+                qf,
+                copy.deepcopy(qf),
+                mixer=mixer,
+                target_mixer=copy.deepcopy(mixer),
+                learning_rate=1e-2,
+                soft_target_tau=0.1,
+            )
+        )
+    return trainers
+
+
+def make_episode(rng, length, n_agents):
+    return dict(
+        observations=[rng.randn(n_agents, OBS_DIM) for _ in range(length)],
+        next_observations=[rng.randn(n_agents, OBS_DIM) for _ in range(length)],
+        actions=[np.eye(NUM_ACTIONS)[rng.randint(NUM_ACTIONS, size=n_agents)] for _ in range(length)],
+        rewards=[rng.randn(1, n_agents) for _ in range(length)],
+        terminals=[(rng.rand(1, n_agents) < 0.1).astype(float) for _ in range(length)],
+        states=[rng.randn(1, STATE_DIM) for _ in range(length)],
+        next_states=[rng.randn(1, STATE_DIM) for _ in range(length)],
+        active_agents=[np.ones((1, MAX_NUM_AGENTS)) for _ in range(length)],
+    )
+
+
+def make_batch(rng):
+    episodes = [make_episode(rng, rng.randint(2, 8), rng.randint(1, MAX_NUM_AGENTS + 1)) for _ in range(BATCH_SIZE)]
+    random_batch = {key: [episode[key] for episode in episodes] for key in episodes[0].keys()}
+    return EpisodeBatch.from_random_batch(random_batch, device="cpu")
+
+
+def check_multi_seed(use_mixer):
+    trainers = make_trainers(use_mixer)
+    # trained separately, before the networks of `trainers` are stacked
+    references = copy.deepcopy(trainers)
+    multi_seed = MultiSeedDoubleDQNTrainer(trainers)
+    assert MultiSeedDoubleDQNTrainer.supports(trainers)
+
+    rng = np.random.RandomState(0)
+    for _ in range(NUM_STEPS):
+        batches = [make_batch(rng) for _ in range(NUM_SEEDS)]
+        multi_seed.train(batches)
+        for reference, batch in zip(references, batches):
+            reference.train_collated(batch)
+
+    for trainer, reference, initial in zip(trainers, references, make_trainers(use_mixer)):
+        names = ["qf", "target_qf"] + (["mixer", "target_mixer"] if use_mixer else [])
+        for name in names:
+            for param, expected in zip(getattr(trainer, name).parameters(), getattr(reference, name).parameters()):
+                np.testing.assert_allclose(param.detach().numpy(), expected.detach().numpy(), atol=1e-6, err_msg=name)
+        # the networks did train
+        assert not torch.allclose(trainer.qf.last_fc.weight, initial.qf.last_fc.weight)
+        assert np.isclose(trainer.eval_statistics["QF Loss"], reference.eval_statistics["QF Loss"], rtol=1e-5)
+
+
+def test_iql():
+    check_multi_seed(use_mixer=False)
+
+
+def test_qmix():
+    check_multi_seed(use_mixer=True)
+
+
+if __name__ == "__main__":
+    test_iql()
+    test_qmix()
@@ -0,0 +1,129 @@
+"""
+Checks the vectorized return operators of `marlkit.torch.returns` against
+reference python loops over the time steps, on padded batches with
+terminals and per agent masks.
+"""
+import sys
+import os
+
+sys.path.append(os.path.dirname(sys.path[0]))
+import numpy as np
+import torch
+
+from marlkit.torch.returns import discounted_reverse_cumsum, gae, n_step_returns, td_lambda_targets
+
+B, T, N = 4, 9, 3
+GAMMA = 0.9
+
+
+def make_batch(seed=0):
+    """
+    `[B, T, 1, N]` rewards, values, terminals and masks. Every trajectory is
+    active up to its length and terminates on its last step or is cut by
+    the padding.
+    """
+    rng = np.random.RandomState(seed)
+    rewards = rng.randn(B, T, 1, N)
+    values = rng.randn(B, T, 1, N)
+    next_values = rng.randn(B, T, 1, N)
+    terminals = np.zeros((B, T, 1, N))
+    mask = np.zeros((B, T, 1, N))
+    for b in range(B):
+        for ag in range(N):
+            length = rng.randint(1, T + 1)
+            mask[b, :length, 0, ag] = 1
+            if rng.rand() < 0.5:
+                terminals[b, length - 1, 0, ag] = 1
+    return [torch.as_tensor(x, dtype=torch.float64) for x in (rewards, values, next_values, terminals, mask)]
+
+
+def reference_n_step_returns(rewards, terminals, next_values, gamma, n, mask):
+    returns = np.zeros_like(rewards)
+    for b, t, ag in np.ndindex(B, T, N):
+        if mask[b, t, 0, ag] == 0:
+            continue
+        ret = 0.0
+        for i in range(n):
+            k = t + i
+            ret += gamma ** i * rewards[b, k, 0, ag]
+            if terminals[b, k, 0, ag]:
+                break
+            if i == n - 1 or k + 1 >= T or mask[b, k + 1, 0, ag] == 0:
+                ret += gamma ** (i + 1) * next_values[b, k, 0, ag]
+                break
+        returns[b, t, 0, ag] = ret
+    return returns
+
+
+def reference_gae(rewards, terminals, values, next_values, gamma, gae_lambda, mask):
+    advantages = np.zeros_like(rewards)
+    for b, ag in np.ndindex(B, N):
+        advantage = 0.0
+        for t in reversed(range(T)):
+            if mask[b, t, 0, ag] == 0:
+                advantage = 0.0
+                continue
+            not_done = 1 - terminals[b, t, 0, ag]
+            delta = rewards[b, t, 0, ag] + gamma * not_done * next_values[b, t, 0, ag] - values[b, t, 0, ag]
+            advantage = delta + gamma * gae_lambda * not_done * advantage
+            advantages[b, t, 0, ag] = advantage
+    return advantages, (advantages + values) * mask
+
+
+def reference_td_lambda_targets(rewards, terminals, mask, target_qs, gamma, td_lambda):
+    # pymarl's build_td_lambda_targets
+    ret = np.zeros_like(target_qs)
+    ret[:, -1] = target_qs[:, -1] * (1 - np.sum(terminals, axis=1))
+    for t in range(ret.shape[1] - 2, -1, -1):
+        ret[:, t] = td_lambda * gamma * ret[:, t + 1] + mask[:, t] * (
+            rewards[:, t] + (1 - td_lambda) * gamma * target_qs[:, t + 1] * (1 - terminals[:, t])
+        )
+    return ret[:, :-1]
+
+
+def test_discounted_reverse_cumsum():
+    x = torch.randn(B, T, 2, dtype=torch.float64)
+    expected = np.zeros((B, T, 2))
+    running = np.zeros((B, 2))
+    for t in reversed(range(T)):
+        running = x[:, t].numpy() + GAMMA * running
+        expected[:, t] = running
+    np.testing.assert_allclose(discounted_reverse_cumsum(x, GAMMA).numpy(), expected, rtol=1e-10)
+
+
+def test_n_step_returns():
+    rewards, _, next_values, terminals, mask = make_batch()
+    for n in (1, 3, T + 2):
+        returns = n_step_returns(rewards, terminals, next_values, GAMMA, n, mask=mask)
+        expected = reference_n_step_returns(
+            *(x.numpy() for x in (rewards, terminals, next_values)), GAMMA, n, mask.numpy()
+        )
+        np.testing.assert_allclose(returns.numpy(), expected, rtol=1e-10, atol=1e-10)
+
+
+def test_gae():
+    rewards, values, next_values, terminals, mask = make_batch(1)
+    for gae_lambda in (0.0, 0.95, 1.0):
+        advantages, returns = gae(rewards, terminals, values, next_values, GAMMA, gae_lambda, mask=mask)
+        expected_advantages, expected_returns = reference_gae(
+            *(x.numpy() for x in (rewards, terminals, values, next_values)), GAMMA, gae_lambda, mask.numpy()
+        )
+        np.testing.assert_allclose(advantages.numpy(), expected_advantages, rtol=1e-10, atol=1e-10)
+        np.testing.assert_allclose(returns.numpy(), expected_returns, rtol=1e-10, atol=1e-10)
+
+
+def test_td_lambda_targets():
+    rewards, target_qs, _, terminals, mask = make_batch(2)
+    for td_lambda in (0.0, 0.8):
+        targets = td_lambda_targets(rewards, terminals, mask, target_qs, GAMMA, td_lambda)
+        expected = reference_td_lambda_targets(
+            *(x.numpy() for x in (rewards, terminals, mask, target_qs)), GAMMA, td_lambda
+        )
+        np.testing.assert_allclose(targets.numpy(), expected, rtol=1e-10, atol=1e-10)
+
+
+if __name__ == "__main__":
+    test_discounted_reverse_cumsum()
+    test_n_step_returns()
+    test_gae()
+    test_td_lambda_targets()